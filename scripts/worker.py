@@ -4,7 +4,11 @@ import argparse
 import datetime
 import logging
 import math
+import multiprocessing
+import multiprocessing.connection
 import signal
+import sys
+import threading
 import traceback
 from argparse import Namespace
 from io import StringIO
@@ -12,21 +16,22 @@ from pathlib import Path
 from tempfile import TemporaryDirectory
 from threading import Event
 from types import FrameType
+from typing import Literal
 
-import torch
-from cloudnet_api_client import APIClient
+import requests
 from cloudnet_api_client.containers import (
     ExtendedProduct,
     Instrument,
     Site,
 )
 
-from processing import utils
+from processing import instrumentation, pipeline, utils
 from processing.config import Config
 from processing.dvas import DvasV3
 from processing.instrument import process_instrument
 from processing.jobs import freeze, update_plots, update_qc, upload_to_dvas
 from processing.metadata_api import MetadataApi
+from processing.metadata_cache import CachedAPIClient, MetadataCache
 from processing.model import process_model
 from processing.pid_utils import PidUtils
 from processing.processor import (
@@ -40,23 +45,60 @@ from processing.product import process_product
 from processing.storage_api import StorageApi
 from processing.utils import send_slack_alert, utcnow, utctoday
 
+MAX_TASKS = 1000
+PIPELINE_DEPTH = 3
+# Exit code of a task process whose task failed in a controlled way, after the
+# error has already been reported. Other non-zero exit codes, including 1 from
+# an uncaught exception, mean that the process itself failed.
+TASK_FAILED_EXIT_CODE = 3
+
+# Imported once in the fork server of the worker pool. Task processes get them
+# from the fork server, so only this script itself is imported per task.
+PRELOAD_MODULES = [
+    "torch",
+    "matplotlib.pyplot",
+    "cloudnetpy.categorize",
+    "cloudnetpy.instruments",
+    "cloudnetpy.plotting",
+    "cloudnetpy.products",
+    "cloudnetpy_qc",
+    "doppy",
+    "orbital_radar",
+    "model_munger",
+    "housekeeping",
+    "processing.instrument_process",
+    "processing.product",
+    "processing.jobs",
+]
+
+TaskAction = Literal["complete", "fail"]
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+
+def _log_to_stderr() -> None:
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logger.addHandler(handler)
+
 
 class MemoryLogger:
-    """Logger that outputs to stderr but also keeps content in memory."""
+    """Logger that outputs to stderr but also keeps content in memory.
 
-    def __init__(self) -> None:
-        logger = logging.getLogger()
-        logger.setLevel(logging.INFO)
-        formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    With `per_thread`, each thread keeps its own memory. Records logged by
+    helper threads (e.g. parallel downloads) then only go to stderr.
+    """
 
-        self._memory = StringIO()
+    def __init__(self, per_thread: bool = False) -> None:
+        self._memory: StringIO | _ThreadLocalMemory = (
+            _ThreadLocalMemory() if per_thread else StringIO()
+        )
         memory_handler = logging.StreamHandler(self._memory)
-        memory_handler.setFormatter(formatter)
-        logger.addHandler(memory_handler)
-
-        stderr_handler = logging.StreamHandler()
-        stderr_handler.setFormatter(formatter)
-        logger.addHandler(stderr_handler)
+        memory_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        logging.getLogger().addHandler(memory_handler)
+        _log_to_stderr()
 
     def clear_memory(self) -> None:
         """Clear log memory."""
@@ -69,32 +111,115 @@ class MemoryLogger:
         return self._memory.getvalue()
 
 
+class _ThreadLocalMemory:
+    """File-like object that keeps a separate buffer for each thread."""
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+
+    @property
+    def _buffer(self) -> StringIO:
+        if not hasattr(self._local, "buffer"):
+            self._local.buffer = StringIO()
+        return self._local.buffer
+
+    def write(self, text: str) -> int:
+        return self._buffer.write(text)
+
+    def flush(self) -> None:
+        pass
+
+    def truncate(self, size: int) -> int:
+        return self._buffer.truncate(size)
+
+    def seek(self, offset: int) -> int:
+        return self._buffer.seek(offset)
+
+    def getvalue(self) -> str:
+        return self._buffer.getvalue()
+
+
+class TaskQueue:
+    """Leases tasks from the data portal queue and reports their outcome."""
+
+    def __init__(
+        self, config: Config, session: requests.Session, queue: str | None
+    ) -> None:
+        self.dataportal_url = config.dataportal_url
+        self.session = session
+        self.queue = queue
+
+    def receive(self) -> dict | None:
+        """Lease a task from the specified queue, or from the default queue if
+        the specified queue is empty. Returns None if there are no tasks."""
+        if self.queue:
+            return self._get_task(self.queue) or self._get_task()
+        return self._get_task()
+
+    def finish(self, task: dict, action: TaskAction) -> None:
+        res = self.session.put(f"{self.dataportal_url}/queue/{action}/{task['id']}")
+        res.raise_for_status()
+        logging.info("Task processed")
+
+    def _get_task(self, queue: str | None = None) -> dict | None:
+        params = {"queue": queue} if queue is not None else None
+        res = self.session.post(f"{self.dataportal_url}/queue/receive", params=params)
+        if res.status_code == 204:
+            return None
+        res.raise_for_status()
+        return res.json()
+
+
 class Worker:
-    def __init__(self, config: Config, queue: str | None) -> None:
+    def __init__(
+        self,
+        config: Config,
+        queue: str | None,
+        logger: MemoryLogger | None = None,
+        cache: MetadataCache | None = None,
+    ) -> None:
         self.config = config
         self.dataportal_url = config.dataportal_url
         self.session = utils.make_session()
-        self.client = APIClient(f"{config.dataportal_url}/api/", self.session)
+        self.client = CachedAPIClient(
+            f"{config.dataportal_url}/api/",
+            self.session,
+            cache or MetadataCache.from_config(config),
+        )
         md_api = MetadataApi(config, self.session)
         storage_api = StorageApi(config, self.session)
         pid_utils = PidUtils(config, self.session)
         dvas = DvasV3(config, md_api, self.client)
         self.processor = Processor(md_api, storage_api, pid_utils, dvas, self.client)
-        self.logger = MemoryLogger()
+        self.logger = logger or MemoryLogger()
+        self.task_queue = TaskQueue(config, self.session, queue)
         self.n_processed_tasks = 0
-        self.queue = queue
 
     def process_task(self) -> bool:
         """Get task from queue and process it. Returns True if a task was
         processed, or False if there's was no task to process."""
-        if self.queue:
-            task = self.get_task(self.queue) or self.get_task()
-        else:
-            task = self.get_task()
+        task = self.task_queue.receive()
         if task is None:
             return False
+        action = self.run_task(task)
+        self.task_queue.finish(task, action)
+        self.n_processed_tasks += 1
+        return True
+
+    def run_task(self, task: dict) -> TaskAction:
+        """Process a leased task. Returns the action to report to the queue."""
         self.logger.clear_memory()
+        with instrumentation.task(task) as record:
+            action = self._run_task(task)
+            record.status = action
+        if action == "fail":
+            # Don't let possibly outdated metadata fail the following tasks.
+            self.client.invalidate()
+        return action
+
+    def _run_task(self, task: dict) -> TaskAction:
         logging.info(f"Processing task: {task}")
+        action: TaskAction
         try:
             date = datetime.date.fromisoformat(task["measurementDate"])
             site = self.processor.get_site(task["siteId"], date)
@@ -220,19 +345,7 @@ class Worker:
             except Exception:
                 logging.exception("Failed to send Slack alert")
             action = "fail"
-        res = self.session.put(f"{self.dataportal_url}/queue/{action}/{task['id']}")
-        res.raise_for_status()
-        logging.info("Task processed")
-        self.n_processed_tasks += 1
-        return True
-
-    def get_task(self, queue: str | None = None) -> dict | None:
-        params = {"queue": queue} if queue is not None else None
-        res = self.session.post(f"{self.dataportal_url}/queue/receive", params=params)
-        if res.status_code == 204:
-            return None
-        res.raise_for_status()
-        return res.json()
+        return action
 
     def publish_followup_tasks(
         self, site: Site, product: ExtendedProduct, params: ProcessParams
@@ -335,6 +448,200 @@ class Worker:
         return {m.instrument for m in metadata}
 
 
+class WorkerPipeline:
+    """Runs a few tasks concurrently in threads of a single process.
+
+    Only one task computes at a time while the others are downloading or
+    uploading, so that the raw data download of the next task and the
+    image and QC uploads of the previous task overlap the conversion of the
+    current task.
+    """
+
+    def __init__(self, config: Config, queue: str | None, depth: int) -> None:
+        self.config = config
+        logger = MemoryLogger(per_thread=True)
+        cache = MetadataCache.from_config(config)
+        self.workers = [Worker(config, queue, logger, cache) for _ in range(depth)]
+
+    @property
+    def n_processed_tasks(self) -> int:
+        return sum(worker.n_processed_tasks for worker in self.workers)
+
+    def run(self, exit: Event) -> None:
+        """Process tasks until `exit` is set, then wait for running tasks."""
+        pipeline.enable()
+        threads = [
+            threading.Thread(
+                target=self._run_worker, args=(worker, exit), name=f"pipeline-{i}"
+            )
+            for i, worker in enumerate(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _run_worker(self, worker: Worker, exit: Event) -> None:
+        try:
+            while not exit.is_set() and self.n_processed_tasks < MAX_TASKS:
+                with pipeline.compute_phase():
+                    processed = worker.process_task()
+                if not processed:
+                    exit.wait(10)
+        except Exception as err:
+            logging.exception("Fatal error in worker")
+            send_slack_alert(
+                self.config, err, source="worker", log=traceback.format_exc()
+            )
+            exit.set()
+
+
+class WorkerPool:
+    """Supervisor that leases tasks and runs each of them in a child process.
+
+    Every task gets a fresh process running the regular `Worker`, so crashes,
+    OOM kills and memory leaks stay inside a single task. Task processes are
+    forked from a fork server that has imported the heavy dependencies once,
+    so the pool can run indefinitely without restarts.
+    """
+
+    def __init__(self, config: Config, queue: str | None, n_processes: int) -> None:
+        self.config = config
+        self.n_processes = n_processes
+        self.session = utils.make_session()
+        self.task_queue = TaskQueue(config, self.session, queue)
+        self.n_threads = _threads_per_process(config, n_processes)
+        self.n_processed_tasks = 0
+        self._context = multiprocessing.get_context("forkserver")
+        self._context.set_forkserver_preload(PRELOAD_MODULES)
+        self._running: list[tuple[multiprocessing.process.BaseProcess, dict]] = []
+
+    def run(self, exit: Event) -> None:
+        """Process tasks until `exit` is set, then wait for running tasks.
+
+        If the supervisor fails, running task processes are terminated and
+        their tasks are released as failed.
+        """
+        try:
+            while not exit.is_set():
+                self._reap_finished()
+                if len(self._running) < self.n_processes:
+                    task = self.task_queue.receive()
+                    if task is not None:
+                        self._start(task)
+                        continue
+                if self._running:
+                    sentinels = [process.sentinel for process, _ in self._running]
+                    multiprocessing.connection.wait(sentinels, timeout=10)
+                else:
+                    exit.wait(10)
+            if self._running:
+                logging.info("Waiting for %d running tasks", len(self._running))
+            for process, _ in self._running:
+                process.join()
+            self._reap_finished()
+        finally:
+            self._terminate()
+
+    def _start(self, task: dict) -> None:
+        process = self._context.Process(
+            target=_run_task_in_child,
+            args=(self.config, task, self.n_threads),
+            name=f"task-{task['id']}",
+        )
+        try:
+            process.start()
+        except BaseException:
+            self._release(task)
+            raise
+        logging.info("Started task %s in process %d", task["id"], process.pid)
+        self._running.append((process, task))
+
+    def _terminate(self) -> None:
+        for process, task in self._running:
+            logging.warning(
+                "Terminating task %s in process %d", task["id"], process.pid
+            )
+            process.terminate()
+        for process, task in self._running:
+            process.join()
+            process.close()
+            self._release(task)
+        self._running = []
+
+    def _release(self, task: dict) -> None:
+        try:
+            self.task_queue.finish(task, "fail")
+        except Exception:
+            logging.exception("Failed to release task %s", task["id"])
+
+    def _reap_finished(self) -> None:
+        still_running = []
+        for process, task in self._running:
+            if process.is_alive():
+                still_running.append((process, task))
+                continue
+            process.join()
+            self._finish(process, task)
+            process.close()
+        self._running = still_running
+
+    def _finish(self, process: multiprocessing.process.BaseProcess, task: dict) -> None:
+        exitcode = process.exitcode
+        if exitcode == 0:
+            action: TaskAction = "complete"
+        else:
+            action = "fail"
+            if exitcode != TASK_FAILED_EXIT_CODE:
+                msg = f"Task process {process.pid} died with exit code {exitcode}"
+                logging.error(msg)
+                send_slack_alert(
+                    self.config,
+                    RuntimeError(msg),
+                    source="worker",
+                    site=task.get("siteId"),
+                    date=task.get("measurementDate"),
+                    model=task.get("modelId"),
+                    product=task.get("productId"),
+                )
+        self.task_queue.finish(task, action)
+        self.n_processed_tasks += 1
+
+
+def _run_task_in_child(config: Config, task: dict, n_threads: int | None) -> None:
+    # Drop handlers possibly set up while preloading, Worker sets up its own.
+    logging.getLogger().handlers.clear()
+    try:
+        if n_threads is not None:
+            # Share of CPUs for this task, used e.g. for parallel decompression.
+            config.cpu_limit = n_threads
+        worker = Worker(config, queue=None)
+        _limit_torch_threads(n_threads)
+        action = worker.run_task(task)
+    except Exception:
+        logging.exception("Task process failed")
+        sys.exit(1)
+    sys.exit(0 if action == "complete" else TASK_FAILED_EXIT_CODE)
+
+
+def _threads_per_process(config: Config, n_processes: int) -> int | None:
+    if config.cpu_limit is None:
+        return None
+    return max(1, math.floor(config.cpu_limit / n_processes))
+
+
+def _limit_torch_threads(n_threads: int | None) -> None:
+    # Limit number of threads for VOODOO. In production, the numbers are set too
+    # high by default.
+    if n_threads is None:
+        return
+    import torch
+
+    logging.info("Limit number of pytorch threads to %d", n_threads)
+    torch.set_num_threads(n_threads)
+    torch.set_num_interop_threads(n_threads)
+
+
 def _should_skip_derived_product(derived_product: ExtendedProduct) -> bool:
     if derived_product.id in (
         "cpr-tc-validation",
@@ -362,24 +669,34 @@ def _parse_args() -> Namespace:
         "--queue",
         help="Process tasks from this queue, or from default queue if the specified queue is empty",
     )
+    parser.add_argument(
+        "--processes",
+        type=_positive_int,
+        help="Process up to N tasks in parallel, each in its own child process",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Overlap downloads and uploads of consecutive tasks with computation",
+    )
     args = parser.parse_args()
+    if args.pipeline and args.processes is not None:
+        parser.error("--pipeline cannot be combined with --processes")
     return args
 
 
+def _positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be a positive integer")
+    return number
+
+
 def main() -> None:
     config = Config()
     args = _parse_args()
-    worker = Worker(config, args.queue)
     exit = Event()
 
-    # Limit number of threads for VOODOO. In production, the numbers are set too
-    # high by default.
-    if config.cpu_limit is not None:
-        n_threads = math.ceil(config.cpu_limit)
-        logging.info("Limit number of pytorch threads to %d", n_threads)
-        torch.set_num_threads(n_threads)
-        torch.set_num_interop_threads(n_threads)
-
     def signal_handler(sig: int, frame: FrameType | None) -> None:
         logging.info("Received termination signal")
         exit.set()
@@ -388,11 +705,25 @@ def main() -> None:
     signal.signal(signal.SIGTERM, signal_handler)
 
     try:
-        logging.info("Waiting for a task...")
-        while not exit.is_set() and worker.n_processed_tasks < 1000:
-            if not worker.process_task():
-                exit.wait(10)
-        logging.info("Terminate after processing the maximum number of tasks")
+        if args.processes is not None:
+            pool = WorkerPool(config, args.queue, args.processes)
+            logging.info("Waiting for tasks with %d processes...", args.processes)
+            pool.run(exit)
+        elif args.pipeline:
+            worker_pipeline = WorkerPipeline(config, args.queue, PIPELINE_DEPTH)
+            if config.cpu_limit is not None:
+                _limit_torch_threads(math.ceil(config.cpu_limit))
+            logging.info("Waiting for tasks in pipeline mode...")
+            worker_pipeline.run(exit)
+        else:
+            worker = Worker(config, args.queue)
+            if config.cpu_limit is not None:
+                _limit_torch_threads(math.ceil(config.cpu_limit))
+            logging.info("Waiting for a task...")
+            while not exit.is_set() and worker.n_processed_tasks < MAX_TASKS:
+                if not worker.process_task():
+                    exit.wait(10)
+        logging.info("Terminate worker")
     except Exception as err:
         logging.exception("Fatal error in worker")
         send_slack_alert(config, err, source="worker", log=traceback.format_exc())
@@ -1,12 +1,23 @@
-"""Module containing helper functions for CH15k concatenation."""
+"""Module containing helper functions for netCDF concatenation."""
 
 import datetime
+import logging
+import math
 import shutil
+from collections.abc import Iterable, Iterator, Mapping
+from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Literal
 
 import netCDF4
-from cloudnetpy import concat_lib as clib
-from cloudnetpy.utils import get_epoch, seconds2date
+import numpy as np
+from cloudnetpy.exceptions import ValidTimeStampError
+from cloudnetpy.utils import get_epoch
+from numpy import ma
+
+TIME_BLOCK_SIZE = 1024
+MEMORY_BUDGET = 256 * 1024 * 1024
 
 
 def concat_netcdf_files(
@@ -15,38 +26,78 @@ def concat_netcdf_files(
     output_file: Path,
     concat_dimension: str = "time",
     variables: list | None = None,
+    time_offsets: Mapping[Path, datetime.timedelta] | None = None,
 ) -> list[Path]:
-    """Concatenates several netcdf files into daily file."""
+    """Concatenates several netcdf files into daily file.
+
+    Timestamps of the files in `time_offsets` are shifted by subtracting the
+    offset, leaving the input files unmodified.
+    """
+    time_offsets = time_offsets or {}
     with netCDF4.Dataset(files[0]) as nc:
         if concat_dimension not in nc.dimensions:
             raise KeyError
     if len(files) == 1:
         shutil.copy(files[0], output_file)
+        if (time_offset := time_offsets.get(files[0])) is not None:
+            with netCDF4.Dataset(output_file, "a") as nc:
+                nc.variables["time"][:] -= time_offset / datetime.timedelta(seconds=1)
         return files
     valid_files = []
     for file in files:
         try:
             with netCDF4.Dataset(file) as nc:
-                time = nc.variables["time"]
-                time_array = time[:]
-                time_units = time.units
+                is_valid = _has_timestamps_on_date(
+                    nc.variables["time"], date, time_offsets.get(file)
+                )
         except OSError:
             continue
-        epoch = get_epoch(time_units)
-        for timestamp in time_array:
-            if seconds2date(timestamp, epoch).date() == date:
-                valid_files.append(file)
-                break
+        if is_valid:
+            valid_files.append(file)
 
-    clib.concatenate_files(
+    concatenate_files(
         valid_files,
         output_file,
         concat_dimension=concat_dimension,
         variables=variables,
+        time_offsets=time_offsets,
     )
     return valid_files
 
 
+def _has_timestamps_on_date(
+    time: netCDF4.Variable,
+    date: datetime.date,
+    time_offset: datetime.timedelta | None = None,
+) -> bool:
+    """Check if any timestamp, in seconds since epoch, is on the given date
+    after subtracting `time_offset`.
+
+    The first and last blocks of timestamps are checked first, so that the
+    whole time array is usually read only for files without valid data.
+    """
+    epoch = get_epoch(time.units)
+    day_start = datetime.datetime.combine(date, datetime.time(), tzinfo=epoch.tzinfo)
+    lower = (day_start - epoch).total_seconds()
+    if time_offset is not None:
+        lower += time_offset / datetime.timedelta(seconds=1)
+    upper = lower + 24 * 60 * 60
+    n_time = time.shape[0]
+    if n_time > 2 * TIME_BLOCK_SIZE:
+        blocks = [
+            slice(0, TIME_BLOCK_SIZE),
+            slice(n_time - TIME_BLOCK_SIZE, n_time),
+            slice(TIME_BLOCK_SIZE, n_time - TIME_BLOCK_SIZE),
+        ]
+    else:
+        blocks = [slice(0, n_time)]
+    for block in blocks:
+        values = ma.compressed(time[block])
+        if np.any((values >= lower) & (values < upper)):
+            return True
+    return False
+
+
 def concat_chm15k_files(
     files: list[Path], date: datetime.date, output_file: Path
 ) -> list:
@@ -68,7 +119,7 @@ def concat_chm15k_files(
     if len(valid_files) == 0:
         raise ValueError
     variables = ["time", "beta_raw", "stddev", "nn1", "nn2", "nn3", "beta_att"]
-    clib.concatenate_files(
+    concatenate_files(
         valid_files,
         output_file,
         variables=variables,
@@ -76,6 +127,286 @@ def concat_chm15k_files(
     return valid_files
 
 
+def concatenate_files(
+    filenames: Iterable[Path],
+    output_file: Path,
+    concat_dimension: str = "time",
+    variables: list[str] | None = None,
+    ignore: list[str] | None = None,
+    time_offsets: Mapping[Path, datetime.timedelta] | None = None,
+    interp_dimension: str = "range",
+    memory_budget: int = MEMORY_BUDGET,
+) -> list[Path]:
+    """Concatenate netCDF files in one dimension.
+
+    Produces the same output as `cloudnetpy.concat_lib.concatenate_files`,
+    but the length of every input file is scanned first, so that the
+    concatenated dimension is allocated to its final length before copying
+    the data. Variables are copied in hyperslabs aligned to the chunks of
+    the input files and limited to `memory_budget` bytes, so large files
+    never need to be read into memory at once.
+
+    Args:
+        filenames: Files to be concatenated.
+        output_file: Output file name.
+        concat_dimension: Dimension name for concatenation.
+        variables: Variables with `concat_dimension` to be concatenated.
+            Default is None when all variables will be saved.
+        ignore: Variables to be ignored.
+        time_offsets: Offsets subtracted from the `time` variable of the
+            given files while copying, e.g. to convert local time to UTC.
+        interp_dimension: Dimension for nearest neighbour interpolation if
+            its size differs between the files.
+        memory_budget: Approximate maximum size of a copied hyperslab in bytes.
+
+    Returns:
+        Files that were successfully concatenated.
+
+    Raises:
+        ValidTimeStampError: No valid files to be concatenated.
+
+    """
+    sources = _scan_files(filenames, concat_dimension, interp_dimension)
+    if not sources:
+        msg = "No valid files to concatenate."
+        raise ValidTimeStampError(msg)
+    while True:
+        try:
+            _concatenate(
+                sources,
+                output_file,
+                concat_dimension,
+                variables,
+                ignore,
+                time_offsets or {},
+                interp_dimension,
+                memory_budget,
+            )
+        except _BrokenFileError as err:
+            logging.exception(f"Caught a NetCDF HDF error. Skipping file '{err.path}'.")
+            sources = [source for source in sources if source.path != err.path]
+            continue
+        return [source.path for source in sources]
+
+
+@dataclass(frozen=True)
+class _Source:
+    path: Path
+    n_rows: int
+
+
+class _BrokenFileError(Exception):
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        super().__init__(str(path))
+
+
+def _scan_files(
+    filenames: Iterable[Path], concat_dimension: str, interp_dimension: str
+) -> list[_Source]:
+    sources = []
+    for filename in sorted(filenames, key=lambda f: Path(f).name):
+        with netCDF4.Dataset(filename) as nc:
+            n_rows = nc[concat_dimension].size
+            # Skip strange .znc files with no time and huge range dimension
+            # resulting in large memory usage (e.g. Jülich 2019-05-18).
+            if n_rows > 0 and nc[interp_dimension].size < 10_000:
+                sources.append(_Source(Path(filename), n_rows))
+    return sources
+
+
+def _concatenate(
+    sources: list[_Source],
+    output_file: Path,
+    concat_dimension: str,
+    keep: list[str] | None,
+    ignore: list[str] | None,
+    time_offsets: Mapping[Path, datetime.timedelta],
+    interp_dimension: str,
+    memory_budget: int,
+) -> None:
+    offsets = np.cumsum([0] + [source.n_rows for source in sources])
+    with (
+        netCDF4.Dataset(sources[0].path) as first,
+        netCDF4.Dataset(output_file, "w", format=_data_model(first)) as output,
+    ):
+        first.set_auto_scale(False)
+        for name, dim in first.dimensions.items():
+            output.createDimension(name, None if name == concat_dimension else dim.size)
+        _copy_attributes(first, output)
+        for key, var in first.variables.items():
+            if (
+                keep is not None
+                and key not in keep
+                and key != concat_dimension
+                and concat_dimension in var.dimensions
+            ) or (ignore and key in ignore):
+                continue
+            dimensions = var.dimensions
+            if concat_dimension not in dimensions and key != interp_dimension:
+                dimensions = (concat_dimension, *dimensions)
+            var_new = output.createVariable(
+                key,
+                var.dtype,
+                dimensions,
+                zlib=True,
+                complevel=3,
+                shuffle=False,
+                fill_value=var.get_fill_value(),
+            )
+            var_new.set_auto_scale(False)
+
+        # Writing the whole time variable first sets the concatenated
+        # dimension to its final length.
+        preallocated = (
+            "time" in output.variables
+            and concat_dimension in output.variables["time"].dimensions
+        )
+        if preallocated:
+            for ind, source in enumerate(sources):
+                with _open_source(source, ind) as nc:
+                    if "time" not in nc.variables:
+                        continue
+                    _copy_variable(
+                        nc,
+                        first,
+                        output,
+                        "time",
+                        offsets[ind],
+                        source.n_rows,
+                        interp_dimension,
+                        memory_budget,
+                        time_offsets.get(source.path),
+                    )
+
+        for ind, source in enumerate(sources):
+            with _open_source(source, ind) as nc:
+                for key in output.variables:
+                    if (
+                        key not in nc.variables
+                        or (ind > 0 and key == interp_dimension)
+                        or (preallocated and key == "time")
+                    ):
+                        continue
+                    _copy_variable(
+                        nc,
+                        first,
+                        output,
+                        key,
+                        offsets[ind],
+                        source.n_rows,
+                        interp_dimension,
+                        memory_budget,
+                        time_offsets.get(source.path) if key == "time" else None,
+                    )
+            if ind == 0:
+                for key, var_new in output.variables.items():
+                    _copy_attributes(first.variables[key], var_new)
+
+
+@contextmanager
+def _open_source(source: _Source, ind: int) -> Iterator[netCDF4.Dataset]:
+    """Open input file, reporting HDF errors in other than the first file."""
+    try:
+        with netCDF4.Dataset(source.path) as nc:
+            nc.set_auto_scale(False)
+            yield nc
+    except RuntimeError as err:
+        if ind > 0 and "NetCDF: HDF error" in str(err):
+            raise _BrokenFileError(source.path) from err
+        raise
+
+
+def _copy_variable(
+    nc: netCDF4.Dataset,
+    first: netCDF4.Dataset,
+    output: netCDF4.Dataset,
+    key: str,
+    ind0: int,
+    n_rows: int,
+    interp_dimension: str,
+    memory_budget: int,
+    time_offset: datetime.timedelta | None,
+) -> None:
+    var = nc.variables[key]
+    var_new = output.variables[key]
+    if key == interp_dimension:
+        var_new[:] = var[:]
+        return
+    interpolation = None
+    if (
+        interp_dimension in var_new.dimensions
+        and first[interp_dimension].size != nc[interp_dimension].size
+    ):
+        interpolation = _nearest_indices(nc, first, interp_dimension)
+    shift = None
+    if time_offset is not None:
+        shift = time_offset / datetime.timedelta(seconds=1)
+        shift /= getattr(var, "scale_factor", 1)
+    expand = var.dimensions != var_new.dimensions
+    if expand:
+        row = var[:][np.newaxis, ...]
+        step = max(1, memory_budget // max(row.nbytes, 1))
+    else:
+        step = _rows_per_slab(var, memory_budget)
+    for start in range(0, n_rows, step):
+        stop = min(start + step, n_rows)
+        if expand:
+            array = np.repeat(row, stop - start, axis=0)
+        else:
+            array = var[start:stop, ...]
+        array = _process_slab(array, var_new, interpolation, shift)
+        var_new[ind0 + start : ind0 + stop, ...] = array
+
+
+def _process_slab(
+    array: np.ndarray,
+    var_new: netCDF4.Variable,
+    interpolation: tuple[np.ndarray, np.ndarray] | None,
+    shift: float | None,
+) -> np.ndarray:
+    if interpolation is not None:
+        idx, out_of_bounds = interpolation
+        array = array[:, idx]
+        array[:, out_of_bounds] = var_new.get_fill_value()
+    if shift is not None:
+        array = array - shift
+    return array
+
+
+def _nearest_indices(
+    nc: netCDF4.Dataset, first: netCDF4.Dataset, interp_dimension: str
+) -> tuple[np.ndarray, np.ndarray]:
+    x = nc.variables[interp_dimension][:]
+    x_target = first.variables[interp_dimension][:]
+    idx = np.abs(x[:, None] - x_target[None, :]).argmin(axis=0)
+    out_of_bounds = (x_target < x.min()) | (x_target > x.max())
+    return idx, out_of_bounds
+
+
+def _rows_per_slab(var: netCDF4.Variable, memory_budget: int) -> int:
+    row_size = np.dtype(var.dtype).itemsize * math.prod(var.shape[1:])
+    n_rows = max(1, memory_budget // max(row_size, 1))
+    chunking = var.chunking()
+    if isinstance(chunking, list) and chunking:
+        chunk_rows = chunking[0]
+        n_rows = max(chunk_rows, n_rows // chunk_rows * chunk_rows)
+    return n_rows
+
+
+def _data_model(nc: netCDF4.Dataset) -> Literal["NETCDF4", "NETCDF4_CLASSIC"]:
+    return "NETCDF4" if nc.data_model == "NETCDF4" else "NETCDF4_CLASSIC"
+
+
+def _copy_attributes(
+    source: netCDF4.Dataset | netCDF4.Variable,
+    target: netCDF4.Dataset | netCDF4.Variable,
+) -> None:
+    for attr in source.ncattrs():
+        if attr != "_FillValue":
+            setattr(target, attr, getattr(source, attr))
+
+
 def _remove_files_with_wrong_date(files: list, date: datetime.date) -> list:
     """Remove files that contain wrong date."""
     valid_files = []
@@ -1,5 +1,6 @@
 import datetime
 import os
+from pathlib import Path
 
 
 class Config:
@@ -34,6 +35,21 @@ class Config:
         self.cpu_limit = (
             _parse_cpu_limit(environ["CPU_LIMIT"]) if "CPU_LIMIT" in environ else None
         )
+        self.metadata_cache_ttl = datetime.timedelta(
+            seconds=int(environ.get("METADATA_CACHE_TTL", "3600"))
+        )
+        self.metadata_cache_size = int(environ.get("METADATA_CACHE_SIZE", "1000"))
+        self.metadata_cache_path = (
+            Path(environ["METADATA_CACHE_PATH"])
+            if "METADATA_CACHE_PATH" in environ
+            else None
+        )
+        self.file_cache_dir = (
+            Path(environ["FILE_CACHE_DIR"]) if "FILE_CACHE_DIR" in environ else None
+        )
+        self.file_cache_size = int(
+            float(environ.get("FILE_CACHE_SIZE_GB", "10")) * 1024**3
+        )
 
 
 def _parse_cpu_limit(value: str) -> float:
@@ -0,0 +1,174 @@
+"""Persistent local cache for downloaded files, keyed by checksum.
+
+Files are never linked to the cache with hard links, because processing
+modifies some downloaded files in place (e.g. CL61D time offsets and PIDs
+added when freezing). Instead, cache hits are served as reflinks where the
+file system supports them, and copied otherwise.
+"""
+
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import BinaryIO
+
+from processing.config import Config
+from processing.hashing import file_digests, invalidate_file_digests
+
+FICLONE = 0x40049409
+STALE_TEMP_FILE_AGE = 60 * 60
+
+
+class FileCache:
+    """Size-bounded LRU cache of files that can be shared by several workers.
+
+    Files are inserted atomically by renaming a complete temporary file into
+    place. Reading a file while another process evicts it is safe, because
+    the file is opened before it is cloned. Fetched files are verified, and
+    entries with a wrong size or checksum are removed.
+
+    The total size of the cached files is kept in an index file, so that the
+    directory is scanned only when the total exceeds `max_size` or is not
+    known. Concurrent inserts can make the total inexact, but every scan
+    corrects it.
+    """
+
+    def __init__(self, directory: Path, max_size: int) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self._tmp_dir = directory / "tmp"
+        self._tmp_dir.mkdir(parents=True, exist_ok=True)
+        self._lock_path = directory / "lock"
+        self._size_path = directory / "size"
+
+    @classmethod
+    def from_config(cls, config: Config) -> "FileCache | None":
+        if config.file_cache_dir is None:
+            return None
+        return cls(config.file_cache_dir, config.file_cache_size)
+
+    def fetch(
+        self, checksum: str, algorithm: str, output_path: Path, size: int | None = None
+    ) -> bool:
+        """Write cached file to `output_path`. Returns False if the file is not
+        in the cache, or if it does not have the given `size` and checksum."""
+        path = self._path(checksum, algorithm)
+        try:
+            src = path.open("rb")
+        except FileNotFoundError:
+            return False
+        with src:
+            cached_size = os.fstat(src.fileno()).st_size
+            if size is not None and cached_size != size:
+                self._remove(path, cached_size)
+                return False
+            with output_path.open("wb") as dst:
+                _clone(src, dst)
+        invalidate_file_digests(output_path)
+        digests = file_digests(output_path)
+        if getattr(digests, algorithm).hex() != checksum:
+            self._remove(path, cached_size)
+            return False
+        # Modification time is used for LRU eviction.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def insert(self, path: Path, checksum: str, algorithm: str) -> None:
+        """Add a file with a verified checksum to the cache."""
+        cache_path = self._path(checksum, algorithm)
+        if cache_path.exists():
+            return
+        try:
+            fd, tmp_name = tempfile.mkstemp(dir=self._tmp_dir)
+            try:
+                with path.open("rb") as src, os.fdopen(fd, "wb") as dst:
+                    _clone(src, dst)
+                size = os.stat(tmp_name).st_size
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(tmp_name, cache_path)
+            except BaseException:
+                Path(tmp_name).unlink(missing_ok=True)
+                raise
+            total_size = self._update_size(size)
+            if total_size is None or total_size > self.max_size:
+                self._evict()
+        except OSError as err:
+            logging.warning("Failed to add file to cache: %s", err)
+
+    def _path(self, checksum: str, algorithm: str) -> Path:
+        return self.directory / algorithm / checksum[:2] / checksum
+
+    def _evict(self) -> None:
+        with self._lock_path.open("a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another process is already evicting.
+                return
+            now = time.time()
+            for tmp_path in self._tmp_dir.iterdir():
+                if now - _stat_mtime(tmp_path) > STALE_TEMP_FILE_AGE:
+                    tmp_path.unlink(missing_ok=True)
+            entries = []
+            total_size = 0
+            for algorithm_dir in self.directory.iterdir():
+                if not algorithm_dir.is_dir() or algorithm_dir == self._tmp_dir:
+                    continue
+                for path in algorithm_dir.glob("*/*"):
+                    try:
+                        stat = path.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                    total_size += stat.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total_size <= self.max_size:
+                    break
+                path.unlink(missing_ok=True)
+                total_size -= size
+            self._update_size(total=total_size)
+
+    def _remove(self, path: Path, size: int) -> None:
+        logging.warning("Removing invalid file from cache: %s", path)
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            return
+        self._update_size(-size)
+
+    def _update_size(self, delta: int = 0, total: int | None = None) -> int | None:
+        """Add `delta` to the total size of cached files, or set it to `total`.
+        Returns the new total, or None if it is not known."""
+        fd = os.open(self._size_path, os.O_RDWR | os.O_CREAT)
+        with os.fdopen(fd, "r+") as size_file:
+            fcntl.flock(size_file, fcntl.LOCK_EX)
+            if total is None:
+                try:
+                    total = int(size_file.read()) + delta
+                except ValueError:
+                    return None
+            size_file.seek(0)
+            size_file.truncate()
+            size_file.write(str(total))
+            return total
+
+
+def _stat_mtime(path: Path) -> float:
+    try:
+        return path.stat().st_mtime
+    except FileNotFoundError:
+        return time.time()
+
+
+def _clone(src: BinaryIO, dst: BinaryIO) -> None:
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
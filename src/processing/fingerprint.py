@@ -0,0 +1,222 @@
+"""Fingerprints of the inputs used to generate a product.
+
+A product whose stored fingerprint matches the fingerprint of the current
+inputs would be regenerated identically, so processing can be skipped.
+Fingerprints are conservative: they cover all raw files of the instrument
+and all source product files of the site on the dates read in processing, so
+that changes in any file that might be used change the fingerprint.
+
+The data portal metadata has no field for the fingerprints, so they are
+also recorded in the file cache, keyed by the checksum of the product file.
+This way an unchanged product does not need to be downloaded to read its
+fingerprint. Computing a fingerprint costs a few API requests, so it is only
+done when the cache is configured. Without the cache, the existing product
+would always be downloaded before the fingerprints could be compared.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+
+import netCDF4
+from cloudnet_api_client import APIClient, CloudnetAPIError
+
+from processing.config import Config
+from processing.processor import (
+    CalibrationProvider,
+    ExtendedSite,
+    InstrumentParams,
+    ModelParams,
+    ProcessParams,
+    ProductParams,
+)
+from processing.version import __version__ as cloudnet_processing_version
+
+ATTRIBUTE = "input_fingerprint"
+
+# Products that use inputs not described by the data portal metadata, or that
+# have side effects besides the product file.
+UNSUPPORTED_PRODUCTS = frozenset(
+    (
+        "categorize-voodoo",
+        "cpr-simulation",
+        "cpr-tc-validation",
+        "cpr-validation",
+        "mwr-single",
+    )
+)
+
+# Source products that are used but not listed in the product definition.
+EXTRA_SOURCE_PRODUCTS = {
+    "mwr": ("lidar", "doppler-lidar"),
+    "mwr-l1c": ("lidar", "doppler-lidar"),
+}
+
+# Instruments whose processing reads raw files of neighbouring dates (days
+# before, days after) regardless of time offsets.
+ADJACENT_RAW_DAYS = {
+    "cl61d": (1, 1),
+    "halo-doppler-lidar": (1, 1),
+    "mira-35": (1, 0),
+}
+
+SOFTWARE = ("ceilopyter", "cloudnetpy", "doppy", "model-munger", "mwrpy", "rpgpy")
+
+
+def compute_input_fingerprint(
+    client: APIClient,
+    params: ProcessParams,
+    calibration: CalibrationProvider | None = None,
+) -> str | None:
+    """Return fingerprint of the inputs, or None if the product is not
+    supported or has no inputs.
+
+    Calibration is fetched with `calibration` if given, so that it can be
+    reused in processing.
+    """
+    if params.product.id in UNSUPPORTED_PRODUCTS or isinstance(
+        params.site, ExtendedSite
+    ):
+        return None
+    inputs: dict = {
+        "site": [
+            params.site.id,
+            params.site.latitude,
+            params.site.longitude,
+            params.site.altitude,
+        ],
+        "software": _get_software_versions(),
+    }
+    if isinstance(params, (InstrumentParams, ProductParams)) and params.instrument:
+        if calibration is None:
+            calibration = CalibrationProvider(
+                client, params.instrument.pid, params.date
+            )
+        inputs["calibration"] = _get_calibration(calibration)
+    if isinstance(params, InstrumentParams):
+        start_date, end_date = _get_raw_date_range(params, inputs["calibration"])
+        raw_files = client.raw_files(
+            params.site.id,
+            date_from=start_date,
+            date_to=end_date,
+            instrument_pid=params.instrument.pid,
+            status=["uploaded", "processed"],
+        )
+        if not raw_files:
+            return None
+        inputs["raw"] = sorted(f"{f.uuid}:{f.checksum}" for f in raw_files)
+    product_ids = params.product.source_product_ids.union(
+        EXTRA_SOURCE_PRODUCTS.get(params.product.id, ())
+    )
+    if product_ids:
+        products = client.files(
+            params.site.id, date=params.date, product_id=sorted(product_ids)
+        )
+        inputs["products"] = sorted(f"{f.uuid}:{f.checksum}" for f in products)
+    if "raw" not in inputs and not inputs.get("products"):
+        return None
+    if isinstance(params, ModelParams):
+        inputs["model"] = params.model.id
+    payload = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def read_input_fingerprint(full_path: Path) -> str | None:
+    with netCDF4.Dataset(full_path, "r") as nc:
+        return getattr(nc, ATTRIBUTE, None)
+
+
+class FingerprintStore:
+    """Input fingerprints of product files keyed by their SHA-256 checksum.
+
+    Entries live next to the cached files and are evicted with them, which
+    only means that the product is downloaded to read its fingerprint.
+    Without a cache directory, nothing is stored.
+    """
+
+    def __init__(self, directory: Path | None) -> None:
+        self.directory = directory
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    @classmethod
+    def from_config(cls, config: Config) -> "FingerprintStore":
+        if config.file_cache_dir is None:
+            return cls(None)
+        return cls(config.file_cache_dir / ATTRIBUTE)
+
+    def get(self, checksum: str) -> str | None:
+        if self.directory is None:
+            return None
+        try:
+            return self._path(checksum).read_text()
+        except OSError:
+            return None
+
+    def put(self, checksum: str, fingerprint: str | None) -> None:
+        if self.directory is None or fingerprint is None:
+            return
+        path = self._path(checksum)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(dir=self.directory)
+            try:
+                with os.fdopen(fd, "w") as file:
+                    file.write(fingerprint)
+                os.replace(tmp_name, path)
+            except BaseException:
+                Path(tmp_name).unlink(missing_ok=True)
+                raise
+        except OSError as err:
+            logging.warning("Failed to store input fingerprint: %s", err)
+
+    def _path(self, checksum: str) -> Path:
+        assert self.directory is not None
+        return self.directory / checksum[:2] / checksum
+
+
+def _get_raw_date_range(
+    params: InstrumentParams, calibration: dict | None
+) -> tuple[datetime.date, datetime.date]:
+    """Return dates of the raw files read in processing. Files of the
+    neighbouring date are read if a time offset shifts data across midnight."""
+    days_before, days_after = ADJACENT_RAW_DAYS.get(
+        params.instrument.instrument_id, (0, 0)
+    )
+    time_offset = (calibration or {}).get("data", {}).get("time_offset")
+    if time_offset is not None and time_offset < 0:
+        days_before = 1
+    elif time_offset is not None and time_offset > 0:
+        days_after = 1
+    return (
+        params.date - datetime.timedelta(days=days_before),
+        params.date + datetime.timedelta(days=days_after),
+    )
+
+
+def _get_calibration(
+    calibration: CalibrationProvider, date: datetime.date | None = None
+) -> dict | None:
+    try:
+        return calibration.get(date)
+    except CloudnetAPIError:
+        return None
+
+
+def _get_software_versions() -> dict[str, str | None]:
+    versions: dict[str, str | None] = {
+        "cloudnet-processing": cloudnet_processing_version
+    }
+    for package in SOFTWARE:
+        try:
+            versions[package] = version(package)
+        except PackageNotFoundError:
+            versions[package] = None
+    return versions
@@ -10,6 +10,7 @@ import cloudnetpy.output
 import cloudnetpy.utils
 import netCDF4
 import numpy as np
+from numpy import ma
 
 from processing.version import __version__ as cloudnet_processing_version
 
@@ -59,7 +60,7 @@ class Level1Nc:
     def copy_file_contents(
         self,
         keys: tuple | None = None,
-        time_ind: list | None = None,
+        time_ind: np.ndarray | None = None,
         skip: tuple | None = None,
     ) -> None:
         """Copies all variables and global attributes from one file to another.
@@ -78,7 +79,7 @@ class Level1Nc:
                 self.copy_variable(key, time_ind)
         self._copy_global_attributes()
 
-    def copy_variable(self, key: str, time_ind: list | None = None) -> None:
+    def copy_variable(self, key: str, time_ind: np.ndarray | None = None) -> None:
         """Copies one variable from source file to target. Optionally uses certain
         time indices only.
         """
@@ -190,7 +191,7 @@ class Level1Nc:
             if key in self.nc.variables:
                 self.nc.variables[key].__setattr__(attribute, value)
 
-    def get_valid_time_indices(self) -> list:
+    def get_valid_time_indices(self) -> np.ndarray:
         """Finds valid time indices."""
         # Handle old Leipzig Parsivel files
         if "Meas_Time" in self.nc_raw.variables:
@@ -221,14 +222,14 @@ class Level1Nc:
                 time_stamps = np.array(cloudnetpy.utils.seconds2hours(time_stamps))
 
             max_time = 1440 if "minutes" in time.units else 24
-        valid_ind: list[int] = []
-        for ind, t in enumerate(time_stamps):
-            if 0 <= t < max_time:
-                if t < 0 or raw_time_stamps[ind] < 0:
-                    continue
-                if len(valid_ind) > 0 and t <= time_stamps[valid_ind[-1]]:
-                    continue
-                valid_ind.append(ind)
+        times = ma.masked_array(time_stamps, dtype=float).filled(np.nan)
+        is_negative = ma.filled(raw_time_stamps < 0, False)
+        is_valid = (times >= 0) & (times < max_time) & ~is_negative
+        # Keep only timestamps later than all valid timestamps before them.
+        candidates = np.where(is_valid, times, -np.inf)
+        previous_max = np.maximum.accumulate(np.concatenate(([-np.inf], candidates)))
+        is_valid &= times > previous_max[:-1]
+        valid_ind = np.flatnonzero(is_valid)
         if len(valid_ind) < 2:
             raise cloudnetpy.exceptions.ValidTimeStampError
         return valid_ind
@@ -379,21 +380,29 @@ class Level1Nc:
 
     @staticmethod
     def _screen_data(
-        variable: netCDF4.Variable, time_ind: list | None = None
+        variable: netCDF4.Variable, time_ind: np.ndarray | None = None
     ) -> np.ndarray:
         if (
             variable.ndim > 0
             and time_ind is not None
             and variable.dimensions[0] in ("time", "dim")
         ):
+            ind = Level1Nc._time_selection(time_ind)
             if variable.ndim == 1:
-                return variable[time_ind]
+                return variable[ind]
             if variable.ndim == 2:
-                return variable[time_ind, :]
+                return variable[ind, :]
             if variable.ndim == 3:
-                return variable[time_ind, :, :]
+                return variable[ind, :, :]
         return variable[:]
 
+    @staticmethod
+    def _time_selection(time_ind: np.ndarray) -> slice | np.ndarray:
+        """Returns contiguous time indices as a slice which is faster to read."""
+        if len(time_ind) > 0 and np.all(np.diff(time_ind) == 1):
+            return slice(int(time_ind[0]), int(time_ind[-1]) + 1)
+        return time_ind
+
     @staticmethod
     def _copy_variable_attributes(
         source: netCDF4.Variable, target: netCDF4.Variable
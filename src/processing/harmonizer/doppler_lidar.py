@@ -81,7 +81,7 @@ def harmonize_doppler_lidar_stare_file(
 
 
 class DopplerLidarWindNc(core.Level1Nc):
-    def copy_file(self, valid_ind: list) -> None:
+    def copy_file(self, valid_ind: np.ndarray) -> None:
         keys = (
             "time",
             "height",
@@ -114,7 +114,7 @@ class DopplerLidarStareNc(core.Level1Nc):
                 self.nc.serial_number = getattr(self.nc, attr)
                 delattr(self.nc, attr)
 
-    def copy_file(self, valid_ind: list) -> None:
+    def copy_file(self, valid_ind: np.ndarray) -> None:
         """Copies useful variables only."""
         keys = (
             "beta",
@@ -45,7 +45,7 @@ def harmonize_halo_calibrated_file(data: dict) -> UUID:
 
 
 class HaloNcCalibrated(core.Level1Nc):
-    def copy_file(self, valid_ind: list) -> None:
+    def copy_file(self, valid_ind: np.ndarray) -> None:
         """Copies useful variables only."""
         keys = ("beta", "beta_raw", "time", "wavelength", "elevation", "range")
         self.copy_file_contents(keys, valid_ind)
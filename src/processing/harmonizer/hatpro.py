@@ -4,10 +4,10 @@ from tempfile import NamedTemporaryFile
 from uuid import UUID
 
 import cloudnetpy.exceptions
-import cloudnetpy.utils
 import netCDF4
 import numpy as np
 from cloudnetpy.instruments import instruments
+from numpy import ma
 
 from processing.harmonizer import core
 from processing.utils import MiscError, utctoday
@@ -99,40 +99,42 @@ class HatproNc(core.Level1Nc):
             if self.nc_raw.variables[key][:] != 1:  # not UTC
                 raise ValueError("Local time is not supported")
 
-    def _filter_zenith_observations(self, time_ind: list) -> list:
+    def _filter_zenith_observations(self, time_ind: np.ndarray) -> np.ndarray:
         """Keeps only timestamps where elevation angle is close to 90°."""
         key = _find_elevation_angle_key(self.nc_raw)
         if key is None:
             return time_ind
-        elevation = self.nc_raw.variables[key][time_ind]
+        elevation = self.nc_raw.variables[key][self._time_selection(time_ind)]
         tolerance = 5.0
         mask = np.abs(elevation - 90.0) < tolerance
-        filtered = np.array(time_ind)[mask].tolist()
-        if not filtered:
+        filtered = time_ind[mask]
+        if len(filtered) == 0:
             msg = "No valid timestamps with zenith observations found, check the elevation angle data"
             raise cloudnetpy.exceptions.ValidTimeStampError(msg)
         return filtered
 
-    def _get_valid_timestamps(self) -> list:
+    def _get_valid_timestamps(self) -> np.ndarray:
         time_stamps = self.nc_raw.variables["time"][:]
         epoch = _get_epoch(self.nc_raw.variables["time"].units)
         expected_date = self.data["date"]
-        valid_ind = []
-        for t_ind, t in enumerate(time_stamps):
-            if (0 < t < 24 and epoch.date() == expected_date) or (
-                cloudnetpy.utils.seconds2date(t, epoch).date() == expected_date
-            ):
-                valid_ind.append(t_ind)
-        if not valid_ind:
+        seconds = ma.masked_array(time_stamps, dtype=float).filled(np.nan)
+        day_start = (expected_date - epoch.date()).total_seconds()
+        day_end = day_start + datetime.timedelta(days=1).total_seconds()
+        is_valid = (seconds >= day_start) & (seconds < day_end)
+        if epoch.date() == expected_date:
+            is_valid |= (seconds > 0) & (seconds < 24)
+        valid_ind = np.flatnonzero(is_valid)
+        if len(valid_ind) == 0:
             msg = "No valid timestamps found, check the time data"
             raise cloudnetpy.exceptions.ValidTimeStampError(msg)
-        _, ind = np.unique(time_stamps[valid_ind], return_index=True)
-        return list(np.array(valid_ind)[ind])
+        _, ind = np.unique(seconds[valid_ind], return_index=True)
+        return valid_ind[ind]
 
     def _copy_hatpro_file_contents(
-        self, time_ind: list, keys: tuple | None = None
+        self, time_ind: np.ndarray, keys: tuple | None = None
     ) -> None:
         self.nc.createDimension("time", len(time_ind))
+        selection = self._time_selection(time_ind)
         for name, variable in self.nc_raw.variables.items():
             if keys is not None and name not in keys:
                 continue
@@ -149,7 +151,7 @@ class HatproNc(core.Level1Nc):
             )
             self._copy_variable_attributes(variable, var_out)
             var_out[:] = (
-                variable[time_ind] if "time" in variable.dimensions else variable[:]
+                variable[selection] if "time" in variable.dimensions else variable[:]
             )
         self._copy_global_attributes()
 
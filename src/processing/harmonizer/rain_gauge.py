@@ -94,12 +94,12 @@ class RainGaugeNc(core.Level1Nc):
 
     def copy_data(
         self,
-        time_ind: list,
+        time_ind: np.ndarray,
     ) -> None:
         for key in VALID_KEYS:
             self._copy_variable(key, time_ind)
 
-    def _copy_variable(self, key: str, time_ind: list) -> None:
+    def _copy_variable(self, key: str, time_ind: np.ndarray) -> None:
         if key not in self.nc_raw.variables.keys():
             logging.debug(f"Key {key} not found from the source file.")
             return
@@ -95,8 +95,9 @@ def harmonize_ws_file(data: dict) -> UUID:
 
 
 class Ws(core.Level1Nc):
-    def copy_ws_file_contents(self, time_ind: list) -> None:
+    def copy_ws_file_contents(self, time_ind: np.ndarray) -> None:
         self.nc.createDimension("time", len(time_ind))
+        selection = self._time_selection(time_ind)
         for key, variable in self.nc_raw.variables.items():
             if key not in list(VARIABLE_MAP.keys()) + ["datetime", "time"]:
                 continue
@@ -126,7 +127,7 @@ class Ws(core.Level1Nc):
                 )
                 return
 
-            data = variable[time_ind] if "time" in dimensions else variable[:]
+            data = variable[selection] if "time" in dimensions else variable[:]
             fill_value = _get_fill_value(data)
 
             var = self.nc.createVariable(
@@ -0,0 +1,148 @@
+"""Checksums of local files and netCDF variables."""
+
+import base64
+import hashlib
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+
+CHUNK_SIZE = 1024 * 1024
+MAX_CACHED_FILES = 256
+DIGESTS_ATTRIBUTE = "variable_digests"
+# Approximate size of hyperslabs read when computing variable digests.
+DIGEST_CHUNK_MEMORY = 64 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class FileDigests:
+    md5: bytes
+    sha256: bytes
+
+    @property
+    def md5_base64(self) -> str:
+        return base64.b64encode(self.md5).decode()
+
+    @property
+    def sha256_hex(self) -> str:
+        return self.sha256.hex()
+
+
+_cache: OrderedDict[str, tuple[tuple[int, ...], FileDigests]] = OrderedDict()
+_lock = threading.Lock()
+
+
+def file_digests(path: Path) -> FileDigests:
+    """Return MD5 and SHA-256 digests of file.
+
+    Both digests are computed in a single pass over the file. The result is
+    cached by path, so that e.g. uploading a file and reporting its checksum
+    to the data portal reads the file only once. File status changes too
+    seldom to detect every modification with coarse timestamps, so code that
+    writes files must call `invalidate_file_digests`.
+    """
+    key = os.path.abspath(path)
+    stat = path.stat()
+    file_status = (
+        stat.st_dev,
+        stat.st_ino,
+        stat.st_size,
+        stat.st_mtime_ns,
+        stat.st_ctime_ns,
+    )
+    with _lock:
+        if (entry := _cache.get(key)) is not None and entry[0] == file_status:
+            _cache.move_to_end(key)
+            return entry[1]
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    with path.open("rb", buffering=0) as f:
+        while n := f.readinto(buffer):
+            md5.update(view[:n])
+            sha256.update(view[:n])
+    digests = FileDigests(md5=md5.digest(), sha256=sha256.digest())
+    with _lock:
+        _cache[key] = (file_status, digests)
+        while len(_cache) > MAX_CACHED_FILES:
+            _cache.popitem(last=False)
+    return digests
+
+
+def invalidate_file_digests(path: Path) -> None:
+    """Forget cached digests of file that is being written."""
+    with _lock:
+        _cache.pop(os.path.abspath(path), None)
+
+
+def variable_digests(nc: netCDF4.Dataset) -> dict[str, str]:
+    """Return digests of all variables in file."""
+    return {name: variable_digest(var) for name, var in nc.variables.items()}
+
+
+def read_variable_digests(nc: netCDF4.Dataset) -> dict[str, str]:
+    """Return variable digests stored in file, or an empty dictionary."""
+    try:
+        digests = json.loads(getattr(nc, DIGESTS_ATTRIBUTE))
+    except (AttributeError, ValueError):
+        return {}
+    return digests if isinstance(digests, dict) else {}
+
+
+def variable_digest(var: netCDF4.Variable) -> str:
+    """Return digest of variable's data type, dimensions, attributes and
+    data.
+
+    The data is read without masking and scaling, so the digest covers the
+    mask through the fill values and the masking attributes.
+    """
+    header = {
+        "dtype": str(np.dtype(var.dtype).newbyteorder("=")),
+        "dimensions": var.dimensions,
+        "shape": var.shape,
+        "attributes": {
+            name: _attribute_value(var.getncattr(name)) for name in var.ncattrs()
+        },
+    }
+    digest = hashlib.sha256(json.dumps(header, sort_keys=True, default=str).encode())
+    mask, scale = var.mask, var.scale
+    var.set_auto_maskandscale(False)
+    try:
+        if var.ndim == 0:
+            _update_digest(digest, var[...])
+        else:
+            n_rows = var.shape[0]
+            row_size = np.dtype(var.dtype).itemsize * math.prod(var.shape[1:])
+            step = max(1, DIGEST_CHUNK_MEMORY // max(row_size, 1))
+            for start in range(0, n_rows, step):
+                _update_digest(digest, var[start : start + step])
+    finally:
+        var.set_auto_mask(mask)
+        var.set_auto_scale(scale)
+    return digest.hexdigest()[:32]
+
+
+def _update_digest(digest: "hashlib._Hash", data: np.ndarray) -> None:
+    data = np.asarray(data)
+    if data.dtype.kind == "O":
+        for item in data.flat:
+            digest.update(str(item).encode() + b"\0")
+        return
+    if data.dtype.byteorder == ">":
+        data = data.astype(data.dtype.newbyteorder("<"))
+    digest.update(np.ascontiguousarray(data).tobytes())
+
+
+def _attribute_value(value: object) -> object:
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
@@ -1,16 +1,24 @@
 import logging
 from pathlib import Path
-from typing import Type
+from typing import TYPE_CHECKING, Type
 
-import netCDF4
 from cloudnetpy.exceptions import CloudnetException
 
-from processing import instrument_process, utils
+from processing import instrumentation, utils
+from processing.fingerprint import (
+    FingerprintStore,
+    compute_input_fingerprint,
+    read_input_fingerprint,
+)
+from processing.hashing import file_digests
 from processing.netcdf_comparer import NCDiff, nc_difference
-from processing.processor import InstrumentParams, Processor
+from processing.processor import CalibrationProvider, InstrumentParams, Processor
 from processing.utils import Uuid
 
-ProcessClass = Type[instrument_process.ProcessInstrument]
+if TYPE_CHECKING:
+    from processing.instrument_process import ProcessInstrument
+
+    ProcessClass = Type[ProcessInstrument]
 
 
 def process_instrument(
@@ -18,15 +26,35 @@ def process_instrument(
 ) -> None:
     uuid = Uuid()
     pid_to_new_file = None
+    calibration = CalibrationProvider(
+        processor.client, params.instrument.pid, params.date
+    )
+    fingerprints = FingerprintStore.from_config(processor.md_api.config)
+    fingerprint = (
+        compute_input_fingerprint(processor.client, params, calibration)
+        if fingerprints.enabled
+        else None
+    )
     if existing_product := processor.get_product(params):
         if existing_product.volatile:
             uuid.volatile = existing_product.uuid
             pid_to_new_file = existing_product.pid or None
         filename = existing_product.filename
         s3key = existing_product.s3key
+        if fingerprint is not None and (
+            fingerprints.get(existing_product.checksum) == fingerprint
+        ):
+            _skip_unchanged_inputs(processor, params)
+            return
         existing_file = processor.storage_api.download_product(
             existing_product, directory
         )
+        if fingerprint is not None:
+            existing_fingerprint = read_input_fingerprint(existing_file)
+            fingerprints.put(existing_product.checksum, existing_fingerprint)
+            if fingerprint == existing_fingerprint:
+                _skip_unchanged_inputs(processor, params)
+                return
     else:
         filename = _generate_filename(params)
         existing_file = None
@@ -35,7 +63,8 @@ def process_instrument(
     volatile = not existing_file or uuid.volatile is not None
 
     try:
-        new_file = _process_file(processor, params, uuid, directory)
+        with instrumentation.phase("convert"):
+            new_file = _process_file(processor, params, uuid, directory, calibration)
     except utils.RawDataMissingError as err:
         raise utils.SkipTaskError(err.message) from err
     except NotImplementedError as err:
@@ -43,36 +72,51 @@ def process_instrument(
     except CloudnetException as err:
         raise utils.SkipTaskError(str(err)) from err
 
-    if not params.product.experimental:
-        processor.pid_utils.add_pid_to_file(new_file, pid_to_new_file)
-
-    utils.add_global_attributes(new_file, params.instrument.pid)
+    with utils.FileFinalizer(new_file, summarize=True) as finalizer:
+        if not params.product.experimental:
+            processor.pid_utils.add_pid(finalizer, pid_to_new_file)
+        finalizer.add_global_attributes(params.instrument.pid, fingerprint)
+    summary = finalizer.summary
+    variables = finalizer.variables
 
     upload = True
     patch = False
     if existing_product and existing_file:
-        difference = nc_difference(existing_file, new_file)
+        difference = nc_difference(
+            existing_file, new_file, utils.available_cpus(processor.md_api.config)
+        )
         if difference == NCDiff.NONE:
             upload = False
             new_file = existing_file
             uuid.product = existing_product.uuid
+            # The existing file may have a stale fingerprint or none at all.
+            fingerprints.put(existing_product.checksum, fingerprint)
         elif difference == NCDiff.MINOR:
-            # Replace existing file
+            # Replace existing file. The files are compared only after
+            # finalizing, so PID and UUID are patched in another open.
             patch = True
-            if not params.product.experimental:
-                processor.pid_utils.add_pid_to_file(new_file, existing_product.pid)
-            with netCDF4.Dataset(new_file, "r+") as nc:
-                nc.file_uuid = str(existing_product.uuid)
+            with utils.FileFinalizer(new_file, summarize=True) as finalizer:
+                if not params.product.experimental:
+                    processor.pid_utils.add_pid(finalizer, existing_product.pid)
+                finalizer.set("file_uuid", str(existing_product.uuid))
+            summary = finalizer.summary
             uuid.product = existing_product.uuid
 
     if upload:
         processor.upload_file(
-            params, new_file, filename, volatile, patch, uuid.product, s3key
+            params, new_file, filename, volatile, patch, uuid.product, s3key, summary
         )
+        fingerprints.put(file_digests(new_file).sha256_hex, fingerprint)
     else:
         logging.info("Skipping PUT to data portal, file has not changed")
     processor.create_and_upload_images(
-        new_file, params.product.id, params.site.id, uuid.product, filename, directory
+        new_file,
+        params.product.id,
+        params.site.id,
+        uuid.product,
+        filename,
+        directory,
+        variables=variables,
     )
     qc_result = processor.upload_quality_report(
         new_file, uuid.product, params.site, params.product.id
@@ -83,6 +127,21 @@ def process_instrument(
         processor.process_housekeeping(params)
 
 
+def _skip_unchanged_inputs(processor: Processor, params: InstrumentParams) -> None:
+    """Finish task without processing when the existing product was generated
+    from the current inputs."""
+    logging.info("Skipping processing, inputs have not changed")
+    raw_files = processor.client.raw_files(
+        params.site.id,
+        date=params.date,
+        instrument_pid=params.instrument.pid,
+        status="uploaded",
+    )
+    processor.update_statuses([f.uuid for f in raw_files], "processed")
+    if processor.md_api.config.is_production:
+        processor.process_housekeeping(params)
+
+
 def _generate_filename(params: InstrumentParams) -> str:
     identifier = params.instrument.instrument_id
     if params.product.id == "mwr-l1c":
@@ -101,15 +160,21 @@ def _generate_filename(params: InstrumentParams) -> str:
 
 
 def _process_file(
-    processor: Processor, params: InstrumentParams, uuid: Uuid, directory: Path
+    processor: Processor,
+    params: InstrumentParams,
+    uuid: Uuid,
+    directory: Path,
+    calibration: CalibrationProvider,
 ) -> Path:
+    from processing import instrument_process
+
     product_camel_case = "".join(
         [part.capitalize() for part in params.product.id.split("-")]
     )
     instrument_snake_case = params.instrument.instrument_id.replace("-", "_")
-    process_class: ProcessClass = getattr(
+    process_class: "ProcessClass" = getattr(
         instrument_process, f"Process{product_camel_case}"
     )
-    process = process_class(directory, params, uuid, processor)
+    process = process_class(directory, params, uuid, processor, calibration)
     getattr(process, f"process_{instrument_snake_case}")()
     return process.output_path
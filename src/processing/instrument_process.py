@@ -1,15 +1,15 @@
+import concurrent.futures
 import dataclasses
 import datetime
-import gzip
 import itertools
 import logging
 import math
+import multiprocessing
 import re
 import shutil
-import tarfile
 from collections import defaultdict
 from pathlib import Path
-from typing import Literal, NoReturn
+from typing import Iterable, Literal, NoReturn
 from uuid import UUID
 
 import doppy
@@ -38,13 +38,21 @@ from cloudnetpy.instruments import (
     wr2nc,
     ws2nc,
 )
-from cloudnetpy.utils import is_timestamp
 from requests.exceptions import HTTPError
 
-from processing import concat_wrapper, harmonizer
+from processing import concat_wrapper, harmonizer, instrumentation, pipeline
 from processing.harmonizer.rain_gauge import pluvio2nc
-from processing.processor import InstrumentParams, Processor
-from processing.utils import RawDataMissingError, Uuid, unzip_gz_file
+from processing.processor import CalibrationProvider, InstrumentParams, Processor
+from processing.utils import (
+    RawDataMissingError,
+    Uuid,
+    available_cpus,
+    try_unzip_gz_file,
+)
+
+# Smaller sets of files are decompressed in the main process.
+PARALLEL_UNZIP_MIN_FILES = 8
+TIMESTAMP_LINE = re.compile(rb"-(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\n?")
 
 
 class ProcessInstrument:
@@ -54,6 +62,7 @@ class ProcessInstrument:
         params: InstrumentParams,
         uuid: Uuid,
         processor: Processor,
+        calibration: CalibrationProvider | None = None,
     ) -> None:
         self.output_path = directory / "output.nc"
         self.daily_path = directory / "daily.nc"
@@ -68,6 +77,10 @@ class ProcessInstrument:
             "longitude": params.site.longitude,
             "altitude": params.site.altitude,
         }
+        self.calibration = calibration or CalibrationProvider(
+            processor.client, params.instrument.pid, params.date
+        )
+        self.n_cpus = available_cpus(processor.md_api.config)
         self._kwargs = self._get_kwargs()
         self._args = self._get_args()
 
@@ -104,6 +117,8 @@ class ProcessInstrument:
         filename_suffix: set[str] | str | None = None,
         subdir: str | None = None,
         time_offset: datetime.timedelta | None = None,
+        decompress: bool = False,
+        time_window: tuple[datetime.datetime, datetime.datetime] | None = None,
     ) -> tuple[list[Path], list[UUID]]:
         directory = self.raw_dir
         if subdir is not None:
@@ -124,15 +139,15 @@ class ProcessInstrument:
             filename_prefix=filename_prefix,
             filename_suffix=filename_suffix,
             time_offset=time_offset,
+            decompress=decompress,
+            time_window=time_window,
         )
 
     def _get_time_offset(
         self, date: datetime.date | None = None
     ) -> datetime.timedelta | None:
         try:
-            calibration = self.processor.client.calibration(
-                self.params.instrument.pid, date or self.params.date
-            )
+            calibration = self.calibration.get(date)
             if "time_offset" in calibration["data"]:
                 return datetime.timedelta(minutes=calibration["data"]["time_offset"])
         except CloudnetAPIError:
@@ -150,9 +165,8 @@ class ProcessRadar(ProcessInstrument):
             self.uuid.product = bowtie2nc(self.daily_path, *self._args, **self._kwargs)
         else:
             full_paths, raw_uuids = self.download_instrument(
-                include_pattern=r"zen.*\.lv1(\.gz)?$"
+                include_pattern=r"zen.*\.lv1(\.gz)?$", decompress=True
             )
-            full_paths = _unzip_gz_files(full_paths)
             self.uuid.product, valid_full_paths = rpg2nc(
                 self.raw_dir, *self._args, **self._kwargs
             )
@@ -162,8 +176,7 @@ class ProcessRadar(ProcessInstrument):
         self.process_rpg_fmcw_94()
 
     def process_mira_10(self) -> None:
-        full_paths, self.uuid.raw = self.download_instrument()
-        full_paths = _unzip_gz_files(full_paths)
+        full_paths, self.uuid.raw = self.download_instrument(decompress=True)
         for key in ("azimuth_offset", "zenith_offset", "snr_limit"):
             self._add_calibration(key)
         output_filename, site_meta = self._args
@@ -180,22 +193,27 @@ class ProcessRadar(ProcessInstrument):
             filename_suffix={".znc", ".znc.gz", ".znc.tar.gz"},
             allow_empty=True,
             exclude_pattern=r"[a-z]+\.znc",
+            decompress=True,
         )
         if not full_paths:
             full_paths, self.uuid.raw = self.download_instrument(
-                include_pattern=r"\.mmclx(\.\d+)?(\.gz)?$"
+                include_pattern=r"\.mmclx(\.\d+)?(\.gz)?$", decompress=True
             )
             if self.params.site.id == "chilbolton":
                 # 2021-2022 30 min of data in previous day
                 previous_date = self.params.date - datetime.timedelta(days=1)
                 prefix = f"{previous_date.strftime('%Y%m%d')}_23"
+                midnight = datetime.datetime.combine(self.params.date, datetime.time())
                 paths_previous, uuids_previous = self.download_instrument(
-                    date=previous_date, filename_prefix=prefix, allow_empty=True
+                    date=previous_date,
+                    filename_prefix=prefix,
+                    allow_empty=True,
+                    decompress=True,
+                    time_window=(midnight - datetime.timedelta(minutes=30), midnight),
                 )
                 full_paths.extend(paths_previous)
                 self.uuid.raw.extend(uuids_previous)
 
-        full_paths = _unzip_gz_files(full_paths)
         for key in (
             "azimuth_offset",
             "zenith_offset",
@@ -244,9 +262,7 @@ class ProcessRadar(ProcessInstrument):
         api_key: str | None = None,
     ) -> None:
         try:
-            calibration = self.processor.client.calibration(
-                self.params.instrument.pid, self.params.date
-            )
+            calibration = self.calibration.get()
         except CloudnetAPIError:
             return
         data = calibration["data"]
@@ -304,7 +320,7 @@ class ProcessDopplerLidarWind(ProcessInstrument):
         full_paths, self.uuid.raw = self.download_instrument(
             include_pattern=r".*(vad)|(dbs).*\.nc.*",
         )
-        full_paths = _unzip_gz_files(full_paths)
+        full_paths = _unzip_gz_files(full_paths, self.n_cpus)
         vad_paths = [p for p in full_paths if re.match(r".*_vad_(.*)\.nc\.*", p.name)]
         if vad_paths:
             group_pattern = re.compile(r".*_vad_(.*)\.nc\.*")
@@ -345,9 +361,7 @@ class ProcessDopplerLidarWind(ProcessInstrument):
 
     def _calibration_options(self) -> doppy.product.WindOptions | None:
         try:
-            calibration = self.processor.client.calibration(
-                self.params.instrument.pid, self.params.date
-            )
+            calibration = self.calibration.get()
             azimuth_offset = (
                 calibration.get("data", {}).get("azimuth_offset")
                 if calibration
@@ -437,7 +451,7 @@ class ProcessDopplerLidar(ProcessInstrument):
         full_paths, self.uuid.raw = self.download_instrument(
             include_pattern=r".*fixed.*\.nc(\..+)?"
         )
-        full_paths = _unzip_gz_files(full_paths)
+        full_paths = _unzip_gz_files(full_paths, self.n_cpus)
 
         try:
             # Try to process all "fixed" files at once.
@@ -480,9 +494,7 @@ class ProcessDopplerLidar(ProcessInstrument):
     def _noise_mask_method(self) -> doppy.options.NoiseMaskMethod:
         default = doppy.options.NoiseMaskMethod.INTENSITY_AND_VELOCITY
         try:
-            calibration = self.processor.client.calibration(
-                self.params.instrument.pid, self.params.date
-            )
+            calibration = self.calibration.get()
         except CloudnetAPIError:
             return default
         value = (
@@ -523,7 +535,7 @@ class ProcessLidar(ProcessInstrument):
     def process_ct25k(self) -> None:
         full_paths, self.uuid.raw = self.download_instrument()
         full_paths.sort()
-        full_paths = _unzip_gz_files(full_paths)
+        full_paths = _unzip_gz_files(full_paths, self.n_cpus)
         _concatenate_text_files(full_paths, self.daily_path)
         self._call_ceilo2nc("ct25k")
 
@@ -560,22 +572,23 @@ class ProcessLidar(ProcessInstrument):
         time_offset = self._get_time_offset()
         full_paths, self.uuid.raw = self.download_instrument(time_offset=time_offset)
         full_paths.sort()
-        _concatenate_text_files(full_paths, self.daily_path)
         if time_offset is not None:
             logging.info(
                 "Shifting timestamps to UTC by %d minutes",
                 time_offset / datetime.timedelta(minutes=1),
             )
-            _fix_cl51_timestamps(self.daily_path, time_offset)
+        _concatenate_text_files(full_paths, self.daily_path, time_offset)
         self._call_ceilo2nc("cl51")
 
     def process_cl61d(self) -> None:
+        previous_date = self.params.date - datetime.timedelta(days=1)
+        next_date = self.params.date + datetime.timedelta(days=1)
+        self.calibration.prefetch([previous_date, self.params.date, next_date])
         current_offset = self._get_time_offset(self.params.date)
         full_paths, raw_uuids = self.download_instrument(
             exclude_pattern="clu-generated"
         )
-        _apply_cl61d_time_offset(full_paths, current_offset)
-        previous_date = self.params.date - datetime.timedelta(days=1)
+        time_offsets = _cl61d_time_offsets(full_paths, current_offset)
         previous_offset = self._get_time_offset(previous_date)
         n_hours_previous = _cl61d_boundary_hours(
             current_offset, previous_offset, direction="previous"
@@ -584,10 +597,9 @@ class ProcessLidar(ProcessInstrument):
             paths_previous, uuids_previous = self._download_cl61d_boundary(
                 previous_date, n_hours_previous, direction="previous"
             )
-            _apply_cl61d_time_offset(paths_previous, previous_offset)
+            time_offsets |= _cl61d_time_offsets(paths_previous, previous_offset)
             full_paths.extend(paths_previous)
             raw_uuids.extend(uuids_previous)
-        next_date = self.params.date + datetime.timedelta(days=1)
         next_offset = self._get_time_offset(next_date)
         n_hours_next = _cl61d_boundary_hours(
             current_offset, next_offset, direction="next"
@@ -596,7 +608,7 @@ class ProcessLidar(ProcessInstrument):
             paths_next, uuids_next = self._download_cl61d_boundary(
                 next_date, n_hours_next, direction="next"
             )
-            _apply_cl61d_time_offset(paths_next, next_offset)
+            time_offsets |= _cl61d_time_offsets(paths_next, next_offset)
             full_paths.extend(paths_next)
             raw_uuids.extend(uuids_next)
         variables = ["x_pol", "p_pol", "beta_att", "time", "tilt_angle"]
@@ -606,6 +618,7 @@ class ProcessLidar(ProcessInstrument):
                 self.params.date,
                 self.daily_path,
                 variables=variables,
+                time_offsets=time_offsets,
             )
         except KeyError:
             valid_full_paths = concat_wrapper.concat_netcdf_files(
@@ -614,6 +627,7 @@ class ProcessLidar(ProcessInstrument):
                 self.daily_path,
                 concat_dimension="profile",
                 variables=variables,
+                time_offsets=time_offsets,
             )
         if not valid_full_paths:
             raise RawDataMissingError()
@@ -628,21 +642,30 @@ class ProcessLidar(ProcessInstrument):
     ) -> tuple[list[Path], list[UUID]]:
         if direction == "previous":
             hour_pattern = "|".join(f"{23 - i:02d}" for i in range(n_hours))
+            window_end = datetime.datetime.combine(
+                date + datetime.timedelta(days=1), datetime.time()
+            )
+            window_start = window_end - datetime.timedelta(hours=n_hours)
         else:
             hour_pattern = "|".join(f"{i:02d}" for i in range(n_hours))
+            window_start = datetime.datetime.combine(date, datetime.time())
+            window_end = window_start + datetime.timedelta(hours=n_hours)
         paths, uuids = self.download_instrument(
             date=date,
             include_pattern=f"_{date.strftime('%Y%m%d')}_({hour_pattern})",
             exclude_pattern="clu-generated",
             allow_empty=True,
+            time_window=(window_start, window_end),
         )
         if paths:
             return paths, uuids
-        # Fallback for files without hour in filename (e.g. daily files)
+        # Fallback for files without hour in filename (e.g. daily files).
+        # Files with timestamps in another format are still filtered.
         return self.download_instrument(
             date=date,
             exclude_pattern="clu-generated",
             allow_empty=True,
+            time_window=(window_start, window_end),
         )
 
     def process_da10(self) -> None:
@@ -672,9 +695,7 @@ class ProcessLidar(ProcessInstrument):
     def _fetch_ceilo_calibration(self) -> dict:
         output: dict = {}
         try:
-            calibration = self.processor.client.calibration(
-                self.params.instrument.pid, self.params.date
-            )
+            calibration = self.calibration.get()
         except CloudnetAPIError:
             return output
         if "calibration_factor" in calibration["data"]:
@@ -688,9 +709,7 @@ class ProcessLidar(ProcessInstrument):
     def _fetch_pollyxt_calibration(self) -> dict:
         output = {"snr_limit": 25.0}
         try:
-            calibration = self.processor.client.calibration(
-                self.params.instrument.pid, self.params.date
-            )
+            calibration = self.calibration.get()
         except CloudnetAPIError:
             return output
         if "snr_limit" in calibration["data"]:
@@ -797,7 +816,7 @@ class ProcessMwr(ProcessInstrument):
             filename_suffix=".gz", allow_empty=True
         )
         if full_paths:
-            _unzip_gz_files(full_paths)
+            _unzip_gz_files(full_paths, self.n_cpus)
         else:
             full_paths, self.uuid.raw = self.download_instrument()
         self.uuid.product = radiometrics2nc(self.raw_dir, *self._args, **self._kwargs)
@@ -876,7 +895,7 @@ class ProcessDisdrometer(ProcessInstrument):
     def process_thies_lnm(self) -> None:
         full_paths, self.uuid.raw = self.download_instrument()
         full_paths.sort()
-        full_paths = _unzip_gz_files(full_paths)
+        full_paths = _unzip_gz_files(full_paths, self.n_cpus)
         _concatenate_text_files(full_paths, self.daily_path)
         site_meta = self.site_meta.copy()
         if self.params.site.id == "leipzig-lim":
@@ -893,9 +912,7 @@ class ProcessDisdrometer(ProcessInstrument):
     def _fetch_parsivel_calibration(self) -> dict:
         output: dict = {"telegram": None, "missing_timestamps": False}
         try:
-            calibration = self.processor.client.calibration(
-                self.params.instrument.pid, self.params.date
-            )
+            calibration = self.calibration.get()
         except CloudnetAPIError:
             return output
         return calibration["data"]
@@ -970,7 +987,7 @@ class ProcessWeatherStation(ProcessInstrument):
 class ProcessRainRadar(ProcessInstrument):
     def process_mrr_pro(self) -> None:
         full_paths, self.uuid.raw = self.download_instrument()
-        full_paths = _unzip_gz_files(full_paths)
+        full_paths = _unzip_gz_files(full_paths, self.n_cpus)
         self.uuid.product = mrr2nc(full_paths, *self._args, **self._kwargs)
 
 
@@ -989,45 +1006,46 @@ def _get_valid_uuids(
     ]
 
 
-def _unzip_gz_files(full_paths: list[Path]) -> list[Path]:
+@instrumentation.phase("decompress")
+def _unzip_gz_files(full_paths: list[Path], max_workers: int = 1) -> list[Path]:
+    n_files = sum(path.suffix == ".gz" for path in full_paths)
+    max_workers = min(max_workers, n_files)
+    if max_workers < 2 or n_files < PARALLEL_UNZIP_MIN_FILES:
+        results: Iterable[tuple[list[Path], str | None]] = map(
+            try_unzip_gz_file, full_paths
+        )
+        return _collect_unzipped_files(full_paths, results)
+    context = multiprocessing.get_context("forkserver")
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers, mp_context=context
+    ) as executor:
+        chunksize = max(1, len(full_paths) // (4 * max_workers))
+        results = executor.map(try_unzip_gz_file, full_paths, chunksize=chunksize)
+        return _collect_unzipped_files(full_paths, results)
+
+
+def _collect_unzipped_files(
+    full_paths: list[Path], results: Iterable[tuple[list[Path], str | None]]
+) -> list[Path]:
     paths_out: list[Path] = []
-    for path_in in full_paths:
-        try:
-            paths_out.extend(unzip_gz_file(path_in))
-        except (EOFError, gzip.BadGzipFile, tarfile.TarError) as err:
-            logging.warning("Cannot unzip gz file %s: %s", path_in, err)
+    for path_in, (paths, error) in zip(full_paths, results):
+        if error is not None:
+            logging.warning("Cannot unzip gz file %s: %s", path_in, error)
+        paths_out.extend(paths)
     return paths_out
 
 
-def _fix_cl51_timestamps(filename: Path, offset: datetime.timedelta) -> None:
-    with open(filename, "r") as file:
-        lines = file.readlines()
-    for ind, line in enumerate(lines):
-        if is_timestamp(line):
-            date_time = line.strip("-").strip("\n")
-            date_time_utc = _shift_datetime(date_time, offset)
-            lines[ind] = f"-{date_time_utc}\n"
-    with open(filename, "w") as file:
-        file.writelines(lines)
-
-
-def _apply_cl61d_time_offset(
+def _cl61d_time_offsets(
     paths: list[Path], time_offset: datetime.timedelta | None
-) -> None:
+) -> dict[Path, datetime.timedelta]:
+    """Return time offsets of files, applied later during concatenation."""
     if not paths or time_offset is None:
-        return
+        return {}
     logging.info(
         "Shifting timestamps to UTC by %d minutes",
         time_offset / datetime.timedelta(minutes=1),
     )
-    for path in paths:
-        _fix_cl61d_timestamps(path, time_offset)
-
-
-def _fix_cl61d_timestamps(filename: Path, offset: datetime.timedelta) -> None:
-    offset_seconds = offset / datetime.timedelta(seconds=1)
-    with netCDF4.Dataset(filename, "a") as nc:
-        nc.variables["time"][:] -= offset_seconds
+    return {path: time_offset for path in paths}
 
 
 def _cl61d_boundary_hours(
@@ -1325,19 +1343,47 @@ def _doppy_wls70_wind_to_nc(
             )
 
 
-def _shift_datetime(date_time: str, offset: datetime.timedelta) -> str:
-    """Shifts datetime N hours."""
-    dt = datetime.datetime.strptime(date_time, "%Y-%m-%d %H:%M:%S")
-    dt = dt - offset
-    return dt.strftime("%Y-%m-%d %H:%M:%S")
-
+def _concatenate_text_files(
+    filenames: list,
+    output_filename: Path,
+    time_offset: datetime.timedelta | None = None,
+) -> None:
+    """Concatenates text files.
 
-def _concatenate_text_files(filenames: list, output_filename: Path) -> None:
-    """Concatenates text files."""
+    If `time_offset` is given, it is subtracted from timestamp lines of the
+    form "-yyyy-mm-dd hh:mm:ss" while copying. Line endings are then
+    converted to "\n" like when reading the files in text mode.
+    """
     with open(output_filename, "wb") as target:
-        for filename in filenames:
-            with open(filename, "rb") as source:
-                shutil.copyfileobj(source, target)
+        if time_offset is None:
+            for filename in filenames:
+                with open(filename, "rb") as source:
+                    shutil.copyfileobj(source, target)
+            return
+        for line in _read_lines(filenames):
+            if match := TIMESTAMP_LINE.fullmatch(line):
+                dt = datetime.datetime.strptime(match[1].decode(), "%Y-%m-%d %H:%M:%S")
+                dt -= time_offset
+                line = f"-{dt:%Y-%m-%d %H:%M:%S}\n".encode()
+            target.write(line)
+
+
+def _read_lines(filenames: list) -> Iterable[bytes]:
+    """Yield lines of concatenated files with universal newlines, i.e.
+    "\r\n" and "\r" converted to "\n"."""
+    pending_cr = False
+    for filename in filenames:
+        with open(filename, "rb") as source:
+            for line in source:
+                if pending_cr and line.startswith(b"\n"):
+                    line = line[1:]
+                pending_cr = line.endswith(b"\r")
+                for part in line.splitlines(keepends=True):
+                    if part.endswith(b"\r\n"):
+                        part = part[:-2] + b"\n"
+                    elif part.endswith(b"\r"):
+                        part = part[:-1] + b"\n"
+                    yield part
 
 
 def _check_chm_version(filename: Path, identifier: str) -> None:
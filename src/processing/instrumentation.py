@@ -0,0 +1,150 @@
+"""Per-task timing and resource usage.
+
+The worker opens a record for each task with `task`. Code that belongs to
+one of the task phases runs inside `phase`, and the time spent in a nested
+phase is only counted for the innermost phase. Time outside of any phase is
+reported as "other". When the task finishes, the record is logged as a
+single JSON line. Outside of a task, all functions in this module are no-ops.
+
+CPU time is per task in all worker modes. In pipeline mode, tasks share the
+process, so only the CPU time of the task thread is counted, not that of
+helper threads, e.g. parallel downloads. Peak memory is the high-water mark
+of the whole process, which is per task only in pool mode where each task
+runs in its own process. Otherwise it also includes earlier and concurrent
+tasks.
+"""
+
+import json
+import logging
+import resource
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Literal
+
+from processing import pipeline
+
+Phase = Literal[
+    "metadata",
+    "download",
+    "decompress",
+    "convert",
+    "compare",
+    "upload",
+    "plot",
+    "qc",
+]
+
+_state = threading.local()
+
+
+def _cpu_time() -> float:
+    return time.thread_time() if pipeline.is_enabled() else time.process_time()
+
+
+@dataclass
+class TaskRecord:
+    task: dict
+    status: str | None = None
+    phases: dict[str, float] = field(default_factory=dict)
+    bytes_downloaded: int = 0
+    bytes_uploaded: int = 0
+    _stack: list[str] = field(default_factory=list)
+    _start_time: float = field(default_factory=time.perf_counter)
+    _start_cpu_time: float = field(default_factory=_cpu_time)
+    _mark: float = field(default_factory=time.perf_counter)
+
+    @property
+    def current_phase(self) -> str | None:
+        return self._stack[-1] if self._stack else None
+
+    def enter(self, name: str) -> None:
+        self._charge()
+        self._stack.append(name)
+
+    def exit(self) -> None:
+        self._charge()
+        self._stack.pop()
+
+    def _charge(self) -> None:
+        now = time.perf_counter()
+        name = self._stack[-1] if self._stack else "other"
+        self.phases[name] = self.phases.get(name, 0) + now - self._mark
+        self._mark = now
+
+    def as_dict(self) -> dict:
+        self._charge()
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {
+            "task_id": self.task.get("id"),
+            "type": self.task.get("type"),
+            "site": self.task.get("siteId"),
+            "date": self.task.get("measurementDate"),
+            "product": self.task.get("productId"),
+            "instrument": self.task.get("instrumentInfoUuid"),
+            "model": self.task.get("modelId"),
+            "status": self.status,
+            "wall_time": round(time.perf_counter() - self._start_time, 3),
+            "cpu_time": round(_cpu_time() - self._start_cpu_time, 3),
+            "process_max_rss_mb": round(max_rss / 1024, 1),
+            "bytes_downloaded": self.bytes_downloaded,
+            "bytes_uploaded": self.bytes_uploaded,
+            "phases": {name: round(t, 3) for name, t in self.phases.items()},
+        }
+
+
+@contextmanager
+def task(task: dict) -> Iterator[TaskRecord]:
+    """Record timings of a task and log them when the task finishes."""
+    record = TaskRecord(task)
+    _state.record = record
+    try:
+        yield record
+    finally:
+        _state.record = None
+        logging.info("Task metrics: %s", json.dumps(record.as_dict()))
+
+
+@contextmanager
+def phase(name: Phase) -> Iterator[None]:
+    """Count the time spent in the block to the given phase.
+
+    Can also be used as a function decorator.
+    """
+    record = _current_record()
+    if record is None:
+        yield
+        return
+    record.enter(name)
+    try:
+        yield
+    finally:
+        record.exit()
+
+
+@contextmanager
+def request_phase() -> Iterator[None]:
+    """Count an HTTP request as metadata lookup unless it is part of a
+    download or upload."""
+    record = _current_record()
+    if record is not None and record.current_phase in ("download", "upload"):
+        yield
+        return
+    with phase("metadata"):
+        yield
+
+
+def add_downloaded(n_bytes: int) -> None:
+    if record := _current_record():
+        record.bytes_downloaded += n_bytes
+
+
+def add_uploaded(n_bytes: int) -> None:
+    if record := _current_record():
+        record.bytes_uploaded += n_bytes
+
+
+def _current_record() -> TaskRecord | None:
+    return getattr(_state, "record", None)
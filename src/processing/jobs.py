@@ -3,9 +3,9 @@ import uuid
 from pathlib import Path
 
 from cloudnet_api_client.containers import ProductMetadata
-from cloudnet_api_client.utils import sha256sum
 
 from processing import utils
+from processing.hashing import file_digests
 from processing.processor import ModelParams, Processor, ProcessParams
 
 __all__ = ["freeze", "hkd", "update_plots", "update_qc", "upload_to_dvas"]
@@ -79,7 +79,7 @@ def freeze(processor: Processor, params: ProcessParams, directory: Path) -> None
     file_info = processor.storage_api.upload_product(full_path, metadata.uuid, s3key)
     payload = {
         "uuid": file_uuid,
-        "checksum": sha256sum(full_path),
+        "checksum": file_digests(full_path).sha256_hex,
         "volatile": volatile,
         "pid": pid,
         "newBucket": True,
@@ -0,0 +1,186 @@
+"""Cache for site, product, instrument and model definitions."""
+
+import datetime
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterator
+from contextlib import closing, contextmanager
+from pathlib import Path
+from typing import Any, Callable, Literal, TypeVar
+from uuid import UUID
+
+import requests
+from cloudnet_api_client import APIClient
+from cloudnet_api_client.containers import (
+    ExtendedInstrument,
+    ExtendedProduct,
+    Model,
+    Site,
+)
+
+from processing.config import Config
+
+Kind = Literal["site", "product", "instrument", "model"]
+T = TypeVar("T")
+
+
+class MetadataCache:
+    """Thread-safe LRU cache with expiring entries.
+
+    Entries are optionally persisted to an SQLite file, so that restarted
+    workers and worker pool task processes start with a warm cache.
+    """
+
+    def __init__(
+        self,
+        ttl: datetime.timedelta | dict[Kind, datetime.timedelta],
+        max_size: int,
+        path: Path | None = None,
+    ) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self.path = path
+        self._entries: OrderedDict[tuple[str, str], tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        if self.path is not None:
+            self._init_db()
+
+    @classmethod
+    def from_config(cls, config: Config) -> "MetadataCache":
+        return cls(
+            ttl=config.metadata_cache_ttl,
+            max_size=config.metadata_cache_size,
+            path=config.metadata_cache_path,
+        )
+
+    def get(self, kind: Kind, key: str, fetch: Callable[[], T]) -> T:
+        """Return cached value or fetch and cache a new one."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get((kind, key))
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end((kind, key))
+                return entry[1]
+        if (entry := self._load(kind, key, now)) is None:
+            expires = now + self._ttl(kind).total_seconds()
+            entry = (expires, fetch())
+            self._save(kind, key, entry)
+        with self._lock:
+            self._entries[(kind, key)] = entry
+            self._entries.move_to_end((kind, key))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return entry[1]
+
+    def invalidate(self, kind: Kind | None = None, key: str | None = None) -> None:
+        """Remove entries of the given kind and key, or all entries by default."""
+
+        def matches(entry_kind: str, entry_key: str) -> bool:
+            return (kind is None or kind == entry_kind) and (
+                key is None or key == entry_key
+            )
+
+        with self._lock:
+            for entry_kind, entry_key in list(self._entries):
+                if matches(entry_kind, entry_key):
+                    del self._entries[(entry_kind, entry_key)]
+        if self.path is None:
+            return
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "DELETE FROM cache WHERE (? IS NULL OR kind = ?)"
+                    " AND (? IS NULL OR key = ?)",
+                    (kind, kind, key, key),
+                )
+        except sqlite3.Error as err:
+            logging.warning("Failed to invalidate metadata cache: %s", err)
+
+    def _ttl(self, kind: Kind) -> datetime.timedelta:
+        if isinstance(self.ttl, dict):
+            return self.ttl[kind]
+        return self.ttl
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # New connection per operation, so the cache can be used from several
+        # threads and processes. The connection context only commits, so the
+        # connection is closed separately.
+        assert self.path is not None
+        with closing(sqlite3.connect(self.path, timeout=10)) as conn, conn:
+            yield conn
+
+    def _init_db(self) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "kind TEXT, key TEXT, expires REAL, value BLOB,"
+                " PRIMARY KEY (kind, key))"
+            )
+            conn.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+
+    def _load(self, kind: Kind, key: str, now: float) -> tuple[float, Any] | None:
+        if self.path is None:
+            return None
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT expires, value FROM cache"
+                    " WHERE kind = ? AND key = ? AND expires > ?",
+                    (kind, key, now),
+                ).fetchone()
+            if row is None:
+                return None
+            return row[0], pickle.loads(row[1])
+        except (sqlite3.Error, pickle.UnpicklingError, AttributeError) as err:
+            logging.warning("Failed to read metadata cache: %s", err)
+            return None
+
+    def _save(self, kind: Kind, key: str, entry: tuple[float, Any]) -> None:
+        if self.path is None:
+            return
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                    (kind, key, entry[0], pickle.dumps(entry[1])),
+                )
+        except sqlite3.Error as err:
+            logging.warning("Failed to write metadata cache: %s", err)
+
+
+class CachedAPIClient(APIClient):
+    """API client that caches site, product, instrument and model definitions."""
+
+    def __init__(
+        self,
+        base_url: str,
+        session: requests.Session | None = None,
+        cache: MetadataCache | None = None,
+    ) -> None:
+        super().__init__(base_url, session)
+        self.cache = cache or MetadataCache(datetime.timedelta(hours=1), 1000)
+
+    def site(self, site_id: str) -> Site:
+        fetch = super().site
+        return self.cache.get("site", site_id, lambda: fetch(site_id))
+
+    def product(self, product_id: str) -> ExtendedProduct:
+        fetch = super().product
+        return self.cache.get("product", product_id, lambda: fetch(product_id))
+
+    def instrument(self, uuid: str | UUID) -> ExtendedInstrument:
+        fetch = super().instrument
+        return self.cache.get("instrument", str(uuid), lambda: fetch(uuid))
+
+    def model(self, model_id: str) -> Model:
+        fetch = super().model
+        return self.cache.get("model", model_id, lambda: fetch(model_id))
+
+    def invalidate(self, kind: Kind | None = None, key: str | None = None) -> None:
+        """Remove cached definitions, all of them by default."""
+        self.cache.invalidate(kind, key)
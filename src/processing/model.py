@@ -3,27 +3,18 @@ import logging
 import math
 import uuid
 from pathlib import Path
-from typing import Iterator
+from typing import TYPE_CHECKING, Callable, Iterator
 
 import netCDF4
-from model_munger.merge import merge_models
-from model_munger.model import Location, Model
-from model_munger.readers import (
-    read_arome,
-    read_arome_arctic,
-    read_arpege,
-    read_ecmwf_open,
-    read_gdas1,
-    read_icon_d2,
-)
-from model_munger.readers.icon_d2 import StationMissingError
-
-from processing import utils
-from processing.harmonizer.model import harmonize_model_file
+
+from processing import instrumentation, utils
 from processing.netcdf_comparer import NCDiff, nc_difference
 from processing.processor import ModelParams, Processor
 from processing.utils import MiscError, SkipTaskError
 
+if TYPE_CHECKING:
+    from model_munger.model import Location, Model
+
 CLOUDNET_TO_ICON_D2 = {
     "lindenberg": "Lindenberg_Obs",
     "falkenberg": "Falkenberg",
@@ -39,21 +30,35 @@ CLOUDNET_TO_ICON_D2 = {
 }
 
 
-def _process_icon_d2(path: Path, location: Location) -> Model:
+def _process_icon_d2(path: Path, location: "Location") -> "Model":
+    from model_munger.readers import read_icon_d2
+    from model_munger.readers.icon_d2 import StationMissingError
+
     try:
         return read_icon_d2(path, CLOUDNET_TO_ICON_D2[location.id], location)
     except StationMissingError as err:
         raise SkipTaskError(str(err))
 
 
+def _get_model_reader(source_model_id: str) -> Callable[[Path, "Location"], "Model"]:
+    from model_munger.readers import (
+        read_arome,
+        read_arpege,
+        read_ecmwf_open,
+        read_gdas1,
+    )
+
+    model_readers: dict[str, Callable[[Path, "Location"], "Model"]] = {
+        "arpege": read_arpege,
+        "arome": read_arome,
+        "ecmwf-open": read_ecmwf_open,
+        "gdas1": read_gdas1,
+        "icon-d2": _process_icon_d2,
+    }
+    return model_readers[source_model_id]
+
+
 SKIP_MODELS = ()
-MODEL_READERS = {
-    "arpege": read_arpege,
-    "arome": read_arome,
-    "ecmwf-open": read_ecmwf_open,
-    "gdas1": read_gdas1,
-    "icon-d2": _process_icon_d2,
-}
 
 
 def process_model(processor: Processor, params: ModelParams, directory: Path) -> None:
@@ -111,19 +116,23 @@ def process_model(processor: Processor, params: ModelParams, directory: Path) ->
         s3key = None
 
     try:
-        tmp_path = _process_model(params, full_paths, directory / "temp.nc")
-        new_file = directory / "output.nc"
-        _harmonize_model(params, tmp_path, new_file, product_uuid)
+        with instrumentation.phase("convert"):
+            tmp_path = _process_model(params, full_paths, directory / "temp.nc")
+            new_file = directory / "output.nc"
+            _harmonize_model(params, tmp_path, new_file, product_uuid)
 
         if not existing_meta or not existing_meta.pid:
             volatile_pid = None
         else:
             volatile_pid = existing_meta.pid
-        processor.pid_utils.add_pid_to_file(new_file, pid=volatile_pid)
+        with utils.FileFinalizer(new_file, summarize=True) as finalizer:
+            processor.pid_utils.add_pid(finalizer, pid=volatile_pid)
 
         upload = True
         if existing_meta and existing_file:
-            difference = nc_difference(existing_file, new_file)
+            difference = nc_difference(
+                existing_file, new_file, utils.available_cpus(processor.md_api.config)
+            )
             if difference == NCDiff.NONE:
                 upload = False
                 new_file = existing_file
@@ -137,6 +146,7 @@ def process_model(processor: Processor, params: ModelParams, directory: Path) ->
                 patch=True,
                 uuid=product_uuid,
                 s3key=s3key,
+                summary=finalizer.summary,
             )
         else:
             logging.info("Skipping PUT to data portal, file has not changed")
@@ -144,7 +154,13 @@ def process_model(processor: Processor, params: ModelParams, directory: Path) ->
             logging.info("Skipping plotting for hidden site")
         else:
             processor.create_and_upload_images(
-                new_file, "model", params.site.id, product_uuid, filename, directory
+                new_file,
+                "model",
+                params.site.id,
+                product_uuid,
+                filename,
+                directory,
+                variables=finalizer.variables,
             )
         qc_result = processor.upload_quality_report(new_file, product_uuid, params.site)
         _print_info(product_uuid, qc_result)
@@ -169,6 +185,9 @@ def _generate_filename(params: ModelParams) -> str:
 def _process_model(
     params: ModelParams, input_paths: list[Path], output_path: Path
 ) -> Path:
+    from model_munger.merge import merge_models
+    from model_munger.model import Location
+
     # Skip processing of legacy gdas1 files.
     if params.model.id == "gdas1":
         date_str = params.date.strftime("%Y%m%d")
@@ -209,9 +228,11 @@ def _process_model(
 
 
 def _read_files(
-    input_paths: list[Path], source_model_id: str, location: Location
-) -> Iterator[Model]:
+    input_paths: list[Path], source_model_id: str, location: "Location"
+) -> Iterator["Model"]:
     if source_model_id == "arome-arctic":
+        from model_munger.readers import read_arome_arctic
+
         grouped: dict[str, list[Path | None]] = {}
         for path in input_paths:
             i = path.name.rfind("_")
@@ -228,7 +249,7 @@ def _read_files(
                 continue
             yield read_arome_arctic(sfc_path, ml_path, location)
     else:
-        reader = MODEL_READERS[source_model_id]
+        reader = _get_model_reader(source_model_id)
         for path in input_paths:
             yield reader(path, location)
 
@@ -236,6 +257,8 @@ def _read_files(
 def _harmonize_model(
     params: ModelParams, input_path: Path, output_path: Path, uuid: uuid.UUID
 ) -> None:
+    from processing.harmonizer.model import harmonize_model_file
+
     data = {
         "site_name": params.site.id,
         "date": params.date.isoformat(),
@@ -1,4 +1,8 @@
 import logging
+import math
+import threading
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from pathlib import Path
 from typing import Tuple, cast
@@ -8,6 +12,21 @@ import numpy as np
 import numpy.ma as ma
 import numpy.typing as npt
 
+from processing import instrumentation
+from processing.hashing import DIGESTS_ATTRIBUTE, read_variable_digests
+
+MAJOR_MAPE = 5
+MINOR_MAPE = 0.1
+MAJOR_MASK_MATCH = 99.9
+MINOR_MASK_MATCH = 99.9999
+# Approximate size of compared hyperslabs in bytes.
+CHUNK_MEMORY = 64 * 1024 * 1024
+MAX_COMPARE_WORKERS = 8
+
+# The netCDF and HDF5 libraries are not thread-safe, so only one thread may
+# access the files at a time. Other threads compare data in the meantime.
+_NC_LOCK = threading.Lock()
+
 
 class NCDiff(Enum):
     MAJOR = "major"  # new version
@@ -28,10 +47,12 @@ class NetCDFComparator:
             "folding_flag",
             "nyquist_velocity",
         ),
+        n_workers: int = 1,
     ) -> None:
         self.old_file = old_file
         self.new_file = new_file
         self.ignore_vars = ignore_vars
+        self.n_workers = n_workers
 
     def compare(self) -> NCDiff:
         with (
@@ -108,10 +129,16 @@ class NetCDFComparator:
 
     @staticmethod
     def _skip_compare_global_attribute(name: str) -> bool:
-        return name in ("history", "file_uuid", "pid") or name.endswith("_version")
+        return name in (
+            "history",
+            "file_uuid",
+            "pid",
+            "input_fingerprint",
+            DIGESTS_ATTRIBUTE,
+        ) or name.endswith("_version")
 
     def _check_old_global_attributes_exist(self) -> bool:
-        old_attrs = set(self.old.ncattrs())
+        old_attrs = set(self.old.ncattrs()) - {"input_fingerprint", DIGESTS_ATTRIBUTE}
         new_attrs = set(self.new.ncattrs())
         missing_attrs = old_attrs - new_attrs
         if missing_attrs:
@@ -121,7 +148,7 @@ class NetCDFComparator:
 
     def _check_for_new_global_attributes(self) -> bool:
         old_attrs = set(self.old.ncattrs())
-        new_attrs = set(self.new.ncattrs())
+        new_attrs = set(self.new.ncattrs()) - {"input_fingerprint", DIGESTS_ATTRIBUTE}
         new_attrs_found = new_attrs - old_attrs
         if new_attrs_found:
             logging.info(f"New global attributes in new file: {new_attrs_found}")
@@ -147,10 +174,42 @@ class NetCDFComparator:
         return True
 
     def _compare_variable_data(self) -> NCDiff:
-        for var in self.old.variables:
-            if var in self.ignore_vars:
-                continue
+        """Compare variables concurrently, returning the result of the first
+        variable, in file order, that has differences. Variables with the same
+        digest in both files are identical and not compared."""
+        old_digests = read_variable_digests(self.old)
+        new_digests = read_variable_digests(self.new)
+        names = [
+            var
+            for var in self.old.variables
+            if var not in self.ignore_vars
+            and (var not in old_digests or old_digests[var] != new_digests.get(var))
+        ]
+        n_workers = min(MAX_COMPARE_WORKERS, self.n_workers, len(names))
+        stop = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=max(1, n_workers))
+        try:
+            futures = [
+                executor.submit(self._compare_variable, var, stop) for var in names
+            ]
+            for future in futures:
+                var_diff, messages = future.result()
+                for message in messages:
+                    logging.info(message)
+                if var_diff != NCDiff.NONE:
+                    return var_diff
+        finally:
+            stop.set()
+            executor.shutdown(cancel_futures=True)
+        return NCDiff.NONE
 
+    def _compare_variable(
+        self, var: str, stop: threading.Event
+    ) -> tuple[NCDiff, list[str]]:
+        """Compare data of one variable. Messages are returned instead of
+        logged, so that they can be logged in the order of the variables."""
+        log: list[str] = []
+        with _NC_LOCK:
             old_var = self.old.variables[var]
             new_var = self.new.variables[var]
 
@@ -158,92 +217,102 @@ class NetCDFComparator:
                 old_var.dimensions == new_var.dimensions
                 and old_var.shape != new_var.shape
             ):
-                logging.info(
+                log.append(
                     f"Variable '{var}' shapes differ: {old_var.shape} vs {new_var.shape}"
                 )
-                return NCDiff.MAJOR
+                return NCDiff.MAJOR, log
 
             smaller_var, larger_var = sorted(
                 [old_var, new_var], key=lambda variable: len(variable.shape)
             )
+            smaller_dims = smaller_var.dimensions
+            larger_dims = larger_var.dimensions
+            shapes = (smaller_var.shape, larger_var.shape)
 
             # For now, only broadcasting scalar to array (of any shape) is
             # supported. More complex cases (e.g. 1d to 2d array) could be
             # handled in the future.
-            if (
-                len(smaller_var.dimensions) != 0
-                and smaller_var.dimensions != larger_var.dimensions
-            ):
-                logging.info(
+            if len(smaller_dims) != 0 and smaller_dims != larger_dims:
+                log.append(
                     f"Variable '{var}' has incompatible dimensions: {old_var.dimensions} vs {new_var.dimensions}"
                 )
-                return NCDiff.MAJOR
-
-            try:
-                orig_data = ma.getdata(smaller_var[:])
-                orig_mask = ma.getmaskarray(smaller_var[:])
-                broad_data = np.broadcast_to(orig_data, larger_var.shape)
-                broad_mask = np.broadcast_to(orig_mask, larger_var.shape)
-                data_smaller = ma.array(broad_data, mask=broad_mask)
-                data_larger = larger_var[:]
-            except ValueError:
-                logging.info(
-                    f"Cannot broadcast variable '{var}' from {smaller_var.shape} to {larger_var.shape}"
-                )
-                return NCDiff.MAJOR
+                return NCDiff.MAJOR, log
 
-            mask_diff = self._compare_variable_masks(var, data_smaller, data_larger)
-            if mask_diff != NCDiff.NONE:
-                return mask_diff
+        try:
+            var_diff = self._compare_variable_chunks(
+                var, smaller_var, larger_var, log, stop
+            )
+        except ValueError:
+            log.append(
+                f"Cannot broadcast variable '{var}' from {shapes[0]} to {shapes[1]}"
+            )
+            return NCDiff.MAJOR, log
+        if var_diff != NCDiff.NONE:
+            return var_diff, log
 
-            var_diff = self._compare_variable_values(var, data_smaller, data_larger)
-            if var_diff != NCDiff.NONE:
-                return var_diff
+        # If dimensions don't match and there are no major differences,
+        # consider this always as a minor difference.
+        if smaller_dims != larger_dims:
+            return NCDiff.MINOR, log
 
-            # If dimensions don't match and there are no major differences,
-            # consider this always as a minor difference.
-            if smaller_var.dimensions != larger_var.dimensions:
-                return NCDiff.MINOR
+        return NCDiff.NONE, log
 
-        return NCDiff.NONE
+    def _compare_variable_chunks(
+        self,
+        var: str,
+        smaller_var: netCDF4.Variable,
+        larger_var: netCDF4.Variable,
+        log: list[str],
+        stop: threading.Event,
+    ) -> NCDiff:
+        """Compare variable in chunks along the first dimension.
+
+        Differing masks decide the result before values, so values are not
+        compared once the masks are known to differ, and comparison stops
+        early if the masks are already known to differ majorly. Values are
+        also not compared once they are known to differ majorly, but masks
+        are still compared, because a mask difference could override that.
+        """
+        with _NC_LOCK:
+            stats = _DiffStats(size=larger_var.size)
+        for data_smaller, data_larger in _iter_chunks(smaller_var, larger_var):
+            if stop.is_set():
+                return NCDiff.NONE
+            needs_values = stats.best_mape() < MAJOR_MAPE
+            stats.add_masks(data_smaller, data_larger)
+            if stats.best_mask_match() <= MAJOR_MASK_MATCH:
+                break
+            if needs_values and stats.best_mask_match() > MINOR_MASK_MATCH:
+                stats.add_values(data_smaller, data_larger)
+        mask_diff = self._compare_variable_masks(var, stats, log)
+        if mask_diff != NCDiff.NONE:
+            return mask_diff
+        return self._compare_variable_values(var, stats, log)
 
     def _compare_variable_values(
-        self, var: str, val_old: npt.NDArray, val_new: npt.NDArray
+        self, var: str, stats: "_DiffStats", log: list[str]
     ) -> NCDiff:
-        val_old = ma.masked_invalid(val_old)
-        val_new = ma.masked_invalid(val_new)
-
-        epsilon = 1e-12
-        val_old_nonzero = ma.where(ma.abs(val_old) < epsilon, epsilon, val_old)
-        percentage_error = ma.abs(val_new - val_old) / ma.abs(val_old_nonzero) * 100.0
-        percentage_error = ma.masked_invalid(percentage_error)
-        mape = ma.mean(percentage_error)
-
-        major_threshold = 5
-        minor_threshold = 0.1
-
-        if mape >= major_threshold:
-            logging.info(f"Variable '{var}' has major differences (MAPE={mape:g})")
+        mape = stats.best_mape()
+        if mape >= MAJOR_MAPE:
+            log.append(f"Variable '{var}' has major differences (MAPE={mape:g})")
             return NCDiff.MAJOR
-        elif mape >= minor_threshold:
-            logging.info(f"Variable '{var}' has minor differences (MAPE={mape:g})")
+        elif mape >= MINOR_MAPE:
+            log.append(f"Variable '{var}' has minor differences (MAPE={mape:g})")
             return NCDiff.MINOR
 
         return NCDiff.NONE
 
     def _compare_variable_masks(
-        self, var: str, val_old: npt.NDArray, val_new: npt.NDArray
+        self, var: str, stats: "_DiffStats", log: list[str]
     ) -> NCDiff:
-        mask_old = ma.getmaskarray(val_old)
-        mask_new = ma.getmaskarray(val_new)
-        same_percentage = 100 * np.count_nonzero(mask_old == mask_new) / mask_old.size
-        if same_percentage <= 99.9:
-            logging.info(
+        same_percentage = stats.best_mask_match()
+        if same_percentage <= MAJOR_MASK_MATCH:
+            log.append(
                 f"Variable '{var}' masks have major differences (matches {same_percentage:.2f} %)"
             )
             return NCDiff.MAJOR
-        if same_percentage <= 99.9999:
-            logging.info(
+        if same_percentage <= MINOR_MASK_MATCH:
+            log.append(
                 f"Variable '{var}' masks have minor differences (matches {same_percentage:.2f} %)"
             )
             return NCDiff.MINOR
@@ -324,6 +393,88 @@ class NetCDFComparator:
         return True
 
 
-def nc_difference(old_file: Path, new_file: Path) -> NCDiff:
-    comparator = NetCDFComparator(old_file, new_file)
+class _DiffStats:
+    """Running statistics of differences between two arrays.
+
+    Until all `size` elements have been added, the statistics are computed
+    for the best case where the remaining elements are identical. Thus, they
+    are bounds that can only get worse as more elements are added.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.n_added = 0
+        self.n_same_mask = 0
+        self.error_sum = 0.0
+        self.error_count = 0
+
+    def add_masks(self, val_old: npt.NDArray, val_new: npt.NDArray) -> None:
+        mask_old = ma.getmaskarray(val_old)
+        mask_new = ma.getmaskarray(val_new)
+        self.n_same_mask += int(np.count_nonzero(mask_old == mask_new))
+        self.n_added += mask_old.size
+
+    def add_values(self, val_old: npt.NDArray, val_new: npt.NDArray) -> None:
+        val_old = ma.masked_invalid(val_old)
+        val_new = ma.masked_invalid(val_new)
+        epsilon = 1e-12
+        val_old_nonzero = ma.where(ma.abs(val_old) < epsilon, epsilon, val_old)
+        percentage_error = ma.abs(val_new - val_old) / ma.abs(val_old_nonzero) * 100.0
+        percentage_error = ma.masked_invalid(percentage_error)
+        if count := percentage_error.count():
+            self.error_sum += float(percentage_error.sum(dtype=np.float64))
+            self.error_count += count
+
+    def best_mask_match(self) -> float:
+        """Largest possible percentage of matching mask values."""
+        if self.size == 0:
+            return 100.0
+        n_remaining = self.size - self.n_added
+        return 100 * (self.n_same_mask + n_remaining) / self.size
+
+    def best_mape(self) -> float:
+        """Smallest possible mean absolute percentage error."""
+        n_remaining = self.size - self.n_added
+        if self.error_count + n_remaining == 0:
+            return 0.0
+        return self.error_sum / (self.error_count + n_remaining)
+
+
+def _iter_chunks(
+    smaller_var: netCDF4.Variable, larger_var: netCDF4.Variable
+) -> Iterator[tuple[ma.MaskedArray, ma.MaskedArray]]:
+    """Yield hyperslabs of variables along the first dimension of
+    `larger_var`, broadcasting scalar `smaller_var` to their shape."""
+    with _NC_LOCK:
+        is_scalar = len(smaller_var.dimensions) == 0
+        if is_scalar:
+            scalar = smaller_var[:]
+        if larger_var.ndim == 0:
+            slices = [slice(None)]
+        else:
+            n_rows = larger_var.shape[0]
+            step = _rows_per_chunk(larger_var)
+            slices = [slice(start, start + step) for start in range(0, n_rows, step)]
+    for ind in slices:
+        with _NC_LOCK:
+            data_larger = larger_var[ind]
+            data = scalar if is_scalar else smaller_var[ind]
+        broad_data = np.broadcast_to(ma.getdata(data), data_larger.shape)
+        broad_mask = np.broadcast_to(ma.getmaskarray(data), data_larger.shape)
+        yield ma.array(broad_data, mask=broad_mask), data_larger
+
+
+def _rows_per_chunk(var: netCDF4.Variable) -> int:
+    row_size = np.dtype(var.dtype).itemsize * math.prod(var.shape[1:])
+    n_rows = max(1, CHUNK_MEMORY // max(row_size, 1))
+    chunking = var.chunking()
+    if isinstance(chunking, list) and chunking:
+        n_rows = max(chunking[0], n_rows // chunking[0] * chunking[0])
+    return n_rows
+
+
+@instrumentation.phase("compare")
+def nc_difference(old_file: Path, new_file: Path, n_workers: int = 1) -> NCDiff:
+    """Compare two netCDF files using up to `n_workers` threads."""
+    comparator = NetCDFComparator(old_file, new_file, n_workers=n_workers)
     return comparator.compare()
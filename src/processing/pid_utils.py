@@ -3,12 +3,11 @@ import random
 import string
 from pathlib import Path
 
-import netCDF4
 import requests
 from requests import HTTPError
 
 from processing.config import Config
-from processing.utils import MiscError
+from processing.utils import FileFinalizer, MiscError
 
 from .utils import build_file_landing_page_url, make_session
 
@@ -25,19 +24,24 @@ class PidUtils:
         self, filepath: Path, pid: str | None = None
     ) -> tuple[str, str | None, str]:
         """Queries PID service and adds the PID to NC file metadata."""
-        with netCDF4.Dataset(filepath, "r+") as rootgrp:
-            uuid = getattr(rootgrp, "file_uuid")
-            url = build_file_landing_page_url(uuid)
-            pid_to_file: str | None
-            if pid:
-                pid_to_file = pid
-            elif self._is_production:
-                pid_to_file = self._request_pid(uuid, url)
-            else:
-                pid_to_file = f"https://www.example.pid/{_random_string(5)}"
-            if pid_to_file is not None:
-                rootgrp.pid = pid_to_file
+        with FileFinalizer(filepath) as finalizer:
+            return self.add_pid(finalizer, pid)
 
+    def add_pid(
+        self, finalizer: FileFinalizer, pid: str | None = None
+    ) -> tuple[str, str | None, str]:
+        """Queries PID service and adds the PID to file being finalized."""
+        uuid = finalizer.get("file_uuid")
+        url = build_file_landing_page_url(uuid)
+        pid_to_file: str | None
+        if pid:
+            pid_to_file = pid
+        elif self._is_production:
+            pid_to_file = self._request_pid(uuid, url)
+        else:
+            pid_to_file = f"https://www.example.pid/{_random_string(5)}"
+        if pid_to_file is not None:
+            finalizer.set("pid", pid_to_file)
         return uuid, pid_to_file, url
 
     def _request_pid(self, uuid: str, url: str) -> str | None:
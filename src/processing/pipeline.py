@@ -0,0 +1,59 @@
+"""Compute slot shared by tasks that run concurrently in one process.
+
+In pipeline mode, the worker runs a few tasks in separate threads but only one
+of them may compute at a time. Network phases (metadata requests, downloads
+and uploads) give the slot away, so that e.g. the raw data download of one
+task overlaps the conversion of another. Outside pipeline mode, all functions
+in this module are no-ops.
+"""
+
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+_slot: "threading.Lock | None" = None
+_state = threading.local()
+
+
+def enable() -> None:
+    """Enable the compute slot for this process."""
+    global _slot
+    _slot = threading.Lock()
+
+
+def is_enabled() -> bool:
+    return _slot is not None
+
+
+@contextmanager
+def compute_phase() -> Iterator[None]:
+    """Hold the compute slot while running the block."""
+    if _slot is None or _is_holding():
+        yield
+        return
+    _slot.acquire()
+    _state.holding = True
+    try:
+        yield
+    finally:
+        _state.holding = False
+        _slot.release()
+
+
+@contextmanager
+def io_phase() -> Iterator[None]:
+    """Give the compute slot to other tasks while running the block."""
+    if _slot is None or not _is_holding():
+        yield
+        return
+    _state.holding = False
+    _slot.release()
+    try:
+        yield
+    finally:
+        _slot.acquire()
+        _state.holding = True
+
+
+def _is_holding() -> bool:
+    return getattr(_state, "holding", False)
@@ -1,34 +1,43 @@
+import concurrent.futures
 import datetime
 import logging
+import re
+from collections import defaultdict
 from dataclasses import asdict, dataclass
 from pathlib import Path
+from typing import TYPE_CHECKING, Collection, Iterable
 from uuid import UUID
 
 import numpy as np
 import numpy.typing as npt
-from cloudnet_api_client import APIClient
+from cloudnet_api_client import APIClient, CloudnetAPIError
 from cloudnet_api_client.containers import (
     ProductMetadata,
     RawMetadata,
     RawModelMetadata,
 )
 from cloudnetpy.exceptions import PlottingError
-from cloudnetpy.model_evaluation.plotting.plotting import generate_L3_day_plots
-from cloudnetpy.plotting import Dimensions, PlotParameters, generate_figure
-from cloudnetpy_qc import quality
-from cloudnetpy_qc.quality import ErrorLevel
 from requests.exceptions import HTTPError
 
-import housekeeping
-from processing import utils
+from processing import instrumentation, pipeline, utils
 from processing.dvas import DvasV3
 from processing.metadata_api import MetadataApi
 from processing.pid_utils import PidUtils
 from processing.storage_api import StorageApi
 
+if TYPE_CHECKING:
+    from cloudnetpy.plotting import Dimensions
+
 MIN_MODEL_FILESIZE = 20200
 TIMEDELTA_ZERO = datetime.timedelta(0)
 
+# Timestamps in filenames are not exact, e.g. they may be rounded or tell when
+# the file was created instead of the first measurement.
+FILENAME_TIME_MARGIN = datetime.timedelta(hours=1)
+FILENAME_TIME_PATTERN = re.compile(
+    r"(?<!\d)(?P<date>\d{8}|\d{6})[_T-]?(?P<time>\d{4}(?:\d{2})?)(?!\d)"
+)
+
 
 from cloudnet_api_client.containers import (
     ExtendedProduct,
@@ -67,6 +76,48 @@ class ProductParams(ProcessParams):
     instrument: Instrument | None
 
 
+class CalibrationProvider:
+    """Calibration of an instrument, fetched only once per date."""
+
+    def __init__(
+        self, client: APIClient, instrument_pid: str, date: datetime.date
+    ) -> None:
+        self.client = client
+        self.instrument_pid = instrument_pid
+        self.date = date
+        self._records: dict[datetime.date, dict | CloudnetAPIError] = {}
+
+    def get(self, date: datetime.date | None = None) -> dict:
+        """Return calibration for the given date, by default for the processed
+        date. Raises CloudnetAPIError if the instrument has no calibration."""
+        date = date or self.date
+        if date not in self._records:
+            self._records[date] = self._fetch(date)
+        record = self._records[date]
+        if isinstance(record, CloudnetAPIError):
+            raise record
+        return record
+
+    def prefetch(self, dates: Iterable[datetime.date]) -> None:
+        """Fetch calibration for several dates concurrently."""
+        missing = [date for date in set(dates) if date not in self._records]
+        if not missing:
+            return
+        with (
+            instrumentation.phase("metadata"),
+            concurrent.futures.ThreadPoolExecutor(len(missing)) as executor,
+            pipeline.io_phase(),
+        ):
+            records = executor.map(self._fetch, missing)
+            self._records.update(zip(missing, records))
+
+    def _fetch(self, date: datetime.date) -> dict | CloudnetAPIError:
+        try:
+            return self.client.calibration(self.instrument_pid, date)
+        except CloudnetAPIError as err:
+            return err
+
+
 class Processor:
     def __init__(
         self,
@@ -247,8 +298,16 @@ class Processor:
         filename_prefix: set[str] | str | None = None,
         filename_suffix: set[str] | str | None = None,
         time_offset: datetime.timedelta | None = None,
+        decompress: bool = False,
+        time_window: tuple[datetime.datetime, datetime.datetime] | None = None,
     ) -> tuple[list[Path], list[UUID]]:
-        """Download raw files matching the given parameters."""
+        """Download raw files matching the given parameters.
+
+        With `decompress`, gzipped files are decompressed while downloading.
+        With `time_window`, files whose filename timestamps show that they
+        cannot contain data from the window, given in the time of the
+        filenames, are skipped before downloading.
+        """
         if isinstance(date, datetime.date):
             start_date = date
             end_date = date
@@ -258,6 +317,8 @@ class Processor:
         if time_offset is not None:
             if largest_only:
                 raise ValueError("Cannot use both time_offset and largest_only")
+            if time_window is not None:
+                raise ValueError("Cannot use both time_offset and time_window")
             if abs(time_offset / datetime.timedelta(hours=1)) >= 24:
                 raise ValueError("time_offset must be less than 24 hours")
             if time_offset < TIMEDELTA_ZERO:
@@ -291,6 +352,21 @@ class Processor:
                 upload_metadata, exclude_tag_subset=exclude_tag_subset
             )
 
+        if time_offset is not None:
+            upload_metadata = _remove_files_outside_window(
+                upload_metadata,
+                datetime.datetime.combine(start_date, datetime.time()) + time_offset,
+                datetime.datetime.combine(
+                    end_date + datetime.timedelta(days=1), datetime.time()
+                )
+                + time_offset,
+                keep_dates=(start_date, end_date),
+            )
+        elif time_window is not None:
+            upload_metadata = _remove_files_outside_window(
+                upload_metadata, *time_window
+            )
+
         if not upload_metadata:
             if allow_empty:
                 return [], []
@@ -300,7 +376,7 @@ class Processor:
             upload_metadata = [max(upload_metadata, key=lambda item: item.size)]
 
         full_paths, uuids = self.storage_api.download_raw_data(
-            upload_metadata, directory
+            upload_metadata, directory, decompress=decompress
         )
 
         if time_offset is not None:
@@ -311,6 +387,7 @@ class Processor:
             ]
         return full_paths, uuids
 
+    @instrumentation.phase("upload")
     def upload_file(
         self,
         params: ProcessParams,
@@ -320,6 +397,7 @@ class Processor:
         patch: bool,
         uuid: UUID,
         s3key: str | None,
+        summary: dict | None = None,
     ) -> None:
         file_info = self.storage_api.upload_product(full_path, uuid, s3key or filename)
         payload = utils.create_product_put_payload(
@@ -329,6 +407,7 @@ class Processor:
             volatile,
             patch,
             s3key,
+            summary,
         )
         if isinstance(params, ModelParams):
             payload["model"] = params.model.id
@@ -344,6 +423,7 @@ class Processor:
             payload = {"uuid": str(raw_uuid), "status": status}
             self.md_api.post("upload-metadata", payload)
 
+    @instrumentation.phase("plot")
     def create_and_upload_images(
         self,
         filepath: Path,
@@ -353,7 +433,17 @@ class Processor:
         s3key: str,
         directory: Path,
         legacy: bool = False,
+        variables: Collection[str] | None = None,
     ) -> None:
+        """Plot and upload images of a product.
+
+        If `variables` of the file are given, e.g. from `FileFinalizer`,
+        fields missing from the file are skipped without opening it. Plotted
+        fields still open the file, because cloudnetpy's plotting only
+        accepts a file name.
+        """
+        from cloudnetpy.plotting import PlotParameters, generate_figure
+
         img_path = directory / "plot.png"
         visualizations = []
         s3key = f"legacy/{s3key}" if legacy is True else s3key
@@ -362,6 +452,8 @@ class Processor:
         except NotImplementedError:
             logging.warning(f"Plotting for {product_id} not implemented")
             return
+        if variables is not None:
+            fields = [field for field in fields if field in variables]
         options = PlotParameters()
         options.max_y = max_alt
         options.title = False
@@ -413,6 +505,7 @@ class Processor:
                 max_alt = 16 if is_tropical else 12
         return variable_ids, max_alt
 
+    @instrumentation.phase("plot")
     def create_and_upload_l3_images(
         self,
         filepath: Path,
@@ -421,6 +514,10 @@ class Processor:
         s3key: str,
         directory: Path,
     ) -> None:
+        from cloudnetpy.model_evaluation.plotting.plotting import (
+            generate_L3_day_plots,
+        )
+
         img_path = directory / "plot.png"
         visualizations = []
         fields = _get_fields_for_l3_plot(product_id)
@@ -482,7 +579,7 @@ class Processor:
         uuid: UUID,
         product_id: str,
         field: str,
-        dimensions: Dimensions,
+        dimensions: "Dimensions",
     ) -> dict:
         img_s3key = s3key.replace(".nc", f"-{uuid.hex[:8]}-{field}.png")
         self.storage_api.upload_image(full_path=img_path, s3key=img_s3key)
@@ -494,6 +591,7 @@ class Processor:
             else None,
         }
 
+    @instrumentation.phase("qc")
     def upload_quality_report(
         self,
         filepath: Path,
@@ -501,6 +599,11 @@ class Processor:
         site: Site | ExtendedSite,
         product_id: str | None = None,
     ) -> str:
+        # cloudnetpy_qc only accepts a file name, so the file is opened again
+        # here instead of sharing the handle of FileFinalizer.
+        from cloudnetpy_qc import quality
+        from cloudnetpy_qc.quality import ErrorLevel
+
         try:
             site_meta: quality.SiteMeta = {
                 "time": site.raw_time if isinstance(site, ExtendedSite) else None,
@@ -551,6 +654,8 @@ class Processor:
         return result
 
     def process_housekeeping(self, params: InstrumentParams) -> None:
+        import housekeeping
+
         if params.date < utils.utctoday() - self.md_api.config.housekeeping_retention:
             logging.info("Skipping housekeeping for old data")
             return
@@ -618,7 +723,7 @@ def _get_fields_for_l3_plot(product: str) -> list:
             raise NotImplementedError(f"Unknown product: {unknown_product}")
 
 
-def _dimensions2dict(dimensions: Dimensions) -> dict:
+def _dimensions2dict(dimensions: "Dimensions") -> dict:
     return {
         "width": dimensions.width,
         "height": dimensions.height,
@@ -627,3 +732,62 @@ def _dimensions2dict(dimensions: Dimensions) -> dict:
         "marginBottom": dimensions.margin_bottom,
         "marginRight": dimensions.margin_right,
     }
+
+
+def _remove_files_outside_window(
+    metadata: list[RawMetadata],
+    window_start: datetime.datetime,
+    window_end: datetime.datetime,
+    keep_dates: tuple[datetime.date, datetime.date] | None = None,
+) -> list[RawMetadata]:
+    """Remove files that cannot contain data from the given time window.
+
+    Measurement start times are parsed from filenames and compared with the
+    window in the same time. Files are assumed to contain data until the
+    next file in the same series starts. Files without a timestamp in their
+    filename and files measured between `keep_dates` are kept, and have to
+    be checked after downloading.
+    """
+    series: dict[str, list[tuple[datetime.datetime, RawMetadata]]] = defaultdict(list)
+    for meta in metadata:
+        if parsed := _parse_filename_time(meta):
+            key, file_time = parsed
+            series[key].append((file_time, meta))
+    removed = set()
+    for files in series.values():
+        files.sort(key=lambda item: item[0])
+        for i, (file_start, meta) in enumerate(files):
+            if keep_dates and keep_dates[0] <= meta.measurement_date <= keep_dates[1]:
+                continue
+            is_after = file_start - FILENAME_TIME_MARGIN >= window_end
+            is_before = (
+                i + 1 < len(files)
+                and files[i + 1][0] + FILENAME_TIME_MARGIN <= window_start
+            )
+            if is_after or is_before:
+                removed.add(meta.uuid)
+    if removed:
+        logging.info("Skipping %d files outside the measurement time", len(removed))
+    return [meta for meta in metadata if meta.uuid not in removed]
+
+
+def _parse_filename_time(
+    meta: RawMetadata,
+) -> tuple[str, datetime.datetime] | None:
+    """Return series key and start time parsed from filename, or None if the
+    filename has no timestamp close to the measurement date."""
+    for match in FILENAME_TIME_PATTERN.finditer(meta.filename):
+        date_str, time_str = match.group("date"), match.group("time")
+        date_format = "%Y%m%d" if len(date_str) == 8 else "%y%m%d"
+        time_format = "%H%M%S" if len(time_str) == 6 else "%H%M"
+        try:
+            time = datetime.datetime.strptime(
+                date_str + time_str, date_format + time_format
+            )
+        except ValueError:
+            continue
+        if abs(time.date() - meta.measurement_date) > datetime.timedelta(days=1):
+            continue
+        key = meta.filename[: match.start()] + "*" + meta.filename[match.end() :]
+        return key, time
+    return None
@@ -1,33 +1,32 @@
 import datetime
 import importlib
 import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import cast
+from typing import Callable, cast
 from uuid import UUID
 
 import netCDF4
 from cloudnet_api_client.containers import ProductMetadata
-from cloudnetpy.categorize import CategorizeInput, generate_categorize
 from cloudnetpy.exceptions import CloudnetException, ModelDataError
-from cloudnetpy.model_evaluation.products import product_resampling
-from cloudnetpy.products import (
-    generate_mwr_lhumpro,
-    generate_mwr_multi,
-    generate_mwr_single,
-)
-from cloudnetpy.products.epsilon_lidar import generate_epsilon_from_lidar
-from cloudnetpy.products.epsilon_radar import generate_epsilon_from_radar
-from earthcare_downloader import search
 from numpy import ma
-from orbital_radar import InsufficientDataError, Suborbital
 from requests import HTTPError
 
-from earthcare.classification import cloudnet_vs_ec_classification
-from earthcare.cpr_l1b import cloudnet_vs_cpr_l1b
-from earthcare.utils import MissingEarthCAREDataError
-from processing import utils
+from processing import instrumentation, pipeline, utils
+from processing.fingerprint import (
+    FingerprintStore,
+    compute_input_fingerprint,
+    read_input_fingerprint,
+)
+from processing.hashing import file_digests
 from processing.netcdf_comparer import NCDiff, nc_difference
-from processing.processor import ModelParams, Processor, ProductParams
+from processing.processor import (
+    CalibrationProvider,
+    ModelParams,
+    Processor,
+    ProductParams,
+)
 from processing.utils import RawDataMissingError, SkipTaskError, Uuid
 
 
@@ -36,14 +35,36 @@ def process_product(
 ) -> None:
     uuid = Uuid()
     pid_to_new_file = None
+    calibration = (
+        CalibrationProvider(processor.client, params.instrument.pid, params.date)
+        if isinstance(params, ProductParams) and params.instrument
+        else None
+    )
+    fingerprints = FingerprintStore.from_config(processor.md_api.config)
+    fingerprint = (
+        compute_input_fingerprint(processor.client, params, calibration)
+        if fingerprints.enabled
+        else None
+    )
     if existing_product := processor.get_product(params):
         if existing_product.volatile:
             uuid.volatile = existing_product.uuid
         filename = existing_product.filename
         s3key = existing_product.s3key
+        if fingerprint is not None and (
+            fingerprints.get(existing_product.checksum) == fingerprint
+        ):
+            _skip_unchanged_inputs(processor, params, existing_product)
+            return
         existing_file = processor.storage_api.download_product(
             existing_product, directory
         )
+        if fingerprint is not None:
+            existing_fingerprint = read_input_fingerprint(existing_file)
+            fingerprints.put(existing_product.checksum, existing_fingerprint)
+            if fingerprint == existing_fingerprint:
+                _skip_unchanged_inputs(processor, params, existing_product)
+                return
     else:
         filename = _generate_filename(params)
         s3key = None
@@ -52,58 +73,74 @@ def process_product(
     volatile = not existing_file or uuid.volatile is not None
 
     try:
-        if isinstance(params, ModelParams):
-            new_file = _process_l3(processor, params, uuid, directory)
-        elif params.product.id in ("mwr-single", "mwr-multi"):
-            new_file = _process_mwrpy(processor, params, uuid, directory)
-        elif params.product.id in ("categorize", "categorize-voodoo"):
-            new_file = _process_categorize(processor, params, uuid, directory)
-        elif params.product.id == "cpr-simulation":
-            new_file = _process_cpr_simulation(processor, params, uuid, directory)
-        elif params.product.id == "cpr-validation":
-            new_file = _process_cpr_validation(processor, params, uuid, directory)
-        elif params.product.id == "cpr-tc-validation":
-            new_file = _process_cpr_tc_validation(processor, params, uuid, directory)
-        elif params.product.id == "epsilon-lidar":
-            new_file = _process_epsilon_from_lidar(processor, params, uuid, directory)
-        elif params.product.id == "epsilon-radar":
-            new_file = _process_epsilon_from_radar(processor, params, uuid, directory)
-        else:
-            new_file = _process_level2(processor, params, uuid, directory)
+        with instrumentation.phase("convert"):
+            if isinstance(params, ModelParams):
+                new_file = _process_l3(processor, params, uuid, directory)
+            elif params.product.id in ("mwr-single", "mwr-multi"):
+                new_file = _process_mwrpy(processor, params, uuid, directory)
+            elif params.product.id in ("categorize", "categorize-voodoo"):
+                new_file = _process_categorize(processor, params, uuid, directory)
+            elif params.product.id == "cpr-simulation":
+                new_file = _process_cpr_simulation(processor, params, uuid, directory)
+            elif params.product.id == "cpr-validation":
+                new_file = _process_cpr_validation(processor, params, uuid, directory)
+            elif params.product.id == "cpr-tc-validation":
+                new_file = _process_cpr_tc_validation(
+                    processor, params, uuid, directory
+                )
+            elif params.product.id == "epsilon-lidar":
+                new_file = _process_epsilon_from_lidar(
+                    processor, params, uuid, directory
+                )
+            elif params.product.id == "epsilon-radar":
+                new_file = _process_epsilon_from_radar(
+                    processor, params, uuid, directory
+                )
+            else:
+                new_file = _process_level2(processor, params, uuid, directory)
     except CloudnetException as err:
         raise utils.SkipTaskError(str(err)) from err
 
-    if not params.product.experimental:
-        processor.pid_utils.add_pid_to_file(new_file, pid_to_new_file)
-
     instrument_pid = (
         params.instrument.pid
         if isinstance(params, ProductParams) and params.instrument
         else None
     )
-    utils.add_global_attributes(new_file, instrument_pid)
+    with utils.FileFinalizer(new_file, summarize=True) as finalizer:
+        if not params.product.experimental:
+            processor.pid_utils.add_pid(finalizer, pid_to_new_file)
+        finalizer.add_global_attributes(instrument_pid, fingerprint)
+    summary = finalizer.summary
+    variables = finalizer.variables
 
     upload = True
     patch = False
     if existing_product and existing_file:
-        difference = nc_difference(existing_file, new_file)
+        difference = nc_difference(
+            existing_file, new_file, utils.available_cpus(processor.md_api.config)
+        )
         if difference == NCDiff.NONE:
             upload = False
             new_file = existing_file
             uuid.product = existing_product.uuid
+            # The existing file may have a stale fingerprint or none at all.
+            fingerprints.put(existing_product.checksum, fingerprint)
         elif difference == NCDiff.MINOR:
-            # Replace existing file
+            # Replace existing file. The files are compared only after
+            # finalizing, so PID and UUID are patched in another open.
             patch = True
-            if not params.product.experimental:
-                processor.pid_utils.add_pid_to_file(new_file, existing_product.pid)
-            with netCDF4.Dataset(new_file, "r+") as nc:
-                nc.file_uuid = str(existing_product.uuid)
+            with utils.FileFinalizer(new_file, summarize=True) as finalizer:
+                if not params.product.experimental:
+                    processor.pid_utils.add_pid(finalizer, existing_product.pid)
+                finalizer.set("file_uuid", str(existing_product.uuid))
+            summary = finalizer.summary
             uuid.product = existing_product.uuid
 
     if upload:
         processor.upload_file(
-            params, new_file, filename, volatile, patch, uuid.product, s3key
+            params, new_file, filename, volatile, patch, uuid.product, s3key, summary
         )
+        fingerprints.put(file_digests(new_file).sha256_hex, fingerprint)
     else:
         logging.info("Skipping PUT to data portal, file has not changed")
 
@@ -123,6 +160,7 @@ def process_product(
             uuid.product,
             filename,
             directory,
+            variables=variables,
         )
     qc_result = processor.upload_quality_report(
         new_file, uuid.product, params.site, params.product.id
@@ -156,6 +194,12 @@ def _generate_filename(params: ProductParams | ModelParams) -> str:
 def _process_mwrpy(
     processor: Processor, params: ProductParams, uuid: Uuid, directory: Path
 ) -> Path:
+    from cloudnetpy.products import (
+        generate_mwr_lhumpro,
+        generate_mwr_multi,
+        generate_mwr_single,
+    )
+
     if params.instrument is None:
         raise RuntimeError("Instrument is None")
     metadata = processor.client.files(
@@ -216,6 +260,8 @@ def _get_lwp_offset(
 def _process_cpr_simulation(
     processor: Processor, params: ProductParams, uuid: Uuid, directory: Path
 ) -> Path:
+    from orbital_radar import InsufficientDataError, Suborbital
+
     _check_cpr_date(params)
     metadata = processor.client.files(
         site_id=params.site.id,
@@ -237,13 +283,15 @@ def _process_cpr_simulation(
     except InsufficientDataError as err:
         raise SkipTaskError(str(err)) from err
     uuid.product = UUID(uuid_str)
-    utils.add_global_attributes(output_file)
     return output_file
 
 
 def _process_cpr_validation(
     processor: Processor, params: ProductParams, uuid: Uuid, directory: Path
 ) -> Path:
+    from earthcare.cpr_l1b import cloudnet_vs_cpr_l1b
+    from earthcare.utils import MissingEarthCAREDataError
+
     _check_cpr_date(params)
     cpr_simu_metadata = processor.client.files(
         site_id=params.site.id,
@@ -268,7 +316,6 @@ def _process_cpr_validation(
     except MissingEarthCAREDataError:
         raise SkipTaskError("Missing EarthCARE data")
     uuid.product = UUID(uuid_str)
-    utils.add_global_attributes(output_file)
     _propagate_source_instrument_pids(cpr_simu_file, output_file)
     return output_file
 
@@ -276,6 +323,9 @@ def _process_cpr_validation(
 def _process_cpr_tc_validation(
     processor: Processor, params: ProductParams, uuid: Uuid, directory: Path
 ) -> Path:
+    from earthcare.classification import cloudnet_vs_ec_classification
+    from earthcare.utils import MissingEarthCAREDataError
+
     _check_cpr_date(params)
     metadata = processor.client.files(
         site_id=params.site.id,
@@ -300,7 +350,6 @@ def _process_cpr_tc_validation(
     except MissingEarthCAREDataError:
         raise SkipTaskError("Missing EarthCARE data")
     uuid.product = UUID(uuid_str)
-    utils.add_global_attributes(output_file)
     _propagate_source_instrument_pids(classification_file, output_file)
     return output_file
 
@@ -320,6 +369,8 @@ def _check_cpr_date(params: ProductParams) -> None:
 
 
 def _check_is_overpass(params: ProductParams) -> None:
+    from earthcare_downloader import search
+
     distance_km = 200
     files = search(
         product="CPR_NOM_1B",
@@ -335,6 +386,8 @@ def _check_is_overpass(params: ProductParams) -> None:
 def _process_epsilon_from_lidar(
     processor: Processor, params: ProductParams, uuid: Uuid, directory: Path
 ) -> Path:
+    from cloudnetpy.products.epsilon_lidar import generate_epsilon_from_lidar
+
     if params.instrument is None:
         raise RuntimeError("Instrument is None")
 
@@ -356,11 +409,13 @@ def _process_epsilon_from_lidar(
 
     metadata_wind = sorted(
         metadata_wind,
-        key=lambda meta: -1
-        if meta.instrument is not None
-        and params.instrument is not None
-        and meta.instrument.pid == params.instrument.pid
-        else 1,
+        key=lambda meta: (
+            -1
+            if meta.instrument is not None
+            and params.instrument is not None
+            and meta.instrument.pid == params.instrument.pid
+            else 1
+        ),
     )
 
     file_lidar, file_wind = processor.storage_api.download_products(
@@ -377,6 +432,8 @@ def _process_epsilon_from_lidar(
 def _process_epsilon_from_radar(
     processor: Processor, params: ProductParams, uuid: Uuid, directory: Path
 ) -> Path:
+    from cloudnetpy.products.epsilon_radar import generate_epsilon_from_radar
+
     if params.instrument is None:
         raise RuntimeError("Instrument is None")
 
@@ -406,10 +463,13 @@ def _process_epsilon_from_radar(
 def _process_categorize(
     processor: Processor, params: ProductParams, uuid: Uuid, directory: Path
 ) -> Path:
+    from cloudnetpy.categorize import CategorizeInput, generate_categorize
+
     is_voodoo = params.product.id == "categorize-voodoo"
-    meta_records = _get_level1b_metadata_for_categorize(processor, params, is_voodoo)
-    paths = processor.storage_api.download_products(meta_records.values(), directory)
-    input_files = cast(CategorizeInput, dict(zip(meta_records.keys(), paths)))
+    meta_records, paths = _download_level1b_products_for_categorize(
+        processor, params, directory, is_voodoo
+    )
+    input_files = cast(CategorizeInput, paths)
     if is_voodoo:
         input_files["lv0_files"], lv0_uuid = _get_input_files_for_voodoo(
             processor, params, directory, meta_records["radar"]
@@ -434,6 +494,8 @@ def _process_categorize(
 def _process_l3(
     processor: Processor, params: ModelParams, uuid: Uuid, directory: Path
 ) -> Path:
+    from cloudnetpy.model_evaluation.products import product_resampling
+
     model_meta = processor.client.files(
         site_id=params.site.id,
         date=params.date,
@@ -497,12 +559,66 @@ def _process_level2(
     return output_file
 
 
-def _get_level1b_metadata_for_categorize(
+def _download_level1b_products_for_categorize(
+    processor: Processor, params: ProductParams, directory: Path, is_voodoo: bool
+) -> tuple[dict[str, ProductMetadata], dict[str, Path]]:
+    """Find and download input products of categorize.
+
+    Inputs are resolved concurrently, and each download starts as soon as
+    its input is found. If a required input is missing, pending downloads
+    are cancelled. The same file (e.g. RPG radar used also as MWR) is
+    downloaded only once.
+    """
+    resolvers = _get_level1b_resolvers_for_categorize(processor, params, is_voodoo)
+    optional_products = ["disdrometer", "mwr"]
+    results: dict[str, ProductMetadata | None] = {}
+    downloads: dict[UUID, Future[tuple[Path, int]]] = {}
+    cancel = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=2 * len(resolvers))
+    try:
+        with instrumentation.phase("download"), pipeline.io_phase():
+            resolving = {
+                executor.submit(resolver): key for key, resolver in resolvers.items()
+            }
+            for future in as_completed(resolving):
+                product = resolving[future]
+                metadata = results[product] = future.result()
+                if metadata is None:
+                    if product not in optional_products:
+                        raise SkipTaskError(
+                            f"Missing required input product: {product}"
+                        )
+                    continue
+                if metadata.uuid not in downloads:
+                    downloads[metadata.uuid] = executor.submit(
+                        processor.storage_api.download_product_untracked,
+                        metadata,
+                        directory,
+                        cancel,
+                    )
+            meta_records = {
+                key: metadata
+                for key in resolvers
+                if (metadata := results[key]) is not None
+            }
+            paths = {
+                key: downloads[metadata.uuid].result()[0]
+                for key, metadata in meta_records.items()
+            }
+    finally:
+        cancel.set()
+        executor.shutdown(cancel_futures=True)
+    instrumentation.add_downloaded(
+        sum(download.result()[1] for download in downloads.values())
+    )
+    return meta_records, paths
+
+
+def _get_level1b_resolvers_for_categorize(
     processor: Processor, params: ProductParams, is_voodoo: bool
-) -> dict[str, ProductMetadata]:
-    meta_records = {
-        "model": processor.get_product(params, product_id="model"),
-        "mwr": (
+) -> dict[str, Callable[[], ProductMetadata | None]]:
+    def find_mwr() -> ProductMetadata | None:
+        return (
             processor.find_instrument_product(params, "mwr-single")
             or processor.find_instrument_product(
                 params, "mwr", fallback=["hatpro", "radiometrics"]
@@ -510,27 +626,29 @@ def _get_level1b_metadata_for_categorize(
             or processor.find_instrument_product(
                 params, "radar", require=["rpg-fmcw-35", "rpg-fmcw-94"]
             )
-        ),
-        "radar": (
-            processor.find_instrument_product(params, "radar", require=["rpg-fmcw-94"])
-            if is_voodoo
-            else processor.find_instrument_product(
-                params,
-                "radar",
-                fallback=["mira-35", "rpg-fmcw-35", "rpg-fmcw-94", "copernicus"],
-                exclude=["mira-10"],
+        )
+
+    def find_radar() -> ProductMetadata | None:
+        if is_voodoo:
+            return processor.find_instrument_product(
+                params, "radar", require=["rpg-fmcw-94"]
             )
-        ),
-        "lidar": processor.find_optimal_lidar(params),
-        "disdrometer": processor.find_instrument_product(
+        return processor.find_instrument_product(
+            params,
+            "radar",
+            fallback=["mira-35", "rpg-fmcw-35", "rpg-fmcw-94", "copernicus"],
+            exclude=["mira-10"],
+        )
+
+    return {
+        "model": lambda: processor.get_product(params, product_id="model"),
+        "mwr": find_mwr,
+        "radar": find_radar,
+        "lidar": lambda: processor.find_optimal_lidar(params),
+        "disdrometer": lambda: processor.find_instrument_product(
             params, "disdrometer", fallback=["thies-lnm", "parsivel"]
         ),
     }
-    optional_products = ["disdrometer", "mwr"]
-    for product, metadata in meta_records.items():
-        if product not in optional_products and metadata is None:
-            raise SkipTaskError(f"Missing required input product: {product}")
-    return {key: value for key, value in meta_records.items() if value is not None}
 
 
 def _get_input_files_for_voodoo(
@@ -557,6 +675,18 @@ def _get_input_files_for_voodoo(
     return full_paths, uuids
 
 
+def _skip_unchanged_inputs(
+    processor: Processor,
+    params: ProductParams | ModelParams,
+    existing_product: ProductMetadata,
+) -> None:
+    """Finish task without processing when the existing product was generated
+    from the current inputs."""
+    logging.info("Skipping processing, inputs have not changed")
+    if processor.md_api.config.is_production and isinstance(params, ProductParams):
+        _update_dvas_metadata(processor, existing_product.uuid)
+
+
 def _update_dvas_metadata(processor: Processor, uuid: UUID) -> None:
     meta = processor.client.file(uuid)
     processor.dvas.upload(meta)
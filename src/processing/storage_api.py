@@ -2,25 +2,44 @@
 
 import concurrent
 import concurrent.futures
+import contextlib
+import gzip
 import hashlib
+import io
 import logging
 import re
+import tarfile
 import threading
+import time
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Iterable
+from typing import Any, BinaryIO, Callable, Iterable
 from uuid import UUID
 
 import requests
+import urllib3
 from cloudnet_api_client.containers import (
     Metadata,
     ProductMetadata,
     RawMetadata,
     RawModelMetadata,
 )
-from cloudnet_api_client.utils import md5sum, sha256sum
+from requests.adapters import HTTPAdapter
 
+from processing import instrumentation, pipeline
 from processing.config import Config
+from processing.file_cache import FileCache
+from processing.hashing import file_digests, invalidate_file_digests
+
+MIN_DOWNLOAD_WORKERS = 2
+MAX_DOWNLOAD_WORKERS = 16
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+MAX_RESUME_ATTEMPTS = 5
+PARALLEL_RANGE_MIN_SIZE = 256 * 1024 * 1024
+PARALLEL_RANGE_PARTS = 4
+# Every download worker may use a connection for each range of a large file.
+MAX_DOWNLOAD_CONNECTIONS = MAX_DOWNLOAD_WORKERS * PARALLEL_RANGE_PARTS
+DOWNLOAD_TIMEOUT = 60 * 60
 
 
 class StorageApiError(Exception):
@@ -41,7 +60,11 @@ class StorageApi:
         self.config = config
         self._url = config.storage_service_url
         self._auth = config.storage_service_auth
+        self._cache = FileCache.from_config(config)
+        self._download_session = _make_download_session()
+        self._download_stats = DownloadStats()
 
+    @instrumentation.phase("upload")
     def upload_product(
         self, full_path: Path, uuid: UUID, s3key: str
     ) -> StorageApiFileInfo:
@@ -56,30 +79,64 @@ class StorageApi:
         self,
         metadata: list[RawMetadata] | list[RawModelMetadata],
         dir_name: Path,
+        decompress: bool = False,
     ) -> tuple[list[Path], list[UUID]]:
-        """Download raw instrument or model files."""
+        """Download raw instrument or model files.
+
+        With `decompress`, gzip files and gzipped tar files are decompressed
+        while downloading, and the decompressed files are returned instead.
+        """
         full_paths = self._download_parallel(
-            metadata, checksum_algorithm="md5", output_directory=dir_name
+            metadata,
+            checksum_algorithm="md5",
+            output_directory=dir_name,
+            decompress=decompress,
         )
         uuids = [row.uuid for row in metadata]
         return full_paths, uuids
 
+    @instrumentation.phase("download")
     def download_product(self, metadata: ProductMetadata, dir_name: Path) -> Path:
         """Download a product."""
+        with pipeline.io_phase():
+            full_path, n_bytes = self.download_product_untracked(metadata, dir_name)
+        instrumentation.add_downloaded(n_bytes)
+        return full_path
+
+    def download_product_untracked(
+        self,
+        metadata: ProductMetadata,
+        dir_name: Path,
+        cancel: threading.Event | None = None,
+    ) -> tuple[Path, int]:
+        """Download a product and return its path and the number of downloaded
+        bytes.
+
+        Unlike `download_product`, the download is not recorded to the task
+        instrumentation, so this can be called from other threads. The
+        download is stopped with `DownloadCancelledError` when `cancel` is set.
+        """
         full_path = dir_name / metadata.filename
-        if full_path.exists() and sha256sum(full_path) == metadata.checksum:
+        if (
+            full_path.exists()
+            and file_digests(full_path).sha256_hex == metadata.checksum
+        ):
             # Already downloaded into this directory (e.g. a model source file
             # reused across several L3 products) - skip the network round-trip.
-            return full_path
-        _download_url(
+            return full_path, 0
+        n_bytes = _download_url(
             url=self._get_download_url(metadata),
             size=metadata.size,
             checksum=metadata.checksum,
             checksum_algorithm="sha256",
             output_path=full_path,
             auth=self._auth,
+            session=self._download_session,
+            stats=self._download_stats,
+            cache=self._cache,
+            cancel=cancel,
         )
-        return full_path
+        return full_path, n_bytes
 
     def download_products(
         self, meta_records: Iterable[ProductMetadata], dir_name: Path
@@ -89,6 +146,7 @@ class StorageApi:
             meta_records, checksum_algorithm="sha256", output_directory=dir_name
         )
 
+    @instrumentation.phase("upload")
     def upload_image(self, full_path: Path, s3key: str) -> None:
         url = f"{self._url}/cloudnet-img/{s3key}"
         headers = self._get_headers(full_path)
@@ -100,20 +158,31 @@ class StorageApi:
         with full_path.open("rb") as f:
             res = self.session.put(url, data=f, auth=self._auth, headers=headers)
             res.raise_for_status()
-            return res
+        instrumentation.add_uploaded(full_path.stat().st_size)
+        return res
 
     @staticmethod
     def _get_headers(full_path: Path) -> dict:
-        checksum = md5sum(full_path, is_base64=True)
-        return {"content-md5": checksum}
+        return {"content-md5": file_digests(full_path).md5_base64}
 
+    @instrumentation.phase("download")
     def _download_parallel(
         self,
         meta_records: Iterable[Metadata],
         checksum_algorithm: str,
         output_directory: Path,
+        decompress: bool = False,
     ) -> list[Path]:
-        executor = concurrent.futures.ThreadPoolExecutor(max_workers=5)
+        meta_records = list(meta_records)
+        unique_meta = {self._get_download_url(meta): meta for meta in meta_records}
+        max_workers = self._download_stats.concurrency(
+            [int(meta.size) for meta in unique_meta.values()]
+        )
+        download: Callable[..., Any] = (
+            _download_decompressed if decompress else _download_url
+        )
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        cancel = threading.Event()
         try:
             futures = []
             paths = []
@@ -127,23 +196,45 @@ class StorageApi:
                     continue
                 unique_urls.add(url)
                 future = executor.submit(
-                    _download_url,
+                    download,
                     url=url,
                     size=int(meta.size),
                     checksum=meta.checksum,
                     checksum_algorithm=checksum_algorithm,
                     output_path=path,
                     auth=self._auth,
+                    session=self._download_session,
+                    stats=self._download_stats,
+                    cache=self._cache,
+                    cancel=cancel,
                 )
                 futures.append(future)
-            done, not_done = concurrent.futures.wait(
-                futures, timeout=60 * 60, return_when=concurrent.futures.FIRST_EXCEPTION
-            )
+            with pipeline.io_phase():
+                done, not_done = concurrent.futures.wait(
+                    futures,
+                    timeout=DOWNLOAD_TIMEOUT,
+                    return_when=concurrent.futures.FIRST_EXCEPTION,
+                )
             for future in done:
                 if exc := future.exception():
                     raise StorageApiError("Failed to download all files") from exc
+            if not_done:
+                raise StorageApiError(
+                    f"Downloads did not finish in {DOWNLOAD_TIMEOUT} seconds"
+                )
+            if decompress:
+                paths = []
+                for future in futures:
+                    n_bytes, output_paths = future.result()
+                    instrumentation.add_downloaded(n_bytes)
+                    paths.extend(output_paths)
+            else:
+                for future in futures:
+                    instrumentation.add_downloaded(future.result())
             return paths
         finally:
+            # Stop running downloads, so that shutdown does not wait for them.
+            cancel.set()
             executor.shutdown(cancel_futures=True)
 
     def _get_download_url(self, metadata: Metadata) -> str:
@@ -154,8 +245,79 @@ class StorageApi:
         )
 
 
+class DownloadStats:
+    """Observed request latency and per-connection throughput of downloads.
+
+    Downloads of small files are dominated by request latency and benefit
+    from many concurrent connections, whereas large files are limited by
+    bandwidth and only need a few.
+    """
+
+    def __init__(self, latency: float = 0.2, throughput: float = 20e6) -> None:
+        self.latency = latency
+        self.throughput = throughput
+        self._lock = threading.Lock()
+
+    def add(self, latency: float, n_bytes: int, transfer_time: float) -> None:
+        with self._lock:
+            self.latency = _moving_average(self.latency, latency)
+        self.add_transfer(n_bytes, transfer_time)
+
+    def add_transfer(self, n_bytes: int, transfer_time: float) -> None:
+        """Add observed transfer of one connection without request latency."""
+        if n_bytes < DOWNLOAD_BUFFER_SIZE or transfer_time <= 0:
+            return
+        with self._lock:
+            self.throughput = _moving_average(self.throughput, n_bytes / transfer_time)
+
+    def concurrency(self, sizes: list[int]) -> int:
+        """Return number of concurrent downloads for files of given sizes."""
+        if not sizes:
+            return 1
+        mean_size = sum(sizes) / len(sizes)
+        with self._lock:
+            latency = self.latency
+            time_per_file = latency + mean_size / self.throughput
+        latency_fraction = latency / time_per_file
+        n_workers = round(
+            MIN_DOWNLOAD_WORKERS
+            + latency_fraction * (MAX_DOWNLOAD_WORKERS - MIN_DOWNLOAD_WORKERS)
+        )
+        return min(n_workers, len(sizes))
+
+
+def _moving_average(old: float, new: float, weight: float = 0.2) -> float:
+    return (1 - weight) * old + weight * new
+
+
+def _make_download_session() -> requests.Session:
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=MAX_DOWNLOAD_CONNECTIONS, pool_block=True
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
 thread_local = threading.local()
 
+# Errors after which an interrupted download is resumed.
+STREAM_ERRORS = (requests.RequestException, urllib3.exceptions.HTTPError)
+
+
+class RangeNotSupportedError(Exception):
+    pass
+
+
+class DownloadCancelledError(Exception):
+    pass
+
+
+def _check_cancelled(cancel: threading.Event | None) -> None:
+    if cancel is not None and cancel.is_set():
+        raise DownloadCancelledError
+
 
 def _download_url(
     url: str,
@@ -164,21 +326,320 @@ def _download_url(
     checksum_algorithm: str,
     output_path: Path,
     auth: tuple[str, str],
-) -> None:
-    if not hasattr(thread_local, "session"):
-        thread_local.session = requests.Session()
-    res_size = 0
-    hash_sum = hashlib.new(checksum_algorithm)
-    with output_path.open("wb") as output_file:
-        with thread_local.session.get(
-            url, auth=auth, timeout=2 * 60, stream=True
-        ) as res:
-            res.raise_for_status()
-            for chunk in res.iter_content(chunk_size=8192):
-                output_file.write(chunk)
-                hash_sum.update(chunk)
-                res_size += len(chunk)
+    session: requests.Session,
+    stats: DownloadStats | None = None,
+    cache: FileCache | None = None,
+    cancel: threading.Event | None = None,
+) -> int:
+    """Download file and return the number of downloaded bytes.
+
+    Files found in `cache` are copied from there without downloading. Files
+    with a valid size and checksum are added to `cache`. Interrupted
+    downloads are resumed, and very large files are downloaded in parallel
+    byte ranges if the server supports them. Downloads are stopped with
+    `DownloadCancelledError` when `cancel` is set.
+    """
+    invalidate_file_digests(output_path)
+    if cache is not None and cache.fetch(
+        checksum, checksum_algorithm, output_path, size
+    ):
+        return 0
+    res_checksum = None
+    if size >= PARALLEL_RANGE_MIN_SIZE:
+        try:
+            res_size = _download_ranges(
+                session, url, auth, output_path, size, stats, cancel
+            )
+            digests = file_digests(output_path)
+            res_checksum = getattr(digests, checksum_algorithm).hex()
+        except RangeNotSupportedError:
+            logging.debug("Range requests not supported, downloading as one stream")
+    if res_checksum is None:
+        res_size, res_checksum = _download_stream(
+            session, url, auth, output_path, checksum_algorithm, stats, cancel
+        )
+    is_valid = True
     if res_size != size:
         logging.warning("Invalid size: expected %d bytes, got %d bytes", size, res_size)
-    if (res_checksum := hash_sum.hexdigest()) != checksum:
+        is_valid = False
+    if res_checksum != checksum:
         logging.warning("Invalid checksum: expected %s, got %s", checksum, res_checksum)
+        is_valid = False
+    if cache is not None and is_valid:
+        cache.insert(output_path, checksum, checksum_algorithm)
+    return res_size
+
+
+def _download_decompressed(
+    url: str,
+    size: int,
+    checksum: str,
+    checksum_algorithm: str,
+    output_path: Path,
+    auth: tuple[str, str],
+    session: requests.Session,
+    stats: DownloadStats | None = None,
+    cache: FileCache | None = None,
+    cancel: threading.Event | None = None,
+) -> tuple[int, list[Path]]:
+    """Download and decompress gzip file while downloading. Returns the
+    number of downloaded bytes and decompressed files.
+
+    The compressed file is written to disk only if `cache` is given, so that
+    it can be added to the cache once its checksum is verified. If a file
+    cannot be decompressed, a warning is logged and only the files extracted
+    before the error are returned. Other files are downloaded as such.
+    """
+    from processing.utils import extract_gz_stream, try_unzip_gz_file
+
+    if output_path.suffix != ".gz":
+        n_bytes = _download_url(
+            url,
+            size,
+            checksum,
+            checksum_algorithm,
+            output_path,
+            auth,
+            session,
+            stats,
+            cache,
+            cancel,
+        )
+        return n_bytes, [output_path]
+    path_out = output_path.parent / output_path.stem
+    try:
+        if cache is not None and cache.fetch(
+            checksum, checksum_algorithm, output_path, size
+        ):
+            paths, error = try_unzip_gz_file(output_path)
+            if error is not None:
+                logging.warning("Cannot unzip gz file %s: %s", output_path, error)
+            return 0, paths
+        for attempt in range(MAX_RESUME_ATTEMPTS + 1):
+            n_bytes = 0
+            paths = []
+            hash_sum = hashlib.new(checksum_algorithm)
+            try:
+                with (
+                    session.get(url, auth=auth, timeout=2 * 60, stream=True) as res,
+                    contextlib.ExitStack() as stack,
+                ):
+                    res.raise_for_status()
+                    res.raw.decode_content = True
+                    copy = None
+                    if cache is not None:
+                        copy = stack.enter_context(output_path.open("wb"))
+                    reader = _HashingReader(res.raw, hash_sum, copy, cancel)
+                    with gzip.GzipFile(fileobj=reader, mode="rb") as file_in:
+                        for path in extract_gz_stream(file_in, path_out):
+                            paths.append(path)
+                        # Read trailing data, e.g. tar padding, for the checksum.
+                        while file_in.read(DOWNLOAD_BUFFER_SIZE):
+                            pass
+                    n_bytes = reader.n_bytes
+                break
+            except (EOFError, gzip.BadGzipFile, tarfile.TarError) as err:
+                logging.warning("Cannot unzip gz file %s: %s", output_path, err)
+                return n_bytes, paths
+            except requests.HTTPError:
+                raise
+            except STREAM_ERRORS as err:
+                if attempt == MAX_RESUME_ATTEMPTS:
+                    raise
+                logging.warning("Download interrupted, restarting: %s", err)
+        is_valid = True
+        if n_bytes != size:
+            logging.warning(
+                "Invalid size: expected %d bytes, got %d bytes", size, n_bytes
+            )
+            is_valid = False
+        if (res_checksum := hash_sum.hexdigest()) != checksum:
+            logging.warning(
+                "Invalid checksum: expected %s, got %s", checksum, res_checksum
+            )
+            is_valid = False
+        if cache is not None and is_valid:
+            cache.insert(output_path, checksum, checksum_algorithm)
+        return n_bytes, paths
+    finally:
+        output_path.unlink(missing_ok=True)
+
+
+class _HashingReader(io.RawIOBase):
+    """Readable stream that hashes and counts the bytes read from `raw`, and
+    optionally copies them to `copy`."""
+
+    def __init__(
+        self,
+        raw: io.BufferedIOBase | urllib3.BaseHTTPResponse,
+        hash_sum: "hashlib._Hash",
+        copy: BinaryIO | None = None,
+        cancel: threading.Event | None = None,
+    ) -> None:
+        self._raw = raw
+        self._hash_sum = hash_sum
+        self._copy = copy
+        self._cancel = cancel
+        self.n_bytes = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: bytearray | memoryview) -> int:  # type: ignore[override]
+        _check_cancelled(self._cancel)
+        n = self._raw.readinto(buffer)
+        view = memoryview(buffer)[:n]
+        self._hash_sum.update(view)
+        if self._copy is not None:
+            self._copy.write(view)
+        self.n_bytes += n
+        return n
+
+
+def _download_stream(
+    session: requests.Session,
+    url: str,
+    auth: tuple[str, str],
+    output_path: Path,
+    checksum_algorithm: str,
+    stats: DownloadStats | None,
+    cancel: threading.Event | None = None,
+) -> tuple[int, str]:
+    """Download file as one stream, resuming from the last written byte if
+    the stream is interrupted. Returns size and checksum of the file."""
+    view = _get_buffer()
+    res_size = 0
+    hash_sum = hashlib.new(checksum_algorithm)
+    latency = None
+    start_time = time.perf_counter()
+    with output_path.open("wb") as output_file:
+        for attempt in range(MAX_RESUME_ATTEMPTS + 1):
+            headers = {"Range": f"bytes={res_size}-"} if res_size > 0 else None
+            request_time = time.perf_counter()
+            try:
+                with session.get(
+                    url, auth=auth, headers=headers, timeout=2 * 60, stream=True
+                ) as res:
+                    res.raise_for_status()
+                    if latency is None:
+                        latency = time.perf_counter() - request_time
+                    if res_size > 0 and res.status_code != 206:
+                        # Server ignored the range, so start from the beginning.
+                        output_file.seek(0)
+                        output_file.truncate()
+                        res_size = 0
+                        hash_sum = hashlib.new(checksum_algorithm)
+                    res.raw.decode_content = True
+                    while n := res.raw.readinto(view):
+                        _check_cancelled(cancel)
+                        output_file.write(view[:n])
+                        hash_sum.update(view[:n])
+                        res_size += n
+                break
+            except requests.HTTPError:
+                raise
+            except STREAM_ERRORS as err:
+                if attempt == MAX_RESUME_ATTEMPTS:
+                    raise
+                logging.warning(
+                    "Download interrupted after %d bytes, resuming: %s", res_size, err
+                )
+    if stats is not None and latency is not None:
+        transfer_time = time.perf_counter() - start_time - latency
+        stats.add(latency, res_size, transfer_time)
+    return res_size, hash_sum.hexdigest()
+
+
+def _download_ranges(
+    session: requests.Session,
+    url: str,
+    auth: tuple[str, str],
+    output_path: Path,
+    size: int,
+    stats: DownloadStats | None = None,
+    cancel: threading.Event | None = None,
+) -> int:
+    """Download file in parallel byte ranges. Returns the number of
+    downloaded bytes. If one range fails, the other ranges are stopped."""
+    part_size = -(-size // PARALLEL_RANGE_PARTS)
+    ranges = [
+        (start, min(start + part_size, size)) for start in range(0, size, part_size)
+    ]
+    with output_path.open("wb") as output_file:
+        output_file.truncate(size)
+    failed = threading.Event()
+    start_time = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = [
+            executor.submit(
+                _download_range, session, url, auth, output_path, *r, cancel, failed
+            )
+            for r in ranges
+        ]
+        res_size = 0
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                res_size += future.result()
+        except BaseException:
+            failed.set()
+            raise
+    if stats is not None:
+        transfer_time = time.perf_counter() - start_time
+        stats.add_transfer(res_size // len(ranges), transfer_time)
+    return res_size
+
+
+def _download_range(
+    session: requests.Session,
+    url: str,
+    auth: tuple[str, str],
+    output_path: Path,
+    start: int,
+    end: int,
+    cancel: threading.Event | None = None,
+    failed: threading.Event | None = None,
+) -> int:
+    """Download bytes from `start` to `end` (exclusive) into the same position
+    of an existing file, resuming if the stream is interrupted. Stops with
+    `DownloadCancelledError` when `cancel` or `failed` is set."""
+    view = _get_buffer()
+    position = start
+    with output_path.open("r+b") as output_file:
+        output_file.seek(start)
+        for attempt in range(MAX_RESUME_ATTEMPTS + 1):
+            headers = {"Range": f"bytes={position}-{end - 1}"}
+            try:
+                with session.get(
+                    url, auth=auth, headers=headers, timeout=2 * 60, stream=True
+                ) as res:
+                    res.raise_for_status()
+                    if res.status_code != 206:
+                        raise RangeNotSupportedError
+                    res.raw.decode_content = True
+                    while position < end and (
+                        n := res.raw.readinto(view[: end - position])
+                    ):
+                        _check_cancelled(cancel)
+                        _check_cancelled(failed)
+                        output_file.write(view[:n])
+                        position += n
+                break
+            except requests.HTTPError:
+                raise
+            except STREAM_ERRORS as err:
+                if attempt == MAX_RESUME_ATTEMPTS:
+                    raise
+                logging.warning(
+                    "Download of range %d-%d interrupted at %d, resuming: %s",
+                    start,
+                    end - 1,
+                    position,
+                    err,
+                )
+    return position - start
+
+
+def _get_buffer() -> memoryview:
+    if not hasattr(thread_local, "buffer"):
+        thread_local.buffer = memoryview(bytearray(DOWNLOAD_BUFFER_SIZE))
+    return thread_local.buffer
@@ -1,6 +1,9 @@
 import datetime
 import gzip
+import json
 import logging
+import math
+import os
 import shutil
 import tarfile
 from collections.abc import Iterable
@@ -11,12 +14,18 @@ from uuid import UUID
 import netCDF4
 import numpy as np
 import requests
-from cloudnet_api_client.utils import sha256sum
 from numpy import ma
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+from processing import instrumentation, pipeline
 from processing.config import Config
+from processing.hashing import (
+    DIGESTS_ATTRIBUTE,
+    file_digests,
+    invalidate_file_digests,
+    variable_digests,
+)
 from processing.storage_api import StorageApiFileInfo
 from processing.version import __version__ as cloudnet_processing_version
 
@@ -74,7 +83,8 @@ class MyAdapter(HTTPAdapter):
     ):
         if timeout is None:
             timeout = 120
-        return super().send(request, stream, timeout, verify, cert, proxies)
+        with instrumentation.request_phase(), pipeline.io_phase():
+            return super().send(request, stream, timeout, verify, cert, proxies)
 
 
 def make_session() -> requests.Session:
@@ -85,6 +95,21 @@ def make_session() -> requests.Session:
     return http
 
 
+def _cpu_count() -> int:
+    """Return number of CPUs usable by this process."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def available_cpus(config: Config) -> int:
+    """Return number of CPUs available for processing a task."""
+    n_cpus = _cpu_count()
+    if config.cpu_limit is not None:
+        n_cpus = min(n_cpus, max(1, math.floor(config.cpu_limit)))
+    return n_cpus
+
+
 def utctoday() -> datetime.date:
     return utcnow().date()
 
@@ -189,12 +214,72 @@ def _post_message(
             raise RuntimeError(r.text)
 
 
-def add_global_attributes(full_path: Path, instrument_pid: str | None = None) -> None:
-    """Add cloudnet-processing package version to file attributes."""
-    with netCDF4.Dataset(full_path, "r+") as nc:
-        nc.cloudnet_processing_version = cloudnet_processing_version
+class FileFinalizer:
+    """Collects global attribute changes to a product file and writes them in
+    a single open of the file.
+
+    Attributes can be read while the file is open, but changes are written
+    only when the context exits. If `summarize` is set, a summary of the
+    finalized file for the data portal and the names of its variables are
+    then read from the same handle and stored in `summary` and `variables`.
+    """
+
+    def __init__(self, full_path: Path, summarize: bool = False) -> None:
+        self.full_path = full_path
+        self.summary: dict | None = None
+        self.variables: list[str] | None = None
+        self._summarize = summarize
+        self._attributes: dict[str, str] = {}
+        self._add_digests = False
+        self._nc: netCDF4.Dataset | None = None
+
+    def __enter__(self) -> "FileFinalizer":
+        self._nc = netCDF4.Dataset(self.full_path, "r+")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:  # noqa: ANN001
+        assert self._nc is not None
+        try:
+            if exc_type is None:
+                self._write(self._nc)
+        finally:
+            self._nc.close()
+            self._nc = None
+            invalidate_file_digests(self.full_path)
+
+    def get(self, name: str) -> str:
+        """Returns global attribute, including changes not yet written."""
+        if name in self._attributes:
+            return self._attributes[name]
+        assert self._nc is not None
+        return str(getattr(self._nc, name))
+
+    def set(self, name: str, value: str) -> None:
+        """Sets global attribute when the file is finalized."""
+        self._attributes[name] = value
+
+    def add_global_attributes(
+        self,
+        instrument_pid: str | None = None,
+        input_fingerprint: str | None = None,
+    ) -> None:
+        """Add cloudnet-processing package version and variable digests to
+        file attributes."""
+        self.set("cloudnet_processing_version", cloudnet_processing_version)
         if instrument_pid:
-            nc.instrument_pid = instrument_pid
+            self.set("instrument_pid", instrument_pid)
+        if input_fingerprint:
+            self.set("input_fingerprint", input_fingerprint)
+        self._add_digests = True
+
+    def _write(self, nc: netCDF4.Dataset) -> None:
+        for name, value in self._attributes.items():
+            setattr(nc, name, value)
+        if self._add_digests:
+            setattr(nc, DIGESTS_ATTRIBUTE, json.dumps(variable_digests(nc)))
+        if self._summarize:
+            self.summary = read_product_summary(nc)
+            self.variables = list(nc.variables)
 
 
 def print_info(
@@ -232,20 +317,40 @@ def unzip_gz_file(path_in: Path) -> Iterable[Path]:
     path_out = path_in.parent / path_in.stem
     logging.debug(f"Decompressing {path_in} to {path_out}")
     with gzip.open(path_in, "rb") as file_in:
-        if path_out.suffix == ".tar":
-            with tarfile.TarFile(fileobj=file_in) as tar:
-                for tarinfo in tar:
-                    info_out = path_in.parent / tarinfo.name
-                    logging.debug("Extracting to %s", info_out)
-                    tar.extract(tarinfo, path_in.parent, filter="data")
-                    yield info_out
-        else:
-            with open(path_out, "wb") as file_out:
-                shutil.copyfileobj(file_in, file_out)
-            yield path_out
+        yield from extract_gz_stream(file_in, path_out)
     path_in.unlink()
 
 
+def try_unzip_gz_file(path_in: Path) -> tuple[list[Path], str | None]:
+    """Decompress file, returning the decompressed files and an error message
+    if the file cannot be fully decompressed. Files extracted before the error
+    are also returned."""
+    paths: list[Path] = []
+    try:
+        for path in unzip_gz_file(path_in):
+            paths.append(path)
+    except (EOFError, gzip.BadGzipFile, tarfile.TarError) as err:
+        return paths, str(err)
+    return paths, None
+
+
+def extract_gz_stream(file_in: gzip.GzipFile, path_out: Path) -> Iterable[Path]:
+    """Write decompressed stream to `path_out`, or extract it to the same
+    directory if `path_out` is a tar file. The stream is read sequentially,
+    so it can also be e.g. an HTTP response."""
+    if path_out.suffix == ".tar":
+        with tarfile.open(fileobj=file_in, mode="r|") as tar:
+            for tarinfo in tar:
+                info_out = path_out.parent / tarinfo.name
+                logging.debug("Extracting to %s", info_out)
+                tar.extract(tarinfo, path_out.parent, filter="data")
+                yield info_out
+    else:
+        with open(path_out, "wb") as file_out:
+            shutil.copyfileobj(file_in, file_out, 1024 * 1024)
+        yield path_out
+
+
 def create_product_put_payload(
     full_path: Path,
     file_info: StorageApiFileInfo,
@@ -253,51 +358,65 @@ def create_product_put_payload(
     volatile: bool,
     patch: bool,
     s3key: str | None,
+    summary: dict | None = None,
 ) -> dict:
-    """Creates put payload for data portal."""
-    with netCDF4.Dataset(full_path, "r") as nc:
-        start_time, stop_time = _get_data_timestamps(nc)
-        payload = {
-            "product": nc.cloudnet_file_type,
-            "site": site,
-            "measurementDate": f"{nc.year}-{nc.month}-{nc.day}",
-            "format": _get_file_format(nc),
-            "checksum": sha256sum(full_path),
-            "volatile": volatile,
-            "patch": patch,
-            "uuid": getattr(nc, "file_uuid", ""),
-            "pid": getattr(nc, "pid", ""),
-            "software": {"cloudnet-processing": cloudnet_processing_version},
-            "startTime": start_time,
-            "stopTime": stop_time,
-            "newBucket": True,
-            "s3key": s3key,
-            "version": file_info.version,
-            "size": file_info.size,
-        }
-        if instrument_pid := getattr(nc, "instrument_pid", None):
-            payload["instrumentPid"] = instrument_pid
-        if source_uuids := getattr(nc, "source_file_uuids", None):
-            payload["sourceFileIds"] = [
-                uuid.strip() for uuid in source_uuids.split(",")
-            ]
-        if version := getattr(nc, "cloudnetpy_version", None):
-            payload["software"]["cloudnetpy"] = version
-        if version := getattr(nc, "mwrpy_version", None):
-            payload["software"]["mwrpy"] = version
-        if version := getattr(nc, "doppy_version", None):
-            payload["software"]["doppy"] = version
-        if version := getattr(nc, "voodoonet_version", None):
-            payload["software"]["voodoonet"] = version
-        if version := getattr(nc, "model_munger_version", None):
-            payload["software"]["model-munger"] = version
-        if version := getattr(nc, "ceilopyter_version", None):
-            payload["software"]["ceilopyter"] = version
-        if version := getattr(nc, "earthcare_downloader_version", None):
-            payload["software"]["earthcare-downloader"] = version
+    """Creates put payload for data portal.
+
+    The file is read only if `summary` from `read_product_summary` is not
+    given.
+    """
+    if summary is None:
+        with netCDF4.Dataset(full_path, "r") as nc:
+            summary = read_product_summary(nc)
+    payload = {
+        **summary,
+        "site": site,
+        "checksum": file_digests(full_path).sha256_hex,
+        "volatile": volatile,
+        "patch": patch,
+        "newBucket": True,
+        "s3key": s3key,
+        "version": file_info.version,
+        "size": file_info.size,
+    }
+    payload["software"] = dict(summary["software"])
     return payload
 
 
+def read_product_summary(nc: netCDF4.Dataset) -> dict:
+    """Reads the data portal metadata stored in product file."""
+    start_time, stop_time = _get_data_timestamps(nc)
+    summary: dict = {
+        "product": nc.cloudnet_file_type,
+        "measurementDate": f"{nc.year}-{nc.month}-{nc.day}",
+        "format": _get_file_format(nc),
+        "uuid": getattr(nc, "file_uuid", ""),
+        "pid": getattr(nc, "pid", ""),
+        "software": {"cloudnet-processing": cloudnet_processing_version},
+        "startTime": start_time,
+        "stopTime": stop_time,
+    }
+    if instrument_pid := getattr(nc, "instrument_pid", None):
+        summary["instrumentPid"] = instrument_pid
+    if source_uuids := getattr(nc, "source_file_uuids", None):
+        summary["sourceFileIds"] = [uuid.strip() for uuid in source_uuids.split(",")]
+    if version := getattr(nc, "cloudnetpy_version", None):
+        summary["software"]["cloudnetpy"] = version
+    if version := getattr(nc, "mwrpy_version", None):
+        summary["software"]["mwrpy"] = version
+    if version := getattr(nc, "doppy_version", None):
+        summary["software"]["doppy"] = version
+    if version := getattr(nc, "voodoonet_version", None):
+        summary["software"]["voodoonet"] = version
+    if version := getattr(nc, "model_munger_version", None):
+        summary["software"]["model-munger"] = version
+    if version := getattr(nc, "ceilopyter_version", None):
+        summary["software"]["ceilopyter"] = version
+    if version := getattr(nc, "earthcare_downloader_version", None):
+        summary["software"]["earthcare-downloader"] = version
+    return summary
+
+
 def _get_file_format(nc: netCDF4.Dataset) -> str:
     """Returns netCDF file format."""
     file_format = nc.file_format.lower()
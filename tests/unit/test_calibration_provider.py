@@ -0,0 +1,53 @@
+import datetime
+
+import pytest
+from cloudnet_api_client import APIClient, CloudnetAPIError
+
+from processing.processor import CalibrationProvider
+
+DATE = datetime.date(2024, 6, 1)
+
+
+class FakeClient(APIClient):
+    def __init__(self) -> None:
+        self.requests: list[datetime.date] = []
+
+    def calibration(self, instrument_pid: str, date: datetime.date | str) -> dict:
+        assert isinstance(date, datetime.date)
+        self.requests.append(date)
+        if date > DATE:
+            raise CloudnetAPIError("Not found")
+        return {"data": {"time_offset": date.day}}
+
+
+def test_fetches_once_per_date() -> None:
+    client = FakeClient()
+    provider = CalibrationProvider(client, "pid", DATE)
+    assert provider.get() == {"data": {"time_offset": 1}}
+    assert provider.get(DATE) == {"data": {"time_offset": 1}}
+    assert client.requests == [DATE]
+
+
+def test_missing_calibration_is_memoized() -> None:
+    client = FakeClient()
+    provider = CalibrationProvider(client, "pid", DATE)
+    next_date = DATE + datetime.timedelta(days=1)
+    for _ in range(2):
+        with pytest.raises(CloudnetAPIError):
+            provider.get(next_date)
+    assert client.requests == [next_date]
+
+
+def test_prefetch() -> None:
+    client = FakeClient()
+    provider = CalibrationProvider(client, "pid", DATE)
+    previous_date = DATE - datetime.timedelta(days=1)
+    next_date = DATE + datetime.timedelta(days=1)
+    provider.prefetch([previous_date, DATE, next_date])
+    assert sorted(client.requests) == [previous_date, DATE, next_date]
+    assert provider.get(previous_date) == {"data": {"time_offset": 31}}
+    assert provider.get() == {"data": {"time_offset": 1}}
+    with pytest.raises(CloudnetAPIError):
+        provider.get(next_date)
+    provider.prefetch([DATE])
+    assert len(client.requests) == 3
@@ -0,0 +1,99 @@
+import threading
+import time
+import uuid
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from processing.product import _download_level1b_products_for_categorize
+from processing.utils import SkipTaskError
+
+
+class FakeStorageApi:
+    def __init__(self) -> None:
+        self.downloads: list = []
+        self.cancels: list[threading.Event] = []
+
+    def download_product_untracked(
+        self, metadata: SimpleNamespace, dir_name: Path, cancel: threading.Event
+    ) -> tuple[Path, int]:
+        self.downloads.append(metadata)
+        self.cancels.append(cancel)
+        return dir_name / metadata.filename, 100
+
+
+class FakeProcessor:
+    def __init__(self, products: dict) -> None:
+        self.products = products
+        self.storage_api = FakeStorageApi()
+
+    def get_product(self, params: object, product_id: str) -> object:
+        return self.products.get(product_id)
+
+    def find_instrument_product(
+        self, params: object, product_id: str, **kwargs: object
+    ) -> object:
+        return self.products.get(product_id)
+
+    def find_optimal_lidar(self, params: object) -> object:
+        lidar = self.products.get("lidar")
+        return lidar() if callable(lidar) else lidar
+
+
+def _meta(filename: str) -> SimpleNamespace:
+    return SimpleNamespace(uuid=uuid.uuid4(), filename=filename)
+
+
+def test_downloads_found_inputs(tmp_path: Path) -> None:
+    radar = _meta("radar.nc")
+    products = {"model": _meta("model.nc"), "radar": radar, "lidar": _meta("lidar.nc")}
+    processor = FakeProcessor(products)
+    meta_records, paths = _download_level1b_products_for_categorize(
+        processor,  # type: ignore[arg-type]
+        None,  # type: ignore[arg-type]
+        tmp_path,
+        is_voodoo=False,
+    )
+    assert meta_records == {
+        "model": products["model"],
+        "mwr": radar,
+        "radar": radar,
+        "lidar": products["lidar"],
+    }
+    assert paths["mwr"] == paths["radar"] == tmp_path / "radar.nc"
+    assert len(processor.storage_api.downloads) == 3
+
+
+def test_downloads_start_before_all_inputs_are_found(tmp_path: Path) -> None:
+    processor = FakeProcessor({"model": _meta("model.nc"), "radar": _meta("radar.nc")})
+
+    def find_lidar() -> SimpleNamespace:
+        # Fails unless the other inputs are downloaded while this one is still
+        # being resolved.
+        for _ in range(100):
+            if len(processor.storage_api.downloads) == 2:
+                return _meta("lidar.nc")
+            time.sleep(0.05)
+        raise AssertionError("Downloads did not start")
+
+    processor.products["lidar"] = find_lidar
+    meta_records, paths = _download_level1b_products_for_categorize(
+        processor,  # type: ignore[arg-type]
+        None,  # type: ignore[arg-type]
+        tmp_path,
+        is_voodoo=False,
+    )
+    assert paths["lidar"] == tmp_path / "lidar.nc"
+
+
+def test_missing_input_cancels_downloads(tmp_path: Path) -> None:
+    processor = FakeProcessor({"model": _meta("model.nc"), "radar": _meta("radar.nc")})
+    with pytest.raises(SkipTaskError, match="lidar"):
+        _download_level1b_products_for_categorize(
+            processor,  # type: ignore[arg-type]
+            None,  # type: ignore[arg-type]
+            tmp_path,
+            is_voodoo=False,
+        )
+    assert all(cancel.is_set() for cancel in processor.storage_api.cancels)
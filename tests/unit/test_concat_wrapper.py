@@ -0,0 +1,160 @@
+import datetime
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+import pytest
+from cloudnetpy import concat_lib as clib
+from cloudnetpy.utils import get_epoch, seconds2date
+from numpy import ma
+from numpy.testing import assert_array_equal
+
+from processing.concat_wrapper import (
+    TIME_BLOCK_SIZE,
+    _has_timestamps_on_date,
+    concat_netcdf_files,
+    concatenate_files,
+)
+
+DATE = datetime.date(2024, 6, 1)
+UNITS = "seconds since 2024-05-31 00:00:00"
+
+
+def _check(path: Path, time: np.ndarray) -> bool:
+    with netCDF4.Dataset(path, "w") as nc:
+        nc.createDimension("time", None)
+        var = nc.createVariable("time", "f8", ("time",))
+        var.units = UNITS
+        var[:] = time
+    with netCDF4.Dataset(path) as nc:
+        return _has_timestamps_on_date(nc.variables["time"], DATE)
+
+
+def _check_slowly(time: np.ndarray) -> bool:
+    epoch = get_epoch(UNITS)
+    return any(seconds2date(timestamp, epoch).date() == DATE for timestamp in time)
+
+
+DAY = 86400
+N = 3 * TIME_BLOCK_SIZE
+
+
+@pytest.mark.parametrize(
+    "time",
+    [
+        np.linspace(0, DAY - 1, N),
+        np.linspace(DAY, 2 * DAY - 1, N),
+        np.linspace(2 * DAY, 3 * DAY - 1, N),
+        np.linspace(DAY - 600, DAY + 600, N),
+        np.linspace(2 * DAY - 600, 2 * DAY + 600, N),
+        np.linspace(DAY - 1, DAY - 0.5, 10),
+        np.array([DAY - 1, 2 * DAY]),
+        np.array([2 * DAY, 0]),
+        np.concatenate([np.zeros(N), [DAY + 60], np.zeros(N)]),
+    ],
+)
+def test_has_timestamps_on_date(tmp_path: Path, time: np.ndarray) -> None:
+    assert _check(tmp_path / "file.nc", time) == _check_slowly(time)
+
+
+def _create_raw_file(path: Path, hour: int, n_range: int = 50) -> Path:
+    rng = np.random.default_rng(abs(hour))
+    n_time = 120
+    with netCDF4.Dataset(path, "w", format="NETCDF4") as nc:
+        nc.title = f"File {hour}"
+        nc.createDimension("time", None)
+        nc.createDimension("range", n_range)
+        time = nc.createVariable("time", "f8", ("time",))
+        time.units = UNITS
+        time[:] = DAY + hour * 3600 + np.arange(n_time) * 30
+        range_var = nc.createVariable("range", "f4", ("range",))
+        range_var.units = "m"
+        range_var[:] = np.arange(n_range) * 10 + hour
+        beta = nc.createVariable(
+            "beta_att", "f4", ("time", "range"), chunksizes=(16, n_range)
+        )
+        beta.units = "sr-1 m-1"
+        data = ma.masked_array(rng.random((n_time, n_range)), dtype="f4")
+        data[data > 0.9] = ma.masked
+        beta[:] = data
+        x_pol = nc.createVariable(
+            "x_pol", "i2", ("time", "range"), fill_value=-999, chunksizes=(7, n_range)
+        )
+        x_pol.scale_factor = 0.01
+        x_pol[:] = rng.random((n_time, n_range))
+        tilt = nc.createVariable("tilt_angle", "f4")
+        tilt[:] = hour
+        extra = nc.createVariable("extra", "f4", ("time",))
+        extra[:] = 1
+    return path
+
+
+def _assert_same_files(path1: Path, path2: Path) -> None:
+    with netCDF4.Dataset(path1) as nc1, netCDF4.Dataset(path2) as nc2:
+        nc1.set_auto_scale(False)
+        nc2.set_auto_scale(False)
+        assert nc1.data_model == nc2.data_model
+        assert nc1.__dict__ == nc2.__dict__
+        assert {key: dim.size for key, dim in nc1.dimensions.items()} == {
+            key: dim.size for key, dim in nc2.dimensions.items()
+        }
+        assert nc1.variables.keys() == nc2.variables.keys()
+        for key, var1 in nc1.variables.items():
+            var2 = nc2.variables[key]
+            assert var1.dimensions == var2.dimensions
+            assert var1.dtype == var2.dtype
+            assert var1.__dict__ == var2.__dict__
+            assert_array_equal(var1[:].filled(), var2[:].filled())
+
+
+@pytest.mark.parametrize("memory_budget", [1000, 100_000_000])
+def test_concatenate_files(tmp_path: Path, memory_budget: int) -> None:
+    files = [
+        _create_raw_file(tmp_path / "file_02.nc", 2),
+        _create_raw_file(tmp_path / "file_00.nc", 0),
+        _create_raw_file(tmp_path / "file_01.nc", 1, n_range=40),
+    ]
+    variables = ["time", "beta_att", "x_pol", "tilt_angle"]
+    expected = tmp_path / "expected.nc"
+    clib.concatenate_files(files, expected, variables=variables)
+    output = tmp_path / "output.nc"
+    valid_files = concatenate_files(
+        files, output, variables=variables, memory_budget=memory_budget
+    )
+    assert valid_files == sorted(files)
+    _assert_same_files(output, expected)
+
+
+def test_concatenate_files_with_time_offsets(tmp_path: Path) -> None:
+    files = [_create_raw_file(tmp_path / f"file_{i}.nc", i) for i in range(3)]
+    offsets = {
+        files[0]: datetime.timedelta(hours=2),
+        files[2]: -datetime.timedelta(hours=1),
+    }
+    output = tmp_path / "output.nc"
+    concatenate_files(files, output, time_offsets=offsets)
+    for path, offset in offsets.items():
+        with netCDF4.Dataset(path, "a") as nc:
+            nc.variables["time"][:] -= offset.total_seconds()
+    expected = tmp_path / "expected.nc"
+    clib.concatenate_files(files, expected)
+    _assert_same_files(output, expected)
+
+
+def test_concat_netcdf_files_with_time_offsets(tmp_path: Path) -> None:
+    previous = _create_raw_file(tmp_path / "20240531_2300.nc", -1)
+    current = _create_raw_file(tmp_path / "20240601_0000.nc", 0)
+    output = tmp_path / "output.nc"
+    valid_files = concat_netcdf_files([previous, current], DATE, output)
+    assert valid_files == [current]
+    offset = -datetime.timedelta(hours=1)
+    valid_files = concat_netcdf_files(
+        [previous, current],
+        DATE,
+        output,
+        time_offsets={previous: offset, current: offset},
+    )
+    assert valid_files == [previous, current]
+    with netCDF4.Dataset(output) as nc, netCDF4.Dataset(previous) as nc_previous:
+        assert nc.variables["time"][0] == DAY
+        assert nc_previous.variables["time"][0] == DAY - 3600
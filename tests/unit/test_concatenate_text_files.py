@@ -0,0 +1,66 @@
+import datetime
+import shutil
+from pathlib import Path
+
+import pytest
+from cloudnetpy.utils import is_timestamp
+
+from processing.instrument_process import _concatenate_text_files
+
+OFFSET = datetime.timedelta(hours=2)
+
+
+def _concatenate_and_shift_slowly(filenames: list[Path], output: Path) -> None:
+    with open(output, "wb") as target:
+        for filename in filenames:
+            with open(filename, "rb") as source:
+                shutil.copyfileobj(source, target)
+    with open(output, "r") as file:
+        lines = file.readlines()
+    for ind, line in enumerate(lines):
+        if is_timestamp(line):
+            date_time = line.strip("-").strip("\n")
+            dt = datetime.datetime.strptime(date_time, "%Y-%m-%d %H:%M:%S")
+            lines[ind] = f"-{dt - OFFSET:%Y-%m-%d %H:%M:%S}\n"
+    with open(output, "w") as file:
+        file.writelines(lines)
+
+
+MESSAGE = b"\x01CL010231\x02\r\n20 00100 ///// ///// ///// 00000002\r\n\x03\r\n"
+
+
+@pytest.mark.parametrize(
+    "contents",
+    [
+        [
+            b"-2024-06-01 00:00:15\r\n" + MESSAGE + b"-2024-06-01 01:00:00\r\n",
+            b"-2024-06-01 23:59:59\n" + MESSAGE + b"\r\n",
+        ],
+        [b"-2024-06-01 00:00:15\r", b"\n" + MESSAGE + b"\r-2024-06-01 00:00:30"],
+        [
+            b"-2024-06-01 00:00:15\ntext -2024-06-01 00:00:15\n--2024-06-01 00:00:15\n",
+            b"\r\r\n\n",
+        ],
+    ],
+)
+def test_concatenate_text_files(tmp_path: Path, contents: list[bytes]) -> None:
+    filenames = []
+    for ind, content in enumerate(contents):
+        filename = tmp_path / f"file{ind}.dat"
+        filename.write_bytes(content)
+        filenames.append(filename)
+    output = tmp_path / "output.dat"
+    _concatenate_text_files(filenames, output, OFFSET)
+    expected = tmp_path / "expected.dat"
+    _concatenate_and_shift_slowly(filenames, expected)
+    assert output.read_bytes() == expected.read_bytes()
+    assert b"-2024-05-31 22:00:15\n" in output.read_bytes()
+
+
+def test_concatenate_without_offset(tmp_path: Path) -> None:
+    filenames = [tmp_path / "file1.dat", tmp_path / "file2.dat"]
+    filenames[0].write_bytes(b"-2024-06-01 00:00:15\r\n")
+    filenames[1].write_bytes(MESSAGE)
+    output = tmp_path / "output.dat"
+    _concatenate_text_files(filenames, output)
+    assert output.read_bytes() == b"-2024-06-01 00:00:15\r\n" + MESSAGE
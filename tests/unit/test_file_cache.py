@@ -0,0 +1,99 @@
+import hashlib
+import os
+from pathlib import Path
+
+import pytest
+
+from processing.file_cache import FileCache
+
+
+def _write(path: Path, size: int) -> Path:
+    path.write_bytes(os.urandom(size))
+    return path
+
+
+def _insert(cache: FileCache, path: Path) -> str:
+    checksum = hashlib.sha256(path.read_bytes()).hexdigest()
+    cache.insert(path, checksum, "sha256")
+    return checksum
+
+
+def test_fetch(tmp_path: Path) -> None:
+    cache = FileCache(tmp_path / "cache", max_size=1000)
+    src = _write(tmp_path / "src", 100)
+    checksum = hashlib.sha256(src.read_bytes()).hexdigest()
+    dst = tmp_path / "dst"
+    assert not cache.fetch(checksum, "sha256", dst)
+    assert not dst.exists()
+    _insert(cache, src)
+    assert cache.fetch(checksum, "sha256", dst)
+    assert dst.read_bytes() == src.read_bytes()
+    assert cache.fetch(checksum, "sha256", dst, size=100)
+    assert not cache.fetch(checksum, "md5", dst)
+
+
+def test_cached_file_is_independent_copy(tmp_path: Path) -> None:
+    cache = FileCache(tmp_path / "cache", max_size=1000)
+    src = _write(tmp_path / "src", 100)
+    content = src.read_bytes()
+    checksum = _insert(cache, src)
+    src.write_bytes(b"modified")
+    dst = tmp_path / "dst"
+    assert cache.fetch(checksum, "sha256", dst)
+    assert dst.read_bytes() == content
+    dst.write_bytes(b"modified")
+    assert cache.fetch(checksum, "sha256", dst)
+    assert dst.read_bytes() == content
+
+
+def test_evicts_least_recently_used(tmp_path: Path) -> None:
+    cache = FileCache(tmp_path / "cache", max_size=250)
+    dst = tmp_path / "dst"
+    checksums = []
+    for i, name in enumerate(["aa", "bb"]):
+        checksums.append(_insert(cache, _write(tmp_path / name, 100)))
+        os.utime(cache._path(checksums[-1], "sha256"), (i, i))
+    aa, bb = checksums
+    assert cache.fetch(aa, "sha256", dst)
+    cc = _insert(cache, _write(tmp_path / "cc", 100))
+    assert cache.fetch(aa, "sha256", dst)
+    assert not cache.fetch(bb, "sha256", dst)
+    assert cache.fetch(cc, "sha256", dst)
+
+
+def test_scans_only_when_full(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    cache = FileCache(tmp_path / "cache", max_size=250)
+    n_scans = 0
+    evict = cache._evict
+
+    def counting_evict() -> None:
+        nonlocal n_scans
+        n_scans += 1
+        evict()
+
+    monkeypatch.setattr(cache, "_evict", counting_evict)
+    _insert(cache, _write(tmp_path / "aa", 100))
+    assert n_scans == 1  # Total size is not known yet.
+    _insert(cache, _write(tmp_path / "bb", 100))
+    assert n_scans == 1
+    _insert(cache, _write(tmp_path / "cc", 100))
+    assert n_scans == 2
+    assert cache._size_path.read_text() == "200"
+
+
+@pytest.mark.parametrize("corrupt", [b"truncated", os.urandom(100)])
+def test_invalid_file_is_removed(tmp_path: Path, corrupt: bytes) -> None:
+    cache = FileCache(tmp_path / "cache", max_size=1000)
+    checksum = _insert(cache, _write(tmp_path / "src", 100))
+    cache._path(checksum, "sha256").write_bytes(corrupt)
+    assert not cache.fetch(checksum, "sha256", tmp_path / "dst", size=100)
+    assert not cache._path(checksum, "sha256").exists()
+    assert cache._size_path.read_text() == str(100 - len(corrupt))
+
+
+def test_no_temporary_files_left(tmp_path: Path) -> None:
+    cache = FileCache(tmp_path / "cache", max_size=1000)
+    _insert(cache, _write(tmp_path / "src", 100))
+    cache.insert(tmp_path / "missing", "efgh", "sha256")
+    assert list((tmp_path / "cache" / "tmp").iterdir()) == []
+    assert not cache.fetch("efgh", "sha256", tmp_path / "dst")
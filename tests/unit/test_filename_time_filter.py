@@ -0,0 +1,100 @@
+import datetime
+from dataclasses import dataclass, field
+from uuid import UUID, uuid4
+
+from processing.processor import _remove_files_outside_window
+
+DATE = datetime.date(2024, 6, 1)
+
+
+@dataclass
+class Meta:
+    filename: str
+    measurement_date: datetime.date
+    uuid: UUID = field(default_factory=uuid4)
+
+
+def _hourly_files(date: datetime.date, template: str) -> list[Meta]:
+    return [
+        Meta(template.format(f"{date:%Y%m%d}_{hour:02}0000"), date)
+        for hour in range(24)
+    ]
+
+
+def _filter(metadata: list[Meta], offset_hours: int) -> list[str]:
+    offset = datetime.timedelta(hours=offset_hours)
+    start = datetime.datetime.combine(DATE, datetime.time()) + offset
+    end = start + datetime.timedelta(days=1)
+    return [
+        meta.filename
+        for meta in _remove_files_outside_window(
+            metadata,  # type: ignore[arg-type]
+            start,
+            end,
+            keep_dates=(DATE, DATE),
+        )
+    ]
+
+
+def test_previous_date() -> None:
+    previous_date = DATE - datetime.timedelta(days=1)
+    metadata = _hourly_files(previous_date, "live_{}.nc") + _hourly_files(
+        DATE, "live_{}.nc"
+    )
+    filenames = _filter(metadata, -2)
+    # Local 22-24 is UTC 00-02, and one file more due to the margin.
+    assert filenames[:3] == [
+        "live_20240531_210000.nc",
+        "live_20240531_220000.nc",
+        "live_20240531_230000.nc",
+    ]
+    assert len(filenames) == 3 + 24
+
+
+def test_next_date() -> None:
+    next_date = DATE + datetime.timedelta(days=1)
+    metadata = _hourly_files(DATE, "live_{}.nc") + _hourly_files(
+        next_date, "live_{}.nc"
+    )
+    filenames = _filter(metadata, 2)
+    assert filenames[24:] == [
+        "live_20240602_000000.nc",
+        "live_20240602_010000.nc",
+        "live_20240602_020000.nc",
+    ]
+
+
+def test_series_are_separate() -> None:
+    previous_date = DATE - datetime.timedelta(days=1)
+    metadata = [
+        Meta("20240531.brt", previous_date),
+        Meta("240531_000000_P06_ZEN.LV1", previous_date),
+        Meta("240531_120000_P06_ZEN.LV1", previous_date),
+        Meta("240531_000000.LWP", previous_date),
+        Meta("240601_000000_P06_ZEN.LV1", DATE),
+    ]
+    assert _filter(metadata, -1) == [
+        "20240531.brt",
+        "240531_120000_P06_ZEN.LV1",
+        "240531_000000.LWP",
+        "240601_000000_P06_ZEN.LV1",
+    ]
+
+
+def test_timestamps_far_from_measurement_date_are_ignored() -> None:
+    previous_date = DATE - datetime.timedelta(days=1)
+    metadata = [Meta("serial_20190101_0000.nc", previous_date)]
+    assert _filter(metadata, -1) == ["serial_20190101_0000.nc"]
+
+
+def test_window_without_kept_dates() -> None:
+    previous_date = DATE - datetime.timedelta(days=1)
+    metadata = _hourly_files(previous_date, "live_{}.nc")
+    end = datetime.datetime.combine(DATE, datetime.time())
+    start = end - datetime.timedelta(hours=2)
+    filtered = _remove_files_outside_window(metadata, start, end)  # type: ignore[arg-type]
+    assert [meta.filename for meta in filtered] == [
+        "live_20240531_210000.nc",
+        "live_20240531_220000.nc",
+        "live_20240531_230000.nc",
+    ]
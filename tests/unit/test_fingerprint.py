@@ -0,0 +1,160 @@
+import datetime
+import uuid
+from dataclasses import replace
+from pathlib import Path
+
+import netCDF4
+import pytest
+from cloudnet_api_client import APIClient, CloudnetAPIError
+from cloudnet_api_client.containers import ExtendedProduct, Instrument, Site
+
+from processing.fingerprint import (
+    FingerprintStore,
+    compute_input_fingerprint,
+    read_input_fingerprint,
+)
+from processing.processor import CalibrationProvider, InstrumentParams
+from processing.utils import FileFinalizer
+
+SITE = Site(
+    id="hyytiala",
+    human_readable_name="Hyytiälä",
+    station_name=None,
+    latitude=61.844,
+    longitude=24.287,
+    altitude=174,
+    dvas_id=None,
+    actris_id=None,
+    country="Finland",
+    country_code="FI",
+    country_subdivision_code=None,
+    type=frozenset(["cloudnet"]),
+    gaw=None,
+)
+PRODUCT = ExtendedProduct(
+    id="lidar",
+    human_readable_name="Lidar",
+    type=frozenset(["instrument"]),
+    experimental=False,
+    source_instrument_ids=frozenset(["chm15k"]),
+    source_product_ids=frozenset(),
+    derived_product_ids=frozenset(),
+)
+INSTRUMENT = Instrument(
+    instrument_id="chm15k",
+    model="CHM 15k",
+    type="lidar",
+    name="Hyytiälä CHM 15k",
+    uuid=uuid.uuid4(),
+    pid="https://hdl.handle.net/123/abc",
+    owners=(),
+    serial_number=None,
+)
+PARAMS = InstrumentParams(
+    site=SITE, date=datetime.date(2024, 6, 1), product=PRODUCT, instrument=INSTRUMENT
+)
+
+
+class RawFile:
+    def __init__(self, checksum: str) -> None:
+        self.uuid = uuid.uuid4()
+        self.checksum = checksum
+
+
+class FakeClient(APIClient):
+    def __init__(self) -> None:
+        self.raw = [RawFile("a"), RawFile("b")]
+        self.calibrations: dict = {}
+        self.calibration_requests: list = []
+        self.raw_dates: list = []
+
+    def raw_files(self, *args: object, **kwargs: object) -> list:  # type: ignore[override]
+        self.raw_dates.append((kwargs["date_from"], kwargs["date_to"]))
+        return self.raw
+
+    def calibration(self, instrument_pid: str, date: datetime.date | str) -> dict:
+        self.calibration_requests.append(date)
+        if date not in self.calibrations:
+            raise CloudnetAPIError("Not found")
+        return self.calibrations[date]
+
+
+def test_same_inputs() -> None:
+    client = FakeClient()
+    fingerprint = compute_input_fingerprint(client, PARAMS)
+    assert fingerprint is not None
+    assert compute_input_fingerprint(client, PARAMS) == fingerprint
+    client.raw.reverse()
+    assert compute_input_fingerprint(client, PARAMS) == fingerprint
+
+
+def test_changed_inputs() -> None:
+    client = FakeClient()
+    fingerprint = compute_input_fingerprint(client, PARAMS)
+    client.raw[0].checksum = "c"
+    assert compute_input_fingerprint(client, PARAMS) != fingerprint
+    fingerprint = compute_input_fingerprint(client, PARAMS)
+    client.calibrations[PARAMS.date] = {"data": {"calibration_factor": 1}}
+    assert compute_input_fingerprint(client, PARAMS) != fingerprint
+
+
+def test_calibration_is_shared_with_processing() -> None:
+    client = FakeClient()
+    calibration = CalibrationProvider(client, INSTRUMENT.pid, PARAMS.date)
+    compute_input_fingerprint(client, PARAMS, calibration)
+    with pytest.raises(CloudnetAPIError):
+        calibration.get()
+    assert client.calibration_requests == [PARAMS.date]
+
+
+def test_raw_dates() -> None:
+    client = FakeClient()
+    day = datetime.timedelta(days=1)
+    compute_input_fingerprint(client, PARAMS)
+    client.calibrations[PARAMS.date] = {"data": {"time_offset": -120}}
+    compute_input_fingerprint(client, PARAMS)
+    client.calibrations[PARAMS.date] = {"data": {"time_offset": 60}}
+    compute_input_fingerprint(client, PARAMS)
+    cl61d = replace(INSTRUMENT, instrument_id="cl61d")
+    compute_input_fingerprint(client, replace(PARAMS, instrument=cl61d))
+    assert client.raw_dates == [
+        (PARAMS.date, PARAMS.date),
+        (PARAMS.date - day, PARAMS.date),
+        (PARAMS.date, PARAMS.date + day),
+        (PARAMS.date - day, PARAMS.date + day),
+    ]
+
+
+def test_unsupported() -> None:
+    client = FakeClient()
+    params = replace(PARAMS, product=replace(PRODUCT, id="mwr-single"))
+    assert compute_input_fingerprint(client, params) is None
+    client.raw = []
+    assert compute_input_fingerprint(client, PARAMS) is None
+
+
+def test_read_from_file(tmp_path: Path) -> None:
+    path = tmp_path / "file.nc"
+    netCDF4.Dataset(path, "w").close()
+    assert read_input_fingerprint(path) is None
+    with FileFinalizer(path) as finalizer:
+        finalizer.add_global_attributes(input_fingerprint="abc")
+    assert read_input_fingerprint(path) == "abc"
+
+
+def test_store(tmp_path: Path) -> None:
+    store = FingerprintStore(tmp_path / "fingerprints")
+    assert store.enabled
+    assert store.get("ab12") is None
+    store.put("ab12", "fingerprint")
+    store.put("cd34", None)
+    assert store.get("ab12") == "fingerprint"
+    assert store.get("cd34") is None
+    assert FingerprintStore(tmp_path / "fingerprints").get("ab12") == "fingerprint"
+
+
+def test_store_without_directory() -> None:
+    store = FingerprintStore(None)
+    assert not store.enabled
+    store.put("ab12", "fingerprint")
+    assert store.get("ab12") is None
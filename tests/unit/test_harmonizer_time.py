@@ -0,0 +1,137 @@
+import datetime
+from pathlib import Path
+
+import cloudnetpy.exceptions
+import cloudnetpy.utils
+import netCDF4
+import numpy as np
+import pytest
+from numpy import ma
+from numpy.testing import assert_array_equal
+
+from processing.harmonizer.core import Level1Nc
+from processing.harmonizer.hatpro import HatproNc
+
+DATE = datetime.date(2024, 6, 1)
+
+
+def _valid_time_indices_slowly(time_stamps: np.ndarray, units: str) -> list:
+    raw_time_stamps = time_stamps.copy()
+    if "seconds" in units:
+        time_stamps = np.array(cloudnetpy.utils.seconds2hours(time_stamps))
+    max_time = 1440 if "minutes" in units else 24
+    valid_ind: list[int] = []
+    for ind, t in enumerate(time_stamps):
+        if 0 <= t < max_time:
+            if t < 0 or raw_time_stamps[ind] < 0:
+                continue
+            if len(valid_ind) > 0 and t <= time_stamps[valid_ind[-1]]:
+                continue
+            valid_ind.append(ind)
+    return valid_ind
+
+
+def _hatpro_timestamps_slowly(time_stamps: np.ndarray, units: str) -> list:
+    epoch = datetime.datetime.fromisoformat(f"{units.split()[2]}T00:00:00+00:00")
+    valid_ind = []
+    for t_ind, t in enumerate(time_stamps):
+        if (0 < t < 24 and epoch.date() == DATE) or (
+            cloudnetpy.utils.seconds2date(t, epoch).date() == DATE
+        ):
+            valid_ind.append(t_ind)
+    _, ind = np.unique(time_stamps[valid_ind], return_index=True)
+    return list(np.array(valid_ind)[ind])
+
+
+def _write_time(path: Path, time: np.ndarray, units: str) -> netCDF4.Dataset:
+    with netCDF4.Dataset(path, "w") as nc:
+        nc.createDimension("time", len(time))
+        var = nc.createVariable("time", "f8", ("time",))
+        var.units = units
+        var[:] = time
+    return netCDF4.Dataset(path)
+
+
+TIMES = [
+    np.arange(0, 24, 0.01),
+    np.array([1, 2, 2, 3, 1.5, 4, 30, 5, -1, 6]),
+    np.concatenate([np.arange(12, 24, 0.5), np.arange(0, 12, 0.5)]),
+]
+
+
+@pytest.mark.parametrize("time", TIMES)
+@pytest.mark.parametrize(
+    "units",
+    [
+        "hours since 2024-06-01 00:00:00",
+        "seconds since 2024-06-01 00:00:00",
+        "minutes since 2024-06-01 00:00:00",
+    ],
+)
+def test_get_valid_time_indices(tmp_path: Path, time: np.ndarray, units: str) -> None:
+    if "hours" not in units:
+        time = time * 60 if "minutes" in units else time * 3600
+    with _write_time(tmp_path / "file.nc", time, units) as nc_raw:
+        valid_ind = Level1Nc(nc_raw, nc_raw, {}).get_valid_time_indices()
+        expected = _valid_time_indices_slowly(nc_raw.variables["time"][:], units)
+    assert_array_equal(valid_ind, expected)
+
+
+def test_get_valid_time_indices_without_valid_data(tmp_path: Path) -> None:
+    units = "hours since 2024-06-01 00:00:00"
+    with _write_time(tmp_path / "file.nc", np.array([1, 0.5, -1]), units) as nc_raw:
+        with pytest.raises(cloudnetpy.exceptions.ValidTimeStampError):
+            Level1Nc(nc_raw, nc_raw, {}).get_valid_time_indices()
+
+
+@pytest.mark.parametrize(
+    "time, units",
+    [
+        (np.arange(-3600, 90000, 60.0), "seconds since 2024-06-01 00:00:00"),
+        (np.array([3, 1, 2, 1, 25, 0]), "hours since 2024-06-01 00:00:00"),
+        (
+            np.array([86400 * 2, 86400 * 3 - 1, 10, 86400 * 2.5, 86400 * 3]),
+            "seconds since 2024-05-30 00:00:00",
+        ),
+    ],
+)
+def test_hatpro_valid_timestamps(tmp_path: Path, time: np.ndarray, units: str) -> None:
+    with _write_time(tmp_path / "file.nc", time, units) as nc_raw:
+        hatpro = HatproNc(nc_raw, nc_raw, {"date": DATE})
+        valid_ind = hatpro._get_valid_timestamps()
+        expected = _hatpro_timestamps_slowly(nc_raw.variables["time"][:], units)
+    assert_array_equal(valid_ind, expected)
+
+
+@pytest.mark.parametrize(
+    "time_ind, expected",
+    [
+        (np.array([2, 3, 4]), slice(2, 5)),
+        (np.array([2, 4, 5]), np.array([2, 4, 5])),
+        (np.array([1, 0, 2]), np.array([1, 0, 2])),
+        (np.array([], dtype=int), np.array([], dtype=int)),
+    ],
+)
+def test_time_selection(time_ind: np.ndarray, expected: slice | np.ndarray) -> None:
+    selection = Level1Nc._time_selection(time_ind)
+    if isinstance(expected, slice):
+        assert selection == expected
+    else:
+        assert_array_equal(selection, expected)
+
+
+def test_screen_data_with_slice(tmp_path: Path) -> None:
+    path = tmp_path / "file.nc"
+    values = np.arange(20).reshape(10, 2)
+    mask = values % 3 == 0
+    data = ma.masked_array(values, mask=mask)
+    with netCDF4.Dataset(path, "w") as nc:
+        nc.createDimension("time", 10)
+        nc.createDimension("range", 2)
+        nc.createVariable("data", "f4", ("time", "range"))[:] = data
+    with netCDF4.Dataset(path) as nc:
+        variable = nc.variables["data"]
+        for time_ind in (np.arange(3, 8), np.array([0, 4, 5, 9])):
+            screened = Level1Nc._screen_data(variable, time_ind)
+            assert_array_equal(ma.getmaskarray(screened), mask[time_ind])
+            assert_array_equal(ma.compressed(screened), ma.compressed(data[time_ind]))
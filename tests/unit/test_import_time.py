@@ -0,0 +1,54 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+WORKER_PATH = Path(__file__).parents[2] / "scripts" / "worker.py"
+
+# Loaded only by the code paths that need them.
+HEAVY_MODULES = [
+    "torch",
+    "matplotlib",
+    "scipy",
+    "cloudnetpy.categorize",
+    "cloudnetpy.instruments",
+    "cloudnetpy.plotting",
+    "cloudnetpy.products",
+    "cloudnetpy_qc",
+    "doppy",
+    "earthcare_downloader",
+    "housekeeping",
+    "model_munger",
+    "orbital_radar",
+    "processing.instrument_process",
+]
+
+SCRIPT = """
+import importlib.util
+import json
+import sys
+
+spec = importlib.util.spec_from_file_location("worker", sys.argv[1])
+worker = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(worker)
+print(json.dumps(list(sys.modules)))
+"""
+
+
+def _import_worker() -> list[str]:
+    output = subprocess.check_output(
+        [sys.executable, "-c", SCRIPT, str(WORKER_PATH)], text=True
+    )
+    return json.loads(output)
+
+
+def test_worker_does_not_import_heavy_modules() -> None:
+    modules = _import_worker()
+    loaded = [
+        module
+        for module in modules
+        if any(
+            module == heavy or module.startswith(f"{heavy}.") for heavy in HEAVY_MODULES
+        )
+    ]
+    assert loaded == []
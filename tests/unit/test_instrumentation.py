@@ -0,0 +1,91 @@
+import json
+import logging
+import threading
+import time
+
+import pytest
+
+from processing import instrumentation, pipeline
+
+
+def test_nested_phases_are_exclusive() -> None:
+    with instrumentation.task({"id": "1"}) as record:
+        with instrumentation.phase("convert"):
+            time.sleep(0.02)
+            with instrumentation.phase("download"):
+                time.sleep(0.05)
+                instrumentation.add_downloaded(100)
+            time.sleep(0.02)
+    metrics = record.as_dict()
+    phases = metrics["phases"]
+    assert {"convert", "download"} <= phases.keys()
+    assert all(t >= 0 for t in phases.values())
+    assert phases["download"] >= 0.05
+    assert phases["convert"] >= 0.04
+    # Nested time is not counted twice. Each value is rounded to 1 ms.
+    assert sum(phases.values()) <= metrics["wall_time"] + 0.001 * len(phases)
+    assert record.bytes_downloaded == 100
+
+
+def test_phase_as_decorator() -> None:
+    @instrumentation.phase("qc")
+    def run_qc() -> None:
+        time.sleep(0.01)
+
+    with instrumentation.task({"id": "1"}) as record:
+        run_qc()
+        run_qc()
+    assert record.as_dict()["phases"]["qc"] >= 0.02
+
+
+def test_request_phase_inside_upload() -> None:
+    with instrumentation.task({"id": "1"}) as record:
+        with instrumentation.phase("upload"):
+            with instrumentation.request_phase():
+                time.sleep(0.01)
+        with instrumentation.request_phase():
+            pass
+    metrics = record.as_dict()
+    phases = metrics["phases"]
+    assert {"upload", "metadata"} <= phases.keys()
+    assert phases["upload"] >= 0.01
+    assert phases["metadata"] >= 0
+    assert sum(phases.values()) <= metrics["wall_time"] + 0.001 * len(phases)
+
+
+def test_logs_json_record(caplog: pytest.LogCaptureFixture) -> None:
+    task = {"id": "1", "type": "process", "siteId": "hyytiala"}
+    with caplog.at_level(logging.INFO):
+        with instrumentation.task(task) as record:
+            record.status = "complete"
+    prefix = "Task metrics: "
+    messages = [r.message for r in caplog.records if r.message.startswith(prefix)]
+    assert len(messages) == 1
+    metrics = json.loads(messages[0].removeprefix(prefix))
+    assert metrics["task_id"] == "1"
+    assert metrics["site"] == "hyytiala"
+    assert metrics["status"] == "complete"
+    assert metrics["cpu_time"] >= 0
+    assert metrics["process_max_rss_mb"] > 0
+
+
+def test_pipeline_cpu_time_excludes_other_threads(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(pipeline, "_slot", threading.Lock())
+
+    def busy() -> None:
+        start = time.thread_time()
+        while time.thread_time() - start < 0.2:
+            pass
+
+    with instrumentation.task({"id": "1"}) as record:
+        thread = threading.Thread(target=busy)
+        thread.start()
+        thread.join()
+    assert record.as_dict()["cpu_time"] < 0.2
+
+
+def test_no_task() -> None:
+    with instrumentation.phase("convert"):
+        instrumentation.add_uploaded(100)
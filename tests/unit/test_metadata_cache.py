@@ -0,0 +1,105 @@
+import datetime
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from processing.metadata_cache import MetadataCache
+
+TTL = datetime.timedelta(hours=1)
+
+
+class Fetcher:
+    def __init__(self) -> None:
+        self.n_calls = 0
+
+    def __call__(self) -> dict:
+        self.n_calls += 1
+        return {"call": self.n_calls}
+
+
+def test_caches_values() -> None:
+    cache = MetadataCache(TTL, max_size=10)
+    fetch = Fetcher()
+    assert cache.get("site", "hyytiala", fetch) == {"call": 1}
+    assert cache.get("site", "hyytiala", fetch) == {"call": 1}
+    assert cache.get("product", "hyytiala", fetch) == {"call": 2}
+
+
+def test_expired_values_are_fetched_again() -> None:
+    cache = MetadataCache(datetime.timedelta(0), max_size=10)
+    fetch = Fetcher()
+    cache.get("site", "hyytiala", fetch)
+    cache.get("site", "hyytiala", fetch)
+    assert fetch.n_calls == 2
+
+
+def test_ttl_per_kind() -> None:
+    ttl = {"site": TTL, "product": datetime.timedelta(0)}
+    cache = MetadataCache(ttl, max_size=10)  # type: ignore[arg-type]
+    fetch = Fetcher()
+    for _ in range(2):
+        cache.get("site", "hyytiala", fetch)
+        cache.get("product", "radar", fetch)
+    assert fetch.n_calls == 3
+
+
+def test_evicts_least_recently_used() -> None:
+    cache = MetadataCache(TTL, max_size=2)
+    fetch = Fetcher()
+    cache.get("site", "a", fetch)
+    cache.get("site", "b", fetch)
+    cache.get("site", "a", fetch)
+    cache.get("site", "c", fetch)
+    assert fetch.n_calls == 3
+    cache.get("site", "a", fetch)
+    assert fetch.n_calls == 3
+    cache.get("site", "b", fetch)
+    assert fetch.n_calls == 4
+
+
+def test_invalidate() -> None:
+    cache = MetadataCache(TTL, max_size=10)
+    fetch = Fetcher()
+    cache.get("site", "a", fetch)
+    cache.get("site", "b", fetch)
+    cache.get("model", "ecmwf", fetch)
+    cache.invalidate("site", "a")
+    cache.get("site", "a", fetch)
+    cache.get("site", "b", fetch)
+    assert fetch.n_calls == 4
+    cache.invalidate()
+    cache.get("model", "ecmwf", fetch)
+    assert fetch.n_calls == 5
+
+
+def test_persistence(tmp_path: Path) -> None:
+    path = tmp_path / "cache.sqlite"
+    fetch = Fetcher()
+    MetadataCache(TTL, max_size=10, path=path).get("site", "a", fetch)
+    cache = MetadataCache(TTL, max_size=10, path=path)
+    assert cache.get("site", "a", fetch) == {"call": 1}
+    cache.invalidate("site")
+    cache = MetadataCache(TTL, max_size=10, path=path)
+    assert cache.get("site", "a", fetch) == {"call": 2}
+
+
+def test_connections_are_closed(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    connections: list[sqlite3.Connection] = []
+    original_connect = sqlite3.connect
+
+    def connect(path: Path, timeout: float) -> sqlite3.Connection:
+        conn = original_connect(path, timeout=timeout)
+        connections.append(conn)
+        return conn
+
+    monkeypatch.setattr(sqlite3, "connect", connect)
+    cache = MetadataCache(TTL, max_size=10, path=tmp_path / "cache.sqlite")
+    cache.get("site", "a", Fetcher())
+    cache.invalidate("site")
+    assert len(connections) == 4
+    for conn in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
@@ -0,0 +1,418 @@
+import gzip
+import hashlib
+import io
+import logging
+import os
+import tarfile
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+import requests
+import urllib3
+
+from processing import storage_api
+from processing.config import Config
+from processing.file_cache import FileCache
+from processing.storage_api import (
+    DOWNLOAD_BUFFER_SIZE,
+    MAX_DOWNLOAD_CONNECTIONS,
+    MAX_DOWNLOAD_WORKERS,
+    MIN_DOWNLOAD_WORKERS,
+    PARALLEL_RANGE_PARTS,
+    DownloadCancelledError,
+    DownloadStats,
+    StorageApi,
+    StorageApiError,
+    _download_decompressed,
+    _download_url,
+    _make_download_session,
+)
+
+
+def test_many_small_files_use_many_workers() -> None:
+    stats = DownloadStats()
+    assert stats.concurrency([10_000] * 500) == MAX_DOWNLOAD_WORKERS
+    assert stats.concurrency([10_000] * 3) == 3
+
+
+def test_large_files_use_few_workers() -> None:
+    stats = DownloadStats()
+    assert stats.concurrency([500_000_000] * 24) == MIN_DOWNLOAD_WORKERS
+
+
+def test_concurrency_adapts_to_observations() -> None:
+    stats = DownloadStats()
+    sizes = [10_000_000] * 100
+    n_workers = stats.concurrency(sizes)
+    for _ in range(20):
+        stats.add(latency=1, n_bytes=10_000_000, transfer_time=0.1)
+    assert stats.concurrency(sizes) > n_workers
+    for _ in range(20):
+        stats.add(latency=0.01, n_bytes=10_000_000, transfer_time=10)
+    assert stats.concurrency(sizes) == MIN_DOWNLOAD_WORKERS
+
+
+def test_no_files() -> None:
+    assert DownloadStats().concurrency([]) == 1
+
+
+def test_pool_fits_range_downloads_of_all_workers() -> None:
+    session = _make_download_session()
+    adapter = session.get_adapter("https://example.com")
+    pool = adapter.poolmanager.connection_from_url("https://example.com")  # type: ignore[attr-defined]
+    assert pool.pool.maxsize == MAX_DOWNLOAD_CONNECTIONS
+
+
+class FakeRaw(io.BytesIO):
+    def __init__(self, data: bytes, fail_after: int | None) -> None:
+        super().__init__(data)
+        self.fail_after = fail_after
+        self.decode_content = False
+
+    def readinto(self, buffer: memoryview) -> int:  # type: ignore[override]
+        if self.fail_after is not None and self.tell() >= self.fail_after:
+            raise urllib3.exceptions.ProtocolError("Connection broken")
+        return super().readinto(memoryview(buffer)[:65536])
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, raw: FakeRaw) -> None:
+        self.status_code = status_code
+        self.raw = raw
+
+    def raise_for_status(self) -> None:
+        pass
+
+    def __enter__(self) -> "FakeResponse":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        pass
+
+
+class FakeSession:
+    """Serves `data`, breaking the first responses after `fail_after` bytes."""
+
+    def __init__(
+        self, data: bytes, fail_after: int | None = None, ranges: bool = True
+    ) -> None:
+        self.data = data
+        self.fail_after = fail_after
+        self.ranges = ranges
+        self.requests: list[str | None] = []
+        self._lock = threading.Lock()
+
+    def get(
+        self, url: str, headers: dict | None = None, **kwargs: object
+    ) -> FakeResponse:
+        range_header = headers.get("Range") if headers else None
+        with self._lock:
+            self.requests.append(range_header)
+            fail_after = self.fail_after
+            self.fail_after = None
+        if range_header is None or not self.ranges:
+            return FakeResponse(200, FakeRaw(self.data, fail_after))
+        start, _, end = range_header.removeprefix("bytes=").partition("-")
+        data = self.data[int(start) : int(end) + 1 if end else None]
+        return FakeResponse(206, FakeRaw(data, fail_after))
+
+
+def _download(session: FakeSession, path: Path) -> int:
+    return _download_url(
+        url="https://example.com/file",
+        size=len(session.data),
+        checksum=hashlib.sha256(session.data).hexdigest(),
+        checksum_algorithm="sha256",
+        output_path=path,
+        auth=("user", "pass"),
+        session=session,  # type: ignore[arg-type]
+    )
+
+
+def test_resume_interrupted_download(tmp_path: Path) -> None:
+    data = os.urandom(3 * DOWNLOAD_BUFFER_SIZE)
+    session = FakeSession(data, fail_after=DOWNLOAD_BUFFER_SIZE)
+    path = tmp_path / "file"
+    assert _download(session, path) == len(data)
+    assert path.read_bytes() == data
+    assert session.requests == [None, f"bytes={DOWNLOAD_BUFFER_SIZE}-"]
+
+
+def test_restart_if_range_is_not_supported(tmp_path: Path) -> None:
+    data = os.urandom(3 * DOWNLOAD_BUFFER_SIZE)
+    session = FakeSession(data, fail_after=DOWNLOAD_BUFFER_SIZE, ranges=False)
+    path = tmp_path / "file"
+    assert _download(session, path) == len(data)
+    assert path.read_bytes() == data
+
+
+def test_parallel_ranges(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(storage_api, "PARALLEL_RANGE_MIN_SIZE", 1000)
+    data = os.urandom(3 * DOWNLOAD_BUFFER_SIZE + 1)
+    session = FakeSession(data, fail_after=1000)
+    path = tmp_path / "file"
+    assert _download(session, path) == len(data)
+    assert path.read_bytes() == data
+    assert len(session.requests) == PARALLEL_RANGE_PARTS + 1
+
+    session = FakeSession(data, ranges=False)
+    path.unlink()
+    assert _download(session, path) == len(data)
+    assert path.read_bytes() == data
+
+
+def test_decompress_while_downloading(tmp_path: Path) -> None:
+    content = os.urandom(100_000)
+    session = FakeSession(gzip.compress(content))
+    n_bytes, paths = _download_decompressed(
+        url="https://example.com/file.znc.gz",
+        size=len(session.data),
+        checksum=hashlib.md5(session.data).hexdigest(),
+        checksum_algorithm="md5",
+        output_path=tmp_path / "file.znc.gz",
+        auth=("user", "pass"),
+        session=session,  # type: ignore[arg-type]
+    )
+    assert n_bytes == len(session.data)
+    assert paths == [tmp_path / "file.znc"]
+    assert paths[0].read_bytes() == content
+    assert not (tmp_path / "file.znc.gz").exists()
+
+
+@pytest.mark.parametrize("filename", ["file.znc.gz", "file.znc"])
+def test_decompressed_download_is_cached(tmp_path: Path, filename: str) -> None:
+    content = os.urandom(100_000)
+    session = FakeSession(
+        gzip.compress(content) if filename.endswith(".gz") else content
+    )
+    cache = FileCache(tmp_path / "cache", max_size=10**6)
+    for expected_n_bytes in (len(session.data), 0):
+        download_dir = tmp_path / str(expected_n_bytes)
+        download_dir.mkdir()
+        n_bytes, paths = _download_decompressed(
+            url=f"https://example.com/{filename}",
+            size=len(session.data),
+            checksum=hashlib.md5(session.data).hexdigest(),
+            checksum_algorithm="md5",
+            output_path=download_dir / filename,
+            auth=("user", "pass"),
+            session=session,  # type: ignore[arg-type]
+            cache=cache,
+        )
+        assert n_bytes == expected_n_bytes
+        assert paths == [download_dir / "file.znc"]
+        assert paths[0].read_bytes() == content
+        assert list(download_dir.iterdir()) == paths
+    assert len(session.requests) == 1
+
+
+def test_invalid_decompressed_download_is_not_cached(tmp_path: Path) -> None:
+    session = FakeSession(gzip.compress(os.urandom(100_000)))
+    cache = FileCache(tmp_path / "cache", max_size=10**6)
+    checksum = hashlib.md5(b"other").hexdigest()
+    _download_decompressed(
+        url="https://example.com/file.znc.gz",
+        size=len(session.data),
+        checksum=checksum,
+        checksum_algorithm="md5",
+        output_path=tmp_path / "file.znc.gz",
+        auth=("user", "pass"),
+        session=session,  # type: ignore[arg-type]
+        cache=cache,
+    )
+    assert not cache.fetch(checksum, "md5", tmp_path / "cached")
+    assert not (tmp_path / "file.znc.gz").exists()
+
+
+def test_corrupt_cached_download_is_skipped(
+    tmp_path: Path, caplog: pytest.LogCaptureFixture
+) -> None:
+    data = b"not gzip"
+    checksum = hashlib.md5(data).hexdigest()
+    cache = FileCache(tmp_path / "cache", max_size=10**6)
+    (tmp_path / "source.gz").write_bytes(data)
+    cache.insert(tmp_path / "source.gz", checksum, "md5")
+    session = FakeSession(data)
+    with caplog.at_level(logging.WARNING):
+        n_bytes, paths = _download_decompressed(
+            url="https://example.com/file.znc.gz",
+            size=len(data),
+            checksum=checksum,
+            checksum_algorithm="md5",
+            output_path=tmp_path / "file.znc.gz",
+            auth=("user", "pass"),
+            session=session,  # type: ignore[arg-type]
+            cache=cache,
+        )
+    assert (n_bytes, paths) == (0, [])
+    assert "Cannot unzip gz file" in caplog.text
+    assert not session.requests
+    assert not (tmp_path / "file.znc.gz").exists()
+
+
+def test_decompress_tar_while_downloading(
+    tmp_path: Path, caplog: pytest.LogCaptureFixture
+) -> None:
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+        for name in ("a.znc", "b.znc"):
+            info = tarfile.TarInfo(name)
+            info.size = 100
+            tar.addfile(info, io.BytesIO(bytes(100)))
+    session = FakeSession(archive.getvalue())
+    with caplog.at_level(logging.WARNING):
+        n_bytes, paths = _download_decompressed(
+            url="https://example.com/file.znc.tar.gz",
+            size=len(session.data),
+            checksum=hashlib.md5(session.data).hexdigest(),
+            checksum_algorithm="md5",
+            output_path=tmp_path / "file.znc.tar.gz",
+            auth=("user", "pass"),
+            session=session,  # type: ignore[arg-type]
+        )
+    assert n_bytes == len(session.data)
+    assert paths == [tmp_path / "a.znc", tmp_path / "b.znc"]
+    assert not caplog.records
+
+
+def test_truncated_tar_keeps_extracted_files(
+    tmp_path: Path, caplog: pytest.LogCaptureFixture
+) -> None:
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+        for name in ("a.znc", "b.znc"):
+            content = os.urandom(100_000)
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    data = archive.getvalue()[:-50_000]
+    session = FakeSession(data)
+    with caplog.at_level(logging.WARNING):
+        _, paths = _download_decompressed(
+            url="https://example.com/file.znc.tar.gz",
+            size=len(data),
+            checksum=hashlib.md5(data).hexdigest(),
+            checksum_algorithm="md5",
+            output_path=tmp_path / "file.znc.tar.gz",
+            auth=("user", "pass"),
+            session=session,  # type: ignore[arg-type]
+        )
+    assert paths == [tmp_path / "a.znc"]
+    assert "Cannot unzip gz file" in caplog.text
+
+
+class SlowRaw(FakeRaw):
+    def readinto(self, buffer: memoryview) -> int:  # type: ignore[override]
+        time.sleep(0.01)
+        return super().readinto(memoryview(buffer)[:1000])
+
+
+class SlowSession(FakeSession):
+    def get(
+        self, url: str, headers: dict | None = None, **kwargs: object
+    ) -> FakeResponse:
+        return FakeResponse(200, SlowRaw(self.data, None))
+
+
+class FailingRangeSession(FakeSession):
+    """Fails the request of the first range and serves others slowly."""
+
+    def __init__(self, data: bytes) -> None:
+        super().__init__(data)
+        self.raws: list[FakeRaw] = []
+
+    def get(
+        self, url: str, headers: dict | None = None, **kwargs: object
+    ) -> FakeResponse:
+        range_header = headers.get("Range") if headers else None
+        if range_header is not None and range_header.startswith("bytes=0-"):
+            raise requests.HTTPError("Range failed")
+        raw = SlowRaw(self.data, None)
+        self.raws.append(raw)
+        return FakeResponse(206, raw)
+
+
+def test_failed_range_stops_other_ranges(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(storage_api, "PARALLEL_RANGE_MIN_SIZE", 1000)
+    session = FailingRangeSession(os.urandom(PARALLEL_RANGE_PARTS * 100_000))
+    with pytest.raises(requests.HTTPError):
+        _download(session, tmp_path / "file")
+    assert all(raw.tell() < 100_000 for raw in session.raws)
+
+
+def test_parallel_ranges_update_throughput(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(storage_api, "PARALLEL_RANGE_MIN_SIZE", 1000)
+    data = os.urandom(PARALLEL_RANGE_PARTS * DOWNLOAD_BUFFER_SIZE)
+    stats = DownloadStats(throughput=1)
+    _download_url(
+        url="https://example.com/file",
+        size=len(data),
+        checksum=hashlib.sha256(data).hexdigest(),
+        checksum_algorithm="sha256",
+        output_path=tmp_path / "file",
+        auth=("user", "pass"),
+        session=FakeSession(data),  # type: ignore[arg-type]
+        stats=stats,
+    )
+    assert stats.throughput > 1
+
+
+def test_cancelled_download(tmp_path: Path) -> None:
+    session = FakeSession(os.urandom(1000))
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(DownloadCancelledError):
+        _download_url(
+            url="https://example.com/file",
+            size=len(session.data),
+            checksum=hashlib.sha256(session.data).hexdigest(),
+            checksum_algorithm="sha256",
+            output_path=tmp_path / "file",
+            auth=("user", "pass"),
+            session=session,  # type: ignore[arg-type]
+            cancel=cancel,
+        )
+
+
+def test_parallel_download_deadline(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    environ = {
+        "STORAGE_SERVICE_URL": "https://storage.example.com",
+        "STORAGE_SERVICE_USER": "user",
+        "STORAGE_SERVICE_PASSWORD": "pass",
+        "DATAPORTAL_PUBLIC_URL": "https://example.com",
+        "DATAPORTAL_URL": "https://example.com",
+        "PID_SERVICE_URL": "https://pid.example.com",
+        "PID_SERVICE_TEST_ENV": "true",
+        "FREEZE_AFTER_DAYS": "3",
+        "FREEZE_MODEL_AFTER_DAYS": "4",
+        "DVAS_PORTAL_URL": "https://dvas.example.com",
+        "DVAS_ACCESS_TOKEN": "token",
+        "DVAS_USERNAME": "user",
+        "DVAS_PASSWORD": "pass",
+    }
+    api = StorageApi(Config(environ), requests.Session())  # type: ignore[arg-type]
+    data = os.urandom(1_000_000)
+    api._download_session = SlowSession(data)  # type: ignore[assignment]
+    monkeypatch.setattr(storage_api, "DOWNLOAD_TIMEOUT", 0.1)
+    meta = [
+        SimpleNamespace(
+            filename=f"file{i}",
+            size=len(data),
+            checksum=hashlib.sha256(data).hexdigest(),
+            download_url=f"https://example.com/api/download/file{i}",
+        )
+        for i in range(3)
+    ]
+    start_time = time.perf_counter()
+    with pytest.raises(StorageApiError):
+        api._download_parallel(meta, "sha256", tmp_path)  # type: ignore[arg-type]
+    assert time.perf_counter() - start_time < 1
@@ -0,0 +1,55 @@
+import gzip
+import io
+import logging
+import os
+import tarfile
+from pathlib import Path
+
+import pytest
+
+from processing.instrument_process import PARALLEL_UNZIP_MIN_FILES, _unzip_gz_files
+
+
+def _create_files(directory: Path, n_files: int) -> list[Path]:
+    paths = []
+    for i in range(n_files):
+        path = directory / f"file{i:03}.nc.gz"
+        path.write_bytes(gzip.compress(f"content {i}".encode()))
+        paths.append(path)
+    plain_path = directory / "plain.nc"
+    plain_path.write_bytes(b"plain")
+    paths.insert(1, plain_path)
+    bad_path = directory / "bad.nc.gz"
+    bad_path.write_bytes(b"not gzip")
+    paths.insert(3, bad_path)
+    return paths
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_unzip_gz_files(
+    tmp_path: Path, caplog: pytest.LogCaptureFixture, max_workers: int
+) -> None:
+    n_files = 2 * PARALLEL_UNZIP_MIN_FILES
+    paths = _create_files(tmp_path, n_files)
+    with caplog.at_level(logging.WARNING):
+        paths_out = _unzip_gz_files(paths, max_workers)
+    expected = [tmp_path / f"file{i:03}.nc" for i in range(n_files)]
+    expected.insert(1, tmp_path / "plain.nc")
+    assert paths_out == expected
+    assert paths_out[2].read_text() == "content 1"
+    assert not list(tmp_path.glob("file*.gz"))
+    assert "Cannot unzip gz file" in caplog.text
+    assert "bad.nc.gz" in caplog.text
+
+
+def test_truncated_tar_keeps_extracted_files(tmp_path: Path) -> None:
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+        for name in ("a.nc", "b.nc"):
+            content = os.urandom(100_000)
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    path = tmp_path / "file.tar.gz"
+    path.write_bytes(archive.getvalue()[:-50_000])
+    assert _unzip_gz_files([path]) == [tmp_path / "a.nc"]
@@ -1,8 +1,11 @@
 import gzip
+import logging
+import os
 import shutil
 import tarfile
 from io import BytesIO
 from pathlib import Path
+from typing import Literal, NoReturn
 
 import netCDF4
 import numpy as np
@@ -12,8 +15,19 @@ from cloudnet_api_client.utils import md5sum, sha256sum
 from numpy import ma
 
 from processing import netcdf_comparer
+from processing.hashing import (
+    file_digests,
+    invalidate_file_digests,
+    read_variable_digests,
+    variable_digests,
+)
 from processing.netcdf_comparer import NCDiff
-from processing.utils import unzip_gz_file
+from processing.storage_api import StorageApiFileInfo
+from processing.utils import (
+    FileFinalizer,
+    create_product_put_payload,
+    unzip_gz_file,
+)
 
 test_file_path = Path(__file__).parent.absolute()
 
@@ -32,6 +46,32 @@ class TestHash:
             == "48e006f769a9352a42bf41beac449eae62aea545f4d3ba46bffd35759d8982ca"
         )
 
+    def test_file_digests(self) -> None:
+        digests = file_digests(Path(self.file))
+        assert digests.md5.hex() == "c81d7834d7189facbc5f63416fe5b3da"
+        assert digests.md5_base64 == md5sum(self.file, is_base64=True)
+        assert digests.sha256_hex == sha256sum(self.file)
+
+    def test_file_digests_modified_file(self, tmp_path: Path) -> None:
+        path = tmp_path / "file"
+        path.write_bytes(b"old")
+        old_digests = file_digests(path)
+        assert file_digests(path) is old_digests
+        path.write_bytes(b"longer")
+        assert file_digests(path).sha256_hex == sha256sum(path)
+
+    def test_file_digests_invalidated(self, tmp_path: Path) -> None:
+        path = tmp_path / "file"
+        path.write_bytes(b"old")
+        stat = path.stat()
+        file_digests(path)
+        # Same size and timestamps, as with a modification within the
+        # resolution of file timestamps.
+        path.write_bytes(b"new")
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        invalidate_file_digests(path)
+        assert file_digests(path).sha256_hex == sha256sum(path)
+
 
 def test_are_identical_nc_files_real_data() -> None:
     fname1 = "tests/data/20180703_granada_classification_old.nc"
@@ -607,6 +647,216 @@ def test_different_dimensions(
     assert netcdf_comparer.nc_difference(fname1, fname2) == expected
 
 
+def _write_2d_files(
+    old_file: Path, new_file: Path, old_data: npt.NDArray, new_data: npt.NDArray
+) -> None:
+    for fname, data in ((old_file, old_data), (new_file, new_data)):
+        with netCDF4.Dataset(fname, "w") as nc:
+            nc.createDimension("time", data.shape[0])
+            nc.createDimension("range", data.shape[1])
+            var = nc.createVariable("data", "f4", ("time", "range"))
+            var[:] = data
+
+
+@pytest.mark.parametrize(
+    "factor, n_masked, expected",
+    [
+        (1.0, 0, NCDiff.NONE),
+        (1.002, 0, NCDiff.MINOR),
+        (1.0, 10, NCDiff.MINOR),
+        (1.0, 1000, NCDiff.MAJOR),
+    ],
+)
+def test_compare_in_chunks(
+    factor: float,
+    n_masked: int,
+    expected: NCDiff,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    old_file = tmp_path / "file1.nc"
+    new_file = tmp_path / "file2.nc"
+    data = np.random.rand(1000, 100) + 1
+    mask = np.arange(data.size).reshape(data.shape) >= data.size - n_masked
+    new_data = ma.array(data * factor, mask=mask)
+    _write_2d_files(old_file, new_file, data, new_data)
+    monkeypatch.setattr(netcdf_comparer, "CHUNK_MEMORY", 1000)
+    assert netcdf_comparer.nc_difference(old_file, new_file) == expected
+
+
+def test_compare_stops_at_major_difference(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    old_file = tmp_path / "file1.nc"
+    new_file = tmp_path / "file2.nc"
+    data = np.random.rand(1000, 100) + 1
+    new_data = ma.array(data * 100)
+    new_data[:10] = ma.masked
+    _write_2d_files(old_file, new_file, data, new_data)
+    monkeypatch.setattr(netcdf_comparer, "CHUNK_MEMORY", 4000)
+    n_chunks = 0
+    iter_chunks = netcdf_comparer._iter_chunks
+
+    def counting_iter_chunks(*args: netCDF4.Variable):  # noqa: ANN202
+        nonlocal n_chunks
+        for chunk in iter_chunks(*args):
+            n_chunks += 1
+            yield chunk
+
+    monkeypatch.setattr(netcdf_comparer, "_iter_chunks", counting_iter_chunks)
+    assert netcdf_comparer.nc_difference(old_file, new_file) == NCDiff.MAJOR
+    assert n_chunks < 100
+
+
+def test_values_are_not_compared_after_major_difference(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    old_file = tmp_path / "file1.nc"
+    new_file = tmp_path / "file2.nc"
+    data = np.random.rand(1000, 100) + 1
+    _write_2d_files(old_file, new_file, data, data * 100)
+    monkeypatch.setattr(netcdf_comparer, "CHUNK_MEMORY", 4000)
+    n_calls = 0
+    add_values = netcdf_comparer._DiffStats.add_values
+
+    def counting_add_values(
+        stats: netcdf_comparer._DiffStats, *args: npt.NDArray
+    ) -> None:
+        nonlocal n_calls
+        n_calls += 1
+        add_values(stats, *args)
+
+    monkeypatch.setattr(netcdf_comparer._DiffStats, "add_values", counting_add_values)
+    assert netcdf_comparer.nc_difference(old_file, new_file) == NCDiff.MAJOR
+    assert n_calls < 100
+
+
+def test_minor_mask_differences_precede_major_values(tmp_path: Path) -> None:
+    old_file = tmp_path / "file1.nc"
+    new_file = tmp_path / "file2.nc"
+    data = np.random.rand(1000, 100) + 1
+    new_data = ma.array(data * 2)
+    new_data[-1, :5] = ma.masked
+    _write_2d_files(old_file, new_file, data, new_data)
+    assert netcdf_comparer.nc_difference(old_file, new_file) == NCDiff.MINOR
+
+
+@pytest.mark.parametrize(
+    "factors, expected",
+    [
+        ((1.0, 1.0, 1.0), NCDiff.NONE),
+        ((1.0, 1.002, 2.0), NCDiff.MINOR),
+        ((1.0, 2.0, 1.002), NCDiff.MAJOR),
+    ],
+)
+def test_first_different_variable_decides(
+    factors: tuple[float, ...],
+    expected: NCDiff,
+    tmp_path: Path,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    old_file = tmp_path / "file1.nc"
+    new_file = tmp_path / "file2.nc"
+    data = np.random.rand(1000) + 1
+    for fname, is_new in ((old_file, False), (new_file, True)):
+        with netCDF4.Dataset(fname, "w") as nc:
+            nc.createDimension("time", len(data))
+            for ind, factor in enumerate(factors):
+                var = nc.createVariable(f"var{ind}", "f4", ("time",))
+                var[:] = data * factor if is_new else data
+    with caplog.at_level(logging.INFO):
+        assert netcdf_comparer.nc_difference(old_file, new_file) == expected
+    messages = [record.getMessage() for record in caplog.records]
+    if expected == NCDiff.NONE:
+        assert not messages
+    else:
+        assert len(messages) == 1
+        assert messages[0].startswith("Variable 'var1'")
+
+
+def _write_digest_file(
+    fname: Path, data: npt.NDArray, units: str = "m", dtype: str = "f4"
+) -> None:
+    with netCDF4.Dataset(fname, "w") as nc:
+        nc.createDimension("time", len(data))
+        endian: Literal["big", "native"] = "big" if dtype.startswith(">") else "native"
+        var = nc.createVariable("data", dtype, ("time",), endian=endian)
+        var.units = units
+        var[:] = data
+    with FileFinalizer(fname) as finalizer:
+        finalizer.add_global_attributes()
+
+
+def test_variable_digests(tmp_path: Path) -> None:
+    values = np.random.rand(1000)
+    data = ma.array(values, mask=np.arange(1000) < 10)
+    files = [tmp_path / f"file{i}.nc" for i in range(5)]
+    _write_digest_file(files[0], data)
+    _write_digest_file(files[1], data, dtype=">f4")
+    _write_digest_file(files[2], data, units="km")
+    _write_digest_file(files[3], data * 1.001)
+    _write_digest_file(files[4], ma.array(values, mask=np.arange(1000) < 11))
+    digests = []
+    for fname in files:
+        with netCDF4.Dataset(fname) as nc:
+            digests.append(read_variable_digests(nc)["data"])
+            assert read_variable_digests(nc) == variable_digests(nc)
+    assert digests[0] == digests[1]
+    assert len(set(digests[1:])) == 4
+
+
+def test_identical_digests_skip_data_comparison(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    old_file = tmp_path / "file1.nc"
+    new_file = tmp_path / "file2.nc"
+    data = np.random.rand(1000)
+    _write_digest_file(old_file, data)
+    _write_digest_file(new_file, data)
+
+    def fail(*args: object) -> NoReturn:
+        raise AssertionError("Data should not be compared")
+
+    monkeypatch.setattr(netcdf_comparer, "_iter_chunks", fail)
+    assert netcdf_comparer.nc_difference(old_file, new_file) == NCDiff.NONE
+    monkeypatch.undo()
+
+    _write_digest_file(new_file, data * 2)
+    assert netcdf_comparer.nc_difference(old_file, new_file) == NCDiff.MAJOR
+
+
+def test_file_finalizer(tmp_path: Path) -> None:
+    fname = tmp_path / "file.nc"
+    with netCDF4.Dataset(fname, "w") as nc:
+        nc.cloudnet_file_type = "lidar"
+        nc.year, nc.month, nc.day = "2024", "06", "01"
+        nc.file_uuid = "old-uuid"
+        nc.cloudnetpy_version = "1.2.3"
+        nc.createDimension("time", 3)
+        nc.createVariable("time", "f4", ("time",))[:] = [0, 12, 23.5]
+    with FileFinalizer(fname, summarize=True) as finalizer:
+        finalizer.set("pid", "https://hdl.handle.net/1")
+        finalizer.set("file_uuid", "new-uuid")
+        assert finalizer.get("file_uuid") == "new-uuid"
+        finalizer.add_global_attributes("https://hdl.handle.net/2", "abc")
+        with netCDF4.Dataset(fname) as nc:
+            assert not hasattr(nc, "pid")
+    assert finalizer.summary is not None
+    assert finalizer.summary["uuid"] == "new-uuid"
+    assert finalizer.summary["instrumentPid"] == "https://hdl.handle.net/2"
+    assert finalizer.summary["stopTime"] == "2024-06-01T23:30:00+0000"
+    assert finalizer.variables == ["time"]
+    with netCDF4.Dataset(fname) as nc:
+        assert nc.input_fingerprint == "abc"
+        assert read_variable_digests(nc) == variable_digests(nc)
+    file_info = StorageApiFileInfo(version="1", size=100)
+    args = (fname, file_info, "hyytiala", False, False, None)
+    expected = create_product_put_payload(*args)
+    assert create_product_put_payload(*args, finalizer.summary) == expected
+    assert expected["pid"] == "https://hdl.handle.net/1"
+    assert expected["software"]["cloudnetpy"] == "1.2.3"
+
+
 def test_compression(tmp_path: Path) -> None:
     old_file = tmp_path / "file1.nc"
     new_file = tmp_path / "file2.nc"